@@ -16,9 +16,10 @@ from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.exc import NoResultFound, NoSuchTableError
 
 import duo_utils
+import wsgi_server
 
-makeimport traceback
-from duo_universal.client import Client, DuoExecption
+import traceback
+from duo_universal.client import Client, DuoException
 
 DEBUG = False
 cfg_file = "instance/duo.conf"
@@ -52,10 +53,7 @@ login_manager.session_protection = "strong"
 @login_manager.user_loader
 def loader_user(user_id):
     """Retrieve user from DB"""
-    try:
-        return Users.query.session.execute(db.select(Users).where(Users.id == user_id))
-    except NoResultFound:
-        return None
+    return db.session.get(Users, int(user_id))
 
 
 @app.route('/register', methods=["GET", "POST"])
@@ -234,6 +232,22 @@ def process_args():
             default=False,
 
     )
+
+    parser.add_argument(
+            "--workers",
+            "-w",
+            help="Number of pre-fork worker processes. [Default: server_workers from duo.conf]",
+            type=int,
+            metavar="N"
+    )
+
+    parser.add_argument(
+            "--threads",
+            "-t",
+            help="Number of request threads per worker. [Default: server_threads from duo.conf]",
+            type=int,
+            metavar="N"
+    )
     return parser.parse_known_args()[0]
 
 
@@ -260,4 +274,8 @@ if __name__ == '__main__':
     duo_failmode = config[config_section]['failmode']
     """
 
-    app.run(host=config[config_section]['app_host'], port=int(config[config_section]['app_port']), debug=True)
+    wsgi_server.serve(app, config[config_section],
+                      workers=args.workers,
+                      threads=args.threads,
+                      debug=args.debug,
+                      logger=app_logger)
@@ -0,0 +1,261 @@
+"""
+Asyncio (ASGI) edition of the Duo demo application built with Quart. Duo API calls, database
+access and password hashing are awaited, so a worker can hold thousands of in-flight Duo
+redirects without a thread for each of them.
+
+Run with ``python3 app_asgi.py`` or any ASGI server, e.g. ``hypercorn app_asgi:app``.
+"""
+from __future__ import annotations, print_function
+
+import argparse
+import configparser
+import json
+import os
+
+import sqlalchemy as sa
+from duo_universal.client import DuoException
+from quart import Quart, flash, make_response, redirect, render_template, request, session, url_for
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+import duo_health
+import duo_transport
+import duo_utils
+import password_hasher
+
+cfg_file = "instance/duo.conf"
+app_logger = duo_utils.get_logger(use_queue=True)
+app = Quart(__name__)
+app.secret_key = os.urandom(32)
+
+metadata = sa.MetaData()
+# Same table as the Users model of app_with_duo.py so both editions can share a database
+users = sa.Table(
+        "users",
+        metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("username", sa.String(250), unique=True, nullable=False),
+        sa.Column("password", sa.String(250), nullable=False),
+)
+
+engine: AsyncEngine = None
+duo_client: duo_transport.AsyncPooledClient = None
+duo_health_monitor: duo_health.DuoHealthMonitor = None
+hasher: password_hasher.PasswordHasher = None
+duo_failmode = "closed"
+
+
+def configure(section, /, *, database_uri: str = None):
+    """Set up the Duo client, health monitor, password hasher and database engine from a duo.conf section"""
+    global engine, duo_client, duo_health_monitor, hasher, duo_failmode
+    duo_utils.get_logger(app_logger.name, use_queue=True, **duo_utils.logging_options_from_config(section))
+    if database_uri is None:
+        database_uri = "sqlite+aiosqlite:///" + os.path.join(app.instance_path, "db.sqlite")
+    engine = create_async_engine(database_uri)
+    try:
+        duo_client = duo_transport.AsyncPooledClient(
+                client_id=section['client_id'],
+                client_secret=section['client_secret'],
+                host=section['api_hostname'],
+                redirect_uri=section['redirect_uri'],
+                duo_certs=section.get('duo_certs'),
+                transport=duo_transport.transport_from_config(section),
+        )
+    except DuoException as e:
+        print("*** Duo config error. Verify the values in duo.conf are correct ***")
+        raise e
+    duo_failmode = section['failmode']
+    hasher = password_hasher.hasher_from_config(section)
+    # The monitor refreshes from its own thread with the synchronous pooled client
+    duo_health_monitor = duo_health.DuoHealthMonitor(
+            duo_client.health_check,
+            ttl=section.getfloat('health_ttl', fallback=30.0),
+            jitter=section.getfloat('health_jitter', fallback=0.1),
+            failure_threshold=section.getint('health_failure_threshold', fallback=3),
+            reset_timeout=section.getfloat('health_reset_timeout', fallback=30.0),
+            logger=app_logger,
+    )
+
+
+@app.before_serving
+async def startup():
+    """Create the schema and start the Duo health monitor"""
+    duo_utils.restart_listeners_after_fork()
+    if duo_client is None:
+        # Started by an external ASGI server, configure from the default config file
+        config = configparser.ConfigParser()
+        config.read(cfg_file)
+        configure(config[os.environ.get("DUO_CONFIG_SECTION", "duo")])
+    async with engine.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+    duo_health_monitor.start()
+
+
+@app.after_serving
+async def shutdown():
+    duo_health_monitor.stop()
+    await duo_client.aclose()
+    await engine.dispose()
+    hasher.shutdown()
+
+
+async def get_user(username: str):
+    """Retrieve a user row from the database or None"""
+    async with engine.connect() as conn:
+        result = await conn.execute(sa.select(users).where(users.c.username == username))
+        return result.first()
+
+
+@app.errorhandler(password_hasher.HasherBusy)
+async def hasher_busy(error):
+    """Answer with 503 and Retry-After when the password hashing pool is saturated"""
+    app_logger.warning("%s Rejecting request to %s.", error, request.path)
+    response = await make_response(
+            await render_template("login.html", error="The server is busy. Please try again shortly."), 503)
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+@app.errorhandler(password_hasher.InvalidPassword)
+async def invalid_password(error):
+    """Answer with 400 when a login or registration form has no password"""
+    app_logger.warning("%s Rejecting request to %s.", error, request.path)
+    template = "register.html" if request.endpoint == "register" else "login.html"
+    return await render_template(template, error=str(error)), 400
+
+
+@app.route('/register', methods=["GET", "POST"])
+async def register():
+    """Register a new user in the database"""
+    if request.method == "POST":
+        form = await request.form
+        username = form.get("username")
+        pswd = await hasher.hash_async(form.get('password'))
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(sa.insert(users).values(username=username, password=pswd))
+        except IntegrityError:
+            app_logger.warning("User %s is already registered.", username)
+            return await render_template("register.html", error=f"User {username} is already registered.")
+
+        await flash(f"User {username} successfully registered.")
+        app_logger.info("User %s successfully registered.", username)
+        return redirect(url_for("login"))
+    return await render_template("register.html")
+
+
+@app.route("/login", methods=["GET", "POST"])
+async def login():
+    """Display login screen"""
+    error = None
+    if request.method == "POST":
+        form = await request.form
+        username = form.get("username")
+        if username is None or username == "":
+            app_logger.warning("Username is missing in login POST request.")
+            error = "Username is missing in login POST request."
+            return await render_template("login.html", error=error)
+        user = await get_user(username)
+        if user is None:
+            app_logger.warning("User %s does not exist.", username)
+            error = "User %s is not registered." % username
+            return await render_template("register.html", error=error)
+        if not await hasher.check_async(user.password, form.get("password")):
+            error = "Invalid credentials."
+            app_logger.error("Invalid credentials for %s", username)
+        else:
+            if hasher.needs_rehash(user.password):
+                pswd = await hasher.hash_async(form.get("password"))
+                async with engine.begin() as conn:
+                    await conn.execute(sa.update(users).where(users.c.id == user.id).values(password=pswd))
+                app_logger.info("Password hash for %s upgraded to cost factor %d.", username, hasher.rounds)
+            if not duo_health_monitor.is_available():
+                app_logger.warning("Duo unavailable: %s", duo_health_monitor.status.error)
+                if duo_failmode.upper() == "OPEN":
+                    msg = ("Login 'Successful', but 2FA not performed."
+                           + "Confirm Duo client/secret/host values are correct")
+                    return await render_template("home.html", message=msg)
+                else:
+                    return await render_template("login.html", message="2FA Unavailable.")
+            state = duo_client.generate_state()
+            session["state"] = state
+            session["username"] = username
+            return redirect(duo_client.create_auth_url(username, state))
+    return await render_template("login.html", error=error)
+
+
+@app.route("/duo-callback")
+async def duo_callback():
+    """Get state to verify consistency and originality"""
+    state = request.args.get('state')
+    code = request.args.get('duo_code')
+
+    if 'state' in session and 'username' in session:
+        saved_state = session['state']
+        username = session['username']
+    else:
+        return await render_template("login.html", message="No saved state. Please login again")
+
+    if state != saved_state:
+        return await render_template("login.html", message="Duo state does not match saved state")
+
+    try:
+        decoded_token = await duo_client.exchange_authorization_code_for_2fa_result_async(code, username)
+    except DuoException as duo_exception:
+        app_logger.exception(f"Unable to exchange authorization code for token: {duo_exception}")
+        return await render_template("login.html", error=duo_exception)
+
+    session.pop('state', None)
+    session["username"] = username
+    session["authenticated"] = True
+    app_logger.info("User %s logged in and added to session successfully.", username)
+    return await render_template("home.html",
+                                 message=json.dumps(decoded_token, indent=2, sort_keys=True), username=username)
+
+
+@app.route("/logout")
+async def logout():
+    """Log user out and redirect to home page"""
+    if 'username' in session:
+        app_logger.info("User %s logged out.", session['username'])
+        session.pop('username', None)
+        session.pop('authenticated', None)
+    return redirect(url_for("home"))
+
+
+@app.route("/")
+async def home():
+    """Display home page"""
+    username = session.get("username") if session.get("authenticated") else None
+    return await render_template("home.html", username=username)
+
+
+def process_args():
+    """Process command line arguments"""
+    parser = argparse.ArgumentParser(
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+            "-c",
+            "--config",
+            help="The config section from duo.conf to use",
+            default="duo",
+            metavar=''
+    )
+
+    parser.add_argument(
+            "-f",
+            "--file",
+            help=f"Path to configuration file. [Default: ./instance/duo.conf]",
+            metavar="config_file"
+    )
+    return parser.parse_known_args()[0]
+
+
+if __name__ == '__main__':
+    args = process_args()
+    cfg_file = args.file if args.file is not None else "instance/duo.conf"
+    config = configparser.ConfigParser()
+    config.read(cfg_file)
+    configure(config[args.config])
+    app.run(host=config[args.config]['app_host'], port=int(config[args.config]['app_port']))
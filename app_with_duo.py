@@ -8,53 +8,180 @@ import argparse
 import configparser
 import json
 import os
-import traceback
+import sys
+import threading
 
-from duo_universal.client import Client, DuoException
 from flask import Flask, flash, make_response, redirect, render_template, request, session, url_for
-from flask_bcrypt import Bcrypt
 from flask_login import LoginManager, UserMixin, login_user, logout_user
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.exc import NoResultFound, NoSuchTableError
+from sqlalchemy.orm import make_transient_to_detached
 
+import assets
+import audit
+import duo_config
+import duo_tenants
 import duo_utils
+import metrics
+import password_hasher
+import profiling
+import rate_limit
+import state_store
+import storage
+import user_index
 
 DEBUG = False
 cfg_file = "instance/duo.conf"
-app_logger = duo_utils.get_logger()
+# Incremented whenever the Users model changes, see storage.ensure_schema()
+SCHEMA_VERSION = 1
+app_logger = duo_utils.get_logger(use_queue=True)
 app = Flask(__name__)
-bcrypt = Bcrypt(app)
 app.secret_key = os.urandom(32)
 app.config['CACHE_TYPE'] = 'simple'
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///db.sqlite"
 app.config["SECRET_KEY"] = os.urandom(32)
+# A session cookie per tenant, see duo_tenants
+app.session_interface = duo_tenants.TenantSessionInterface()
 
 db = SQLAlchemy()
 
 
-# The class definition below must be set before calling the db.init_app() and db.create_all() methods below.
+# The class definition below must be set before calling the db.init_app() and db.create_all() methods in configure().
 class Users(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(250), unique=True, nullable=False)
     password = db.Column(db.String(250), nullable=False)
 
 
-db.init_app(app)
-with app.app_context():
-    db.create_all()
+static_assets = assets.StaticAssets(app)
+assets.conditional_pages(app)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.session_protection = "strong"
 
 
+# Optional read-only engines for the login lookups, see configure()
+read_replicas = None
+metrics_enabled = True
+metrics_log_interval = 0.0
+# Login attempts per client IP and username, None when disabled
+login_rate_limiter = None
+# Registered usernames, so logins for unknown names skip the database. None when disabled.
+username_index = None
+
+# The Duo applications served by this process, set by configure(). See current_tenant().
+tenant_registry = None
+# Reloads duo.conf on change or SIGHUP, per process
+config_watcher = None
+# Structured login, Duo and logout events, None when disabled. See record_outcome() and audit.py.
+audit_log = None
+# Traces a sample of the requests and keeps the slow ones, None when profiling is off
+profiler = None
+# /admin/profile shows request paths, tenants, Duo URLs and SQL: off unless enabled, then only the clients
+# profile_access permits
+profile_endpoint_enabled = False
+profile_access = profiling.EndpointAccess()
+_configure_lock = threading.RLock()
+# Process that ran init_worker(), the per-process start up is repeated after a fork
+_worker_pid = None
+
+# Users by id for the Flask-Login user_loader, so authenticated requests normally skip the database
+user_cache = duo_utils.TTLCache()
+
+# Where login time goes, served on /metrics
+app_metrics = metrics.MetricsRegistry()
+login_stage_seconds = app_metrics.histogram("duo_login_stage_seconds",
+                                            "Time spent in each stage of the login and Duo callback flow",
+                                            ("tenant", "stage"))
+login_outcomes = app_metrics.counter("duo_login_outcomes_total", "Results of login attempts and Duo callbacks",
+                                     ("tenant", "outcome"))
+
+
 @login_manager.user_loader
 def loader_user(user_id):
-    """Retrieve user from DB"""
+    """Retrieve user from the cache or the DB"""
+    user_id = int(user_id)
+    cached = user_cache.get(user_id)
+    if cached is None:
+        user = db.session.get(Users, user_id)
+        if user is None:
+            return None
+        # Cache a detached copy, the loaded instance belongs to this request's session
+        cached = Users(id=user.id, username=user.username, password=user.password)
+        make_transient_to_detached(cached)
+        user_cache.put(user_id, cached)
+        return user
+    # Attach the cached copy to this request's session without a SELECT
+    return db.session.merge(cached, load=False)
+
+
+def find_user(username):
+    """Retrieve a user by name, from a read replica when configured. Raises NoResultFound."""
+    if username_index is not None and not username_index.might_exist(username):
+        raise NoResultFound(f"User {username} is not in the username index.")
     try:
-        return Users.query.session.execute(db.select(Users).where(Users.id == user_id))
+        if not read_replicas:
+            return db.session.execute(db.select(Users).filter_by(username=username)).scalar_one()
+        return read_replicas.scalar_one(db.select(Users).filter_by(username=username), db.session)
     except NoResultFound:
-        return None
+        if username_index is not None:
+            username_index.record_miss(username)
+        raise
+
+
+def current_tenant() -> duo_tenants.Tenant:
+    """The Duo application this request was routed to by host name or path prefix"""
+    return tenant_registry.get(request.environ.get(duo_tenants.ENVIRON_KEY))
+
+
+def record_outcome(tenant: duo_tenants.Tenant, outcome: str, username: str = None, detail: str = None):
+    """Count a login or callback outcome and write it to the audit log"""
+    login_outcomes.inc(tenant.name, outcome)
+    audit_event(outcome, username, tenant=tenant, detail=detail)
+
+
+def audit_event(event: str, username: str = None, /, *, tenant: duo_tenants.Tenant = None, detail: str = None):
+    """Queue an audit event for this request, the request does not wait for it to be written"""
+    if audit_log is not None:
+        audit_log.emit(event, tenant=(tenant or current_tenant()).name, username=username, ip=request.remote_addr,
+                       detail=detail)
+
+
+def usernames_after(engine, after_id, limit):
+    """Up to ``limit`` (id, username) rows with an id above ``after_id``, for the username index"""
+    with engine.connect() as conn:
+        return conn.execute(db.select(Users.id, Users.username).where(Users.id > after_id)
+                            .order_by(Users.id).limit(limit)).all()
+
+
+@app.errorhandler(password_hasher.HasherBusy)
+def hasher_busy(error):
+    """Answer with 503 and Retry-After when the password hashing pool is saturated"""
+    app_logger.warning("%s Rejecting request to %s.", error, request.path)
+    response = make_response(render_template("login.html", error="The server is busy. Please try again shortly."),
+                             503)
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+@app.errorhandler(password_hasher.InvalidPassword)
+def invalid_password(error):
+    """Answer with 400 when a login or registration form has no password"""
+    app_logger.warning("%s Rejecting request to %s.", error, request.path)
+    template = "register.html" if request.endpoint == "register" else "login.html"
+    return render_template(template, error=str(error)), 400
+
+
+@app.errorhandler(rate_limit.RateLimitExceeded)
+def rate_limited(error):
+    """Answer with 429 and Retry-After when a client IP or username made too many login attempts"""
+    record_outcome(current_tenant(), "rate_limited", request.form.get("username"),
+                   str(error))
+    app_logger.warning("%s Rejecting request to %s.", error, request.path)
+    response = make_response(render_template("login.html", error="Too many login attempts. Please try again later."),
+                             429)
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
 
 
 @app.route('/register', methods=["GET", "POST"])
@@ -62,15 +189,19 @@ def register():
     """Register a new user in the database"""
     # If the user made a POST request, create a new user
     if request.method == "POST":
-        pswd = bcrypt.generate_password_hash(request.form.get('password')).decode()
+        pswd = hasher.hash(request.form.get('password'))
         user = Users(username=request.form.get("username"),
                      password=pswd)
         # Add the user to the database
         db.session.add(user)
         db.session.commit()
+        user_cache.invalidate(user.id)
+        if username_index is not None:
+            username_index.add(user.username)
 
         flash(f"User {user.username} successfully registered.")
         app_logger.info("User %s successfully registered.", user.username)
+        audit_event("register", user.username)
         # Send the user to the login page after successful registration
         return redirect(url_for("login"))
     # Respond with the registration page if not a POST request
@@ -82,46 +213,70 @@ def login():
     """Display login screen"""
     error = None
     if request.method == "POST":
+        tenant = current_tenant()
         username = request.form.get("username")
         if username is None or username == "":
             app_logger.warning("Username is missing in login POST request.")
             error = "Username is missing in login POST request."
             return render_template("login.html", error=error)
+        if login_rate_limiter is not None:
+            # Before any database, bcrypt or Duo work. remote_addr is the proxy's behind a reverse proxy, see README.
+            login_rate_limiter.check(request.remote_addr, username)
         try:
             # Attempt to retrieve the entered username from the database
-            user = db.session.execute(db.select(Users).filter_by(username=username)).scalar_one()
-            if not bcrypt.check_password_hash(user.password, request.form.get("password")):
+            with login_stage_seconds.time(tenant.name, "lookup"):
+                user = find_user(username)
+            with login_stage_seconds.time(tenant.name, "password_check"):
+                valid = hasher.check(user.password, request.form.get("password"))
+            if not valid:
+                record_outcome(tenant, "invalid_credentials", username)
                 error = "Invalid credentials."
                 app_logger.error("Invalid credentials for %s", username)
             else:
+                if hasher.needs_rehash(user.password):
+                    # The stored hash uses an outdated cost factor, upgrade it while we have the plain password
+                    with login_stage_seconds.time(tenant.name, "rehash"):
+                        user.password = hasher.hash(request.form.get("password"))
+                    db.session.execute(db.update(Users).where(Users.id == user.id).values(password=user.password))
+                    db.session.commit()
+                    user_cache.invalidate(user.id)
+                    app_logger.info("Password hash for %s upgraded to cost factor %d.", username, hasher.rounds)
                 ##########################################################
                 # This is where the Cisco Duo authentication flow begins #
                 ##########################################################
-                try:
-                    # Check to make sure the Duo service is available
-                    duo_client.health_check()
-                except DuoException:
-                    if config.duo_failmode.upper() == "OPEN":
-                        traceback.print_exc()
+                # Check to make sure the Duo service is available. The status is refreshed in the background by
+                # the health monitor so the login request does not wait on a round trip to Duo.
+                # One snapshot for the rest of the request, a concurrent reload does not mix old and new settings
+                context = tenant_registry.use(tenant)
+                with login_stage_seconds.time(tenant.name, "health_check"):
+                    available = tenant.health.is_available()
+                if not available:
+                    app_logger.warning("Duo unavailable for %s: %s", tenant.name, tenant.health.status.error)
+                    if context.config.fail_open:
+                        record_outcome(tenant, "fail_open", username, tenant.health.status.error)
                         msg = ("Login 'Successful', but 2FA not performed."
                                + "Confirm Duo client/secret/host values are correct")
                         return render_template("home.html", message=msg)
                     else:
                         # Duo failmode is set to 'secure' so login is prevented when Duo is unavailable
+                        record_outcome(tenant, "fail_secure", username, tenant.health.status.error)
                         return render_template("login.html", message="2FA Unavailable.")
-                # Generate a unique random state value for each authentication. This value should be store and compared
-                # with the value that is sent to the callback() handler to verify the authentication has not been
-                # tampered with. We do this my storing the value in the browser session.
-                state = duo_client.generate_state()
-                session["state"] = state
-                session["username"] = username
-                prompt_uri = duo_client.create_auth_url(username, state)
-                duo_response_obj = make_response()
+                # Generate a unique random state value for each authentication. This value is stored server side and
+                # compared with the value that is sent to the callback() handler to verify the authentication has not
+                # been tampered with. Keeping it out of the browser session lets any worker handle the callback.
+                client = context.client.get()
+                state = client.generate_state()
+                duo_state_store.put(state, {"username": username, "user_id": user.id, "tenant": tenant.name},
+                                    user=username)
+                with login_stage_seconds.time(tenant.name, "create_auth_url"):
+                    prompt_uri = client.create_auth_url(username, state)
+                record_outcome(tenant, "duo_redirect", username)
                 # Redirect the browser to the Duo hosted authentication prompt
                 return redirect(prompt_uri)
         except NoResultFound:
             # The entered username was not found in the database. This is likely caused by the user having not been
             # previously registered
+            record_outcome(tenant, "unknown_user", username)
             app_logger.warning("User %s does not exist.", username)
             error = "User %s is not registered." % username
             return render_template("register.html", error=error)
@@ -143,37 +298,47 @@ def duo_callback():
     # Get authorization token to trade for 2FA
     code = request.args.get('duo_code')
 
-    if 'state' in session and 'username' in session:
-        saved_state = session['state']
-        username = session['username']
-    else:
-        # For flask, if url used to get to login.html is not localhost,
-        # (ex: 127.0.0.1) then the sessions will be different
-        # and the localhost session does not have the state
+    tenant = current_tenant()
+    # Each state can only be used once, a replayed or expired callback finds nothing here
+    saved_state = duo_state_store.consume(state) if state else None
+    mismatch = None
+    if saved_state is not None and saved_state.get("tenant", tenant.name) != tenant.name:
+        # The login started at another Duo application, its code can not be exchanged here
+        app_logger.warning("Duo state of tenant %s used in a callback for %s.", saved_state["tenant"], tenant.name)
+        mismatch, saved_state = saved_state, None
+    if saved_state is None:
+        record_outcome(tenant, "invalid_state", mismatch and mismatch["username"],
+                       mismatch and f"State of tenant {mismatch['tenant']}")
+        app_logger.warning("Unknown, expired or already used Duo state in callback.")
         return render_template("login.html",
                                message="No saved state. Please login again")
+    username = saved_state["username"]
 
-    # Ensure nonce matches from initial request
-    if state != saved_state:
-        return render_template("login.html",
-                               message="Duo state does not match saved state")
-
+    # Imported with the Duo client in build_duo_client()
+    from duo_universal.client import DuoException
     try:
-        decoded_token = duo_client.exchange_authorization_code_for_2fa_result(code, username)
+        with login_stage_seconds.time(tenant.name, "token_exchange"):
+            client = tenant_registry.use(tenant).client.get()
+            decoded_token = client.exchange_authorization_code_for_2fa_result(code, username)
     except DuoException as duo_exception:
+        record_outcome(tenant, "duo_error", username, str(duo_exception))
         app_logger.exception(f"Unable to exchange authorization code for token: {duo_exception}")
         return render_template("login.html", error=duo_exception)
 
     # Exchange happened successfully so render success page
     # return render_template("success.html",
     #                        message=json.dumps(decoded_token, indent=2, sort_keys=True))
-    user = db.session.execute(db.select(Users).filter_by(username=username)).scalar_one()
-    if login_user(user):
+    with login_stage_seconds.time(tenant.name, "login_user"):
+        user = loader_user(saved_state["user_id"])
+        logged_in = user is not None and login_user(user)
+    if logged_in:
+        record_outcome(tenant, "success", username)
         app_logger.info("User %s logged in and added to session successfully.", username)
         session["username"] = username
         return render_template("home.html",
                                message=json.dumps(decoded_token, indent=2, sort_keys=True), username=username)
     else:
+        record_outcome(tenant, "session_error", username)
         app_logger.warning("Unable to add user %s to session successfully.", username)
         return render_template("home.html", error="Unable to add user to session information.")
 
@@ -183,6 +348,7 @@ def logout():
     """Log user out and redirect to home page"""
     if 'username' in session:
         app_logger.info("User %s logged out.", session['username'])
+        audit_event("logout", session['username'])
         session.pop('username', None)
         logout_user()
     return redirect(url_for("home"))
@@ -198,11 +364,281 @@ def home():
     return render_template("home.html", username=username)
 
 
+@app.route("/metrics")
+def metrics_endpoint():
+    """Login stage latencies, outcomes and component statistics in the Prometheus text format"""
+    if not metrics_enabled:
+        return "Not Found", 404
+    return app_metrics.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
+
+@app.route("/admin/profile")
+def profile_endpoint():
+    """Span trees of the slow requests this worker traced, or collapsed stacks with ?format=folded"""
+    if profiler is None or not profile_endpoint_enabled:
+        return "Not Found", 404
+    if not profile_access.permits(request.remote_addr, request.headers.get("Authorization")):
+        app_logger.warning("Rejected request to %s from %s.", request.path, request.remote_addr)
+        return "Forbidden", 403
+    if request.args.get("format") == "folded":
+        return profiler.folded(), 200, {"Content-Type": "text/plain; charset=utf-8"}
+    return {"stats": profiler.stats(), "slow_requests": profiler.traces()}
+
+
+def configure_storage(section):
+    """Set up the user database and the password hasher from a duo.conf section"""
+    global hasher, read_replicas
+    app.config["SQLALCHEMY_DATABASE_URI"] = section.get('db_uri', fallback=storage.DEFAULT_DATABASE_URI)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = storage.engine_options(section)
+    db.init_app(app)
+    with app.app_context():
+        storage.install_pragmas(db.engine, storage.sqlite_pragmas(section))
+        if storage.ensure_schema(db.engine, db.metadata, SCHEMA_VERSION, marker_dir=app.instance_path):
+            app_logger.info("Database schema created or updated to version %d.", SCHEMA_VERSION)
+    read_replicas = storage.read_replicas_from_config(section)
+    hasher = password_hasher.hasher_from_config(section)
+
+
+def configure_assets(section):
+    """Precompile the templates and serve the static files fingerprinted, compressed and cacheable"""
+    cache_dir = section.get('template_cache_dir', fallback=os.path.join(app.instance_path, "jinja_cache"))
+    count = assets.precompile_templates(app, cache_dir or None)
+    app_logger.info("Precompiled %d templates.", count)
+    static_assets.load(max_age=section.getint('static_max_age', fallback=31536000),
+                       compress=section.getboolean('static_compress', fallback=True))
+
+
+def build_duo_client(settings: duo_config.DuoConfig):
+    """Create the Duo client. duo_universal and requests are only imported here, which keeps them out of
+    the import time of this module."""
+    import duo_tokens
+    import duo_transport
+    from duo_universal.client import DuoException
+
+    try:
+        # Reuse kept-alive connections to Duo for health checks and code exchanges
+        return duo_transport.PooledClient(
+                client_id=settings.client_id,
+                client_secret=settings.client_secret,
+                host=settings.api_hostname,
+                redirect_uri=settings.redirect_uri,
+                duo_certs=settings.duo_certs,
+                transport=duo_transport.transport_from_config(settings.section),
+                verifier=duo_tokens.verifier_from_config(settings.section, settings.client_secret),
+        )
+    except DuoException as e:
+        print("*** Duo config error. Verify the values in duo.conf are correct ***")
+        raise e
+
+
+def get_duo_client():
+    """The Duo client of the default tenant, built on first use"""
+    return tenant_registry.default.context.client.get()
+
+
+def reload_config(settings: duo_config.DuoConfig):
+    """Apply a reloaded duo.conf to every tenant. In-flight requests finish with the snapshot they started with.
+
+    A Duo client is rebuilt when its settings changed, e.g. a rotated client_secret. Changes to other
+    settings than the Duo client, http_*, jwt_*, failmode and the tenants only take effect after a restart.
+    """
+    with _configure_lock:
+        restart = sorted(key for key in duo_config.changed_keys(tenant_registry.config, settings)
+                         if not duo_config.is_reloadable(key))
+        changes = tenant_registry.reload(settings)
+    if restart:
+        app_logger.warning("Changes to %s take effect after a restart.", ", ".join(restart))
+    if changes:
+        app_logger.info("Configuration reloaded from %s, changed: %s", settings.source,
+                        "; ".join(f"[{name}] {', '.join(sorted(keys))}" for name, keys in sorted(changes.items())))
+
+
+def configure(section, /, *, config_file: str = None):
+    """Set up the database, Duo client, health monitor and password hasher from a duo.conf section.
+
+    With ``config_file`` the Duo settings are reloaded when that file changes, see init_worker().
+    Raises duo_config.ConfigError for invalid values.
+    """
+    global tenant_registry, user_cache, duo_state_store, metrics_enabled, metrics_log_interval, login_rate_limiter, \
+        username_index, audit_log, profiler, profile_endpoint_enabled, profile_access
+    settings = duo_config.from_section(section, source=config_file)
+    # Same logger object, its files and queue follow the log_* values
+    duo_utils.get_logger(app_logger.name, use_queue=True, **duo_utils.logging_options_from_config(section))
+    if section.get('secret_key'):
+        # A shared key lets every worker and host decode the session cookies
+        app.secret_key = app.config["SECRET_KEY"] = section['secret_key']
+
+    configure_storage(section)
+    configure_assets(section)
+
+    # One Duo client, health monitor and failmode per tenant section
+    tenant_registry = duo_tenants.TenantRegistry(settings, build_duo_client, logger=app_logger)
+
+    duo_state_store = state_store.state_store_from_config(section, app.instance_path)
+    login_rate_limiter = rate_limit.rate_limiter_from_config(section, app.instance_path)
+    audit_log = audit.audit_log_from_config(section, app.instance_path, app_logger)
+    profiler = profiling.profiler_from_config(section, app_logger)
+    profile_endpoint_enabled = section.getboolean('profile_endpoint_enabled', fallback=False)
+    profile_access = profiling.endpoint_access_from_config(section)
+    if profiler is not None:
+        profiling.instrument_sqlalchemy()
+        profiling.instrument_templates(app)
+        profiling.instrument_logging(app_logger)
+
+    username_index = None
+    if section.getboolean('user_index_enabled', fallback=True):
+        with app.app_context():
+            engine = db.engine
+        username_index = user_index.UsernameIndex(
+                lambda after_id, limit: usernames_after(engine, after_id, limit),
+                capacity=section.getint('user_index_capacity', fallback=100000),
+                error_rate=section.getfloat('user_index_error_rate', fallback=0.001),
+                negative_size=section.getint('user_index_negative_size', fallback=10000),
+                negative_ttl=section.getfloat('user_index_negative_ttl', fallback=60.0),
+                sync_interval=section.getfloat('user_index_sync_interval', fallback=1.0),
+                # Only SQLite commits ids in order, elsewhere catching up by id can miss a user
+                rebuild_interval=(0.0 if engine.dialect.name == "sqlite"
+                                  else section.getfloat('user_index_rebuild_interval', fallback=60.0)),
+                logger=app_logger,
+        )
+
+    user_cache = duo_utils.TTLCache(section.getint('user_cache_size', fallback=1024),
+                                    section.getfloat('user_cache_ttl', fallback=300.0))
+
+    metrics_enabled = section.getboolean('metrics_enabled', fallback=True)
+    metrics_log_interval = section.getfloat('metrics_log_interval', fallback=0.0)
+    register_component_metrics()
+
+
+def register_component_metrics():
+    """Expose the statistics the hasher, Duo transport, user cache and health monitor already keep"""
+    app_metrics.gauge("duo_password_hasher", "Password hasher operations, rejections and timings",
+                      lambda: {f"{operation}_{name}": value for operation, stats in hasher.get_stats().items()
+                               for name, value in stats.items()}, ("stat",))
+    app_metrics.gauge("duo_http_transport", "Requests to Duo and connection pool usage by tenant",
+                      lambda: tenant_client_stats(lambda client: client.transport.stats.as_dict()),
+                      ("tenant", "stat"))
+    app_metrics.gauge("duo_token_verifier", "Duo id_token verifications and key rotations by tenant",
+                      lambda: tenant_client_stats(lambda client: client.verifier.stats()), ("tenant", "stat"))
+    app_metrics.gauge("duo_tenant", "Duo client builds, evictions, idle time and health by tenant",
+                      lambda: tenant_registry.stats(), ("tenant", "stat"))
+    app_metrics.gauge("duo_config_reloads", "Configuration reloads applied and failed in this process",
+                      lambda: {"applied": config_watcher.reloads, "failed": config_watcher.failures}
+                      if config_watcher is not None else {}, ("result",))
+    app_metrics.gauge("duo_audit", "Audit events written, dropped because the writer fell behind, and queued",
+                      lambda: audit_log.stats() if audit_log is not None else {}, ("stat",))
+    app_metrics.gauge("duo_pending_auth", "Pending Duo authentications, the age of the oldest and states dropped",
+                      lambda: duo_state_store.stats(), ("stat",))
+    app_metrics.gauge("duo_profiler", "Requests seen, traced and recorded as slow by the profiler",
+                      lambda: profiler.stats() if profiler is not None else {}, ("stat",))
+    app_metrics.gauge("duo_user_cache", "Flask-Login user cache size, hits, misses and evictions",
+                      lambda: user_cache.stats(), ("stat",))
+    app_metrics.gauge("duo_login_rate_limited", "Login attempts rejected by the rate limiter, by key type",
+                      lambda: login_rate_limiter.stats() if login_rate_limiter is not None else {}, ("key",))
+    app_metrics.gauge("duo_log_queue", "Log records queued for the writer thread and dropped because it was full",
+                      duo_utils.log_queue_stats, ("logger", "stat"))
+    app_metrics.gauge("duo_username_index", "Username index size, memory and false positive rates",
+                      lambda: username_index.stats() if username_index is not None else {}, ("stat",))
+    app_metrics.gauge("duo_available", "1 if the last Duo health check of the tenant succeeded",
+                      lambda: {tenant.name: int(bool(tenant.health.status.healthy)) for tenant in tenant_registry
+                               if tenant.is_built},
+                      ("tenant",))
+
+
+def tenant_client_stats(stats) -> dict:
+    """``stats(client)`` by (tenant, stat) for the tenants whose Duo client is built"""
+    return {(tenant.name, name): value for tenant in tenant_registry if tenant.is_built
+            for name, value in stats(tenant.context.client.get()).items()}
+
+
+def init_worker():
+    """Per-process start up, runs in every server worker after it has been forked"""
+    global _worker_pid, config_watcher
+    _worker_pid = os.getpid()
+    duo_utils.restart_listeners_after_fork()
+    # Do not reuse database connections opened by the parent process
+    with app.app_context():
+        db.engine.dispose(close=False)
+    read_replicas.dispose()
+    tenant_registry.start()
+    duo_state_store.start_sweeper()
+    if login_rate_limiter is not None:
+        login_rate_limiter.start_sweeper()
+    if username_index is not None:
+        username_index.start()
+    if audit_log is not None:
+        audit_log.start()
+    if metrics_log_interval > 0:
+        duo_utils.start_periodic_dump(app_metrics.snapshot, app_logger, metrics_log_interval)
+    settings = tenant_registry.config
+    if config_watcher is not None:
+        config_watcher.stop()
+    if settings.source:
+        config_watcher = duo_config.ConfigWatcher(
+                settings.source, reload_config,
+                section_name=settings.section.name,
+                interval=settings.section.getfloat('config_reload_interval', fallback=5.0),
+                logger=app_logger,
+        )
+        # Only from the main thread, e.g. in a gunicorn worker but not when started by the first request
+        config_watcher.install_signal_handler()
+        config_watcher.start()
+
+
+def configure_from_file(config_file: str = None, config_section: str = None):
+    """Configure the application from duo.conf unless that already happened. Thread-safe.
+
+    The file and section default to the DUO_CONFIG_FILE and DUO_CONFIG_SECTION environment variables.
+    """
+    with _configure_lock:
+        if tenant_registry is not None:
+            return
+        config_file = config_file or os.environ.get("DUO_CONFIG_FILE", cfg_file)
+        settings = duo_config.load(config_file, config_section or os.environ.get("DUO_CONFIG_SECTION", "duo"))
+        configure(settings.section, config_file=config_file)
+
+
+def create_app(config_file: str = None, config_section: str = None) -> Flask:
+    """Application factory for WSGI servers, e.g. ``gunicorn 'app_with_duo:create_app()'``"""
+    configure_from_file(config_file, config_section)
+    return app
+
+
+def _prepare_process(wsgi_app):
+    """Before the first request of every process: configure from duo.conf if a WSGI server imported ``app``
+    directly, and run init_worker() if the server did not call it after forking"""
+
+    def wrapper(environ, start_response):
+        if _worker_pid != os.getpid():
+            with _configure_lock:
+                if tenant_registry is None:
+                    configure_from_file()
+                if _worker_pid != os.getpid():
+                    init_worker()
+        return wsgi_app(environ, start_response)
+
+    return wrapper
+
+
+# Outside of Flask's request handling, configure() still registers extensions with the app
+app.wsgi_app = profiling.profiling_middleware(
+        _prepare_process(duo_tenants.tenant_dispatcher(app.wsgi_app, lambda: tenant_registry)), lambda: profiler)
+
+
 def process_args():
     """Process command line arguments"""
+    import user_io
     parser = argparse.ArgumentParser(
             formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
+    parser.add_argument(
+            "command",
+            help="run: serve the application, import/export: bulk load or dump users",
+            nargs="?",
+            choices=["run", "import", "export"],
+            default="run"
+    )
+
     parser.add_argument(
             "-c",
             "--config",
@@ -226,6 +662,66 @@ def process_args():
             default=False,
 
     )
+
+    parser.add_argument(
+            "--workers",
+            "-w",
+            help="Number of pre-fork worker processes. [Default: server_workers from duo.conf]",
+            type=int,
+            metavar="N"
+    )
+
+    parser.add_argument(
+            "--threads",
+            "-t",
+            help="Number of request threads per worker. [Default: server_threads from duo.conf]",
+            type=int,
+            metavar="N"
+    )
+
+    parser.add_argument(
+            "--profile",
+            help="Trace this fraction (0 to 1) of the requests and log the slow ones. "
+                 "[Default: profile_sample_rate from duo.conf]",
+            type=float,
+            metavar="RATE"
+    )
+
+    parser.add_argument(
+            "--input",
+            "-i",
+            help="import: CSV or JSON Lines file with username and password or password_hash columns ('-' for stdin)",
+            default="-",
+            metavar="FILE"
+    )
+
+    parser.add_argument(
+            "--output",
+            "-o",
+            help="export: file to write the users and password hashes to ('-' for stdout)",
+            default="-",
+            metavar="FILE"
+    )
+
+    parser.add_argument(
+            "--format",
+            help="import/export file format. [Default: from the file extension, csv otherwise]",
+            choices=["csv", "jsonl"]
+    )
+
+    parser.add_argument(
+            "--batch-size",
+            help="import/export: users per transaction or fetch",
+            type=int,
+            default=1000
+    )
+
+    parser.add_argument(
+            "--on-conflict",
+            help="import: what to do with usernames that already exist",
+            choices=user_io.CONFLICT_POLICIES,
+            default="skip"
+    )
     return parser.parse_known_args()[0]
 
 
@@ -233,21 +729,30 @@ if __name__ == '__main__':
     args = process_args()
     cfg_file = args.file if args.file is not None else "instance/duo.conf"
     config_section = args.config
-    config = configparser.ConfigParser()
-    config.read(cfg_file)
-
-    try:
-        duo_client = Client(
-                client_id=config[config_section]['client_id'],
-                client_secret=config[config_section]['client_secret'],
-                host=config[config_section]['api_hostname'],
-                redirect_uri=config[config_section]['redirect_uri'],
-                duo_certs=config[config_section].get('duo_certs'),
-        )
-    except DuoException as e:
-        print("*** Duo config error. Verify the values in duo.conf are correct ***")
-        raise e
-
-    duo_failmode = config[config_section]['failmode']
-
-    app.run(host=config[config_section]['app_host'], port=int(config[config_section]['app_port']), debug=True)
+    config_parser = configparser.ConfigParser()
+    config_parser.read(cfg_file)
+
+    if args.command in ("import", "export"):
+        import user_io
+
+        # Bulk user operations only need the database, not Duo
+        configure_storage(config_parser[config_section])
+        with app.app_context():
+            user_io.run(args, db, Users.__table__, hasher, logger=app_logger)
+        hasher.shutdown()
+        sys.exit(0)
+
+    import wsgi_server
+
+    if args.profile is not None:
+        config_parser[config_section]["profile_sample_rate"] = str(args.profile)
+    configure(config_parser[config_section], config_file=cfg_file)
+    # Build the Duo client before the workers are forked, configuration errors show up right away
+    get_duo_client()
+
+    wsgi_server.serve(app, config_parser[config_section],
+                      workers=args.workers,
+                      threads=args.threads,
+                      debug=args.debug,
+                      post_worker_init=init_worker,
+                      logger=app_logger)
@@ -0,0 +1,149 @@
+"""
+Template precompilation and fingerprinted, pre-compressed static assets with HTTP caching
+"""
+from __future__ import annotations, print_function
+
+import gzip
+import hashlib
+import mimetypes
+import os
+from typing import NamedTuple
+
+from flask import Flask, Response, request
+from jinja2 import FileSystemBytecodeCache
+
+try:
+    import brotli
+except ImportError:  # Optional, assets are served gzip compressed without it
+    brotli = None
+
+# Compressing tiny files does not pay off
+MIN_COMPRESS_SIZE = 256
+
+
+def precompile_templates(app: Flask, cache_dir: str = None) -> int:
+    """Compile every template once at start up, before workers are forked, and return how many.
+
+    With ``cache_dir`` the compiled bytecode is also kept on disk, so restarted processes skip the
+    Jinja parser as well.
+    """
+    env = app.jinja_env
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+
+class Asset(NamedTuple):
+    """A static file with its precomputed encodings (name -> body) and strong ETag"""
+    filename: str
+    mimetype: str
+    etag: str
+    bodies: dict
+
+
+def _fingerprinted(filename: str, digest: str) -> str:
+    root, ext = os.path.splitext(filename)
+    return f"{root}.{digest}{ext}"
+
+
+class StaticAssets:
+    """Serves the static folder from memory.
+
+    ``url_for('static', filename='style.css')`` produces ``style.<hash>.css``, which is served with a
+    long-lived immutable Cache-Control. Every response has an ETag and answers a matching
+    If-None-Match with 304. Bodies are compressed with brotli and gzip once at start up and picked
+    from the Accept-Encoding header.
+
+    Create it at import time, Flask only accepts new hooks before the first request. Files are
+    read by load(), until then the static folder is served as usual.
+    """
+
+    def __init__(self, app: Flask, /, *, max_age: int = 31536000, compress: bool = True):
+        self.app = app
+        self.max_age = max_age
+        self.compress = compress
+        self.assets = {}
+        self.fingerprints = {}
+        self._fallback = app.view_functions["static"]
+        app.view_functions["static"] = self.serve
+        app.url_defaults(self._fingerprint_url)
+
+    def load(self, max_age: int = None, compress: bool = None):
+        """(Re)read and compress every file in the static folder"""
+        if max_age is not None:
+            self.max_age = max_age
+        if compress is not None:
+            self.compress = compress
+        assets, fingerprints = {}, {}
+        folder = self.app.static_folder
+        for directory, _, files in os.walk(folder):
+            for name in files:
+                path = os.path.join(directory, name)
+                filename = os.path.relpath(path, folder).replace(os.sep, "/")
+                with open(path, "rb") as fh:
+                    body = fh.read()
+                digest = hashlib.sha256(body).hexdigest()[:12]
+                bodies = {"identity": body}
+                if self.compress and len(body) >= MIN_COMPRESS_SIZE:
+                    bodies["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+                    if brotli is not None:
+                        bodies["br"] = brotli.compress(body)
+                mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                asset = Asset(filename, mimetype, digest, bodies)
+                assets[filename] = asset
+                fingerprinted = _fingerprinted(filename, digest)
+                assets[fingerprinted] = asset
+                fingerprints[filename] = fingerprinted
+        self.assets, self.fingerprints = assets, fingerprints
+
+    def _fingerprint_url(self, endpoint: str, values: dict):
+        if endpoint == "static" and values.get("filename") in self.fingerprints:
+            values["filename"] = self.fingerprints[values["filename"]]
+
+    def _encoding(self, asset: Asset) -> str:
+        accepted = request.accept_encodings
+        for encoding in ("br", "gzip"):
+            if encoding in asset.bodies and accepted[encoding]:
+                return encoding
+        return "identity"
+
+    def serve(self, filename: str) -> Response:
+        asset = self.assets.get(filename)
+        if asset is None:
+            return self._fallback(filename=filename)
+        encoding = self._encoding(asset)
+        # A strong ETag has to differ between encodings of the same file
+        etag = asset.etag if encoding == "identity" else f"{asset.etag}-{encoding}"
+        response = Response(asset.bodies[encoding], mimetype=asset.mimetype)
+        response.set_etag(etag)
+        response.vary.add("Accept-Encoding")
+        if encoding != "identity":
+            response.content_encoding = encoding
+        if filename == asset.filename:
+            # Unversioned URL, the content may change with the next deployment
+            response.cache_control.public = True
+            response.cache_control.no_cache = True
+        else:
+            response.cache_control.public = True
+            response.cache_control.max_age = self.max_age
+            response.cache_control.immutable = True
+        return response.make_conditional(request)
+
+
+def conditional_pages(app: Flask):
+    """Give HTML pages an ETag so repeat visits of an unchanged page get an empty 304"""
+
+    @app.after_request
+    def add_page_etag(response: Response) -> Response:
+        if (request.method == "GET" and response.status_code == 200 and response.mimetype == "text/html"
+                and not response.direct_passthrough):
+            response.add_etag()
+            # Pages depend on the session, let browsers keep them but always revalidate
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.make_conditional(request)
+        return response
@@ -0,0 +1,342 @@
+"""
+Structured audit events for login and Duo outcomes: an asynchronous writer to append-only JSON Lines
+segments, a time-indexed reader and a command line tool for streaming aggregations
+
+    python audit.py count --since 1h --event fail_open
+    python audit.py count --since 7d --by tenant,event --interval 1h
+    python audit.py events --since 30m --username alice
+"""
+from __future__ import annotations, print_function
+
+import argparse
+import atexit
+import collections
+import datetime
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from typing import Iterable, Iterator, NamedTuple
+
+EVENT_TYPES = frozenset({
+        "register", "logout",
+        # Outcomes of POST /login
+        "duo_redirect", "fail_open", "fail_secure", "invalid_credentials", "unknown_user", "rate_limited",
+        # Outcomes of the Duo callback
+        "success", "invalid_state", "duo_error", "session_error",
+})
+GROUP_FIELDS = ("event", "tenant", "username", "ip")
+
+# audit-<first event ms>-<last event ms or "open">-<pid>.jsonl, the names alone tell which segments a time range needs
+_SEGMENT_NAME = re.compile(r"^audit-(\d+)-(\d+|open)-(\d+)\.jsonl$")
+_STOP = object()
+
+
+class AuditEvent(NamedTuple):
+    ts: float
+    event: str
+    tenant: str | None = None
+    username: str | None = None
+    ip: str | None = None
+    detail: str | None = None
+
+    def to_json(self) -> bytes:
+        return json.dumps({key: value for key, value in self._asdict().items() if value is not None},
+                          separators=(",", ":")).encode() + b"\n"
+
+    @classmethod
+    def from_json(cls, line: bytes) -> AuditEvent:
+        record = json.loads(line)
+        return cls(record["ts"], record["event"], record.get("tenant"), record.get("username"), record.get("ip"),
+                   record.get("detail"))
+
+
+class AuditLog:
+    """Appends audit events to segment files in ``directory`` from a background thread.
+
+    emit() only puts the event on a bounded queue and never blocks; events are dropped (and counted)
+    when the writer falls behind. The writer appends whole batches, fsyncs at most every
+    ``fsync_interval`` seconds and starts a new segment after ``segment_bytes`` or ``segment_seconds``.
+    Each process writes its own segments, start() again after a fork.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 /,
+                 *,
+                 segment_bytes: int = 64 * 1024 * 1024,
+                 segment_seconds: float = 3600.0,
+                 fsync_interval: float = 1.0,
+                 queue_size: int = 10000,
+                 batch_size: int = 1000,
+                 logger: logging.Logger = None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.fsync_interval = fsync_interval
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.counters = {"written": 0, "dropped": 0, "fsyncs": 0, "segments": 0, "errors": 0}
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        # The process the queue belongs to, events emitted before start() are written once it runs
+        self._pid = os.getpid()
+        self._segment = None
+        self._registered = False
+        # emit() runs on request threads, the other counters only change on the writer thread
+        self._dropped_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def emit(self, event: str, /, *, tenant: str = None, username: str = None, ip: str = None, detail: str = None):
+        """Queue an event for writing, returns immediately"""
+        if event not in EVENT_TYPES:
+            raise ValueError(f"Unknown audit event type '{event}'")
+        try:
+            self._queue.put_nowait(AuditEvent(time.time(), event, tenant, username, ip, detail))
+        except queue.Full:
+            with self._dropped_lock:
+                self.counters["dropped"] += 1
+
+    def start(self):
+        """Start the writer thread of this process"""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        if self._pid != os.getpid():
+            # Events queued and the segment opened by the parent process are the parent's to write
+            self._queue = queue.Queue(self.queue_size)
+            self._segment = None
+            self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="duo-audit-writer", daemon=True)
+        self._thread.start()
+        if not self._registered:
+            atexit.register(self.stop)
+            self._registered = True
+
+    def stop(self, timeout: float = 5.0):
+        """Write the queued events, fsync and close the current segment"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        dirty_since = None
+        while True:
+            timeout = None
+            if dirty_since is not None:
+                timeout = max(0.0, dirty_since + self.fsync_interval - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            batch, stop = [], item is _STOP
+            if item is not None and not stop:
+                batch.append(item)
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stop = True
+                        break
+                    batch.append(item)
+            try:
+                if batch:
+                    self._write(batch)
+                    dirty_since = dirty_since or time.monotonic()
+                if stop or (dirty_since is not None and time.monotonic() - dirty_since >= self.fsync_interval):
+                    self._sync()
+                    dirty_since = None
+            except OSError as e:
+                self.counters["errors"] += 1
+                self.logger.error("Unable to write %d audit events: %s", len(batch), e)
+            if stop:
+                self._close_segment()
+                return
+
+    def _write(self, batch: list[AuditEvent]):
+        segment = self._segment
+        if (segment is None or segment["size"] >= self.segment_bytes
+                or batch[0].ts - segment["start"] >= self.segment_seconds):
+            self._close_segment()
+            segment = self._open_segment(batch[0].ts)
+        # Unbuffered, one write per batch. Nothing is left in a buffer that a forked child could write again.
+        data = b"".join(event.to_json() for event in batch)
+        segment["file"].write(data)
+        segment["size"] += len(data)
+        segment["end"] = batch[-1].ts
+        self.counters["written"] += len(batch)
+
+    def _sync(self):
+        if self._segment is not None:
+            os.fsync(self._segment["file"].fileno())
+            self.counters["fsyncs"] += 1
+
+    def _open_segment(self, start: float) -> dict:
+        path = os.path.join(self.directory, f"audit-{int(start * 1000):013d}-open-{os.getpid()}.jsonl")
+        self._segment = {"path": path, "file": open(path, "ab", buffering=0), "start": start, "end": start,
+                         "size": 0}
+        self.counters["segments"] += 1
+        return self._segment
+
+    def _close_segment(self):
+        segment, self._segment = self._segment, None
+        if segment is None:
+            return
+        try:
+            os.fsync(segment["file"].fileno())
+            segment["file"].close()
+            # The end time in the name lets readers skip the segment without opening it
+            os.replace(segment["path"], segment["path"].replace("-open-", f"-{int(segment['end'] * 1000) + 1:013d}-"))
+        except OSError as e:
+            self.counters["errors"] += 1
+            self.logger.error("Unable to close audit segment %s: %s", segment["path"], e)
+
+    def stats(self) -> dict:
+        with self._dropped_lock:
+            return {**self.counters, "queued": self._queue.qsize()}
+
+
+def audit_log_from_config(section, instance_path: str, logger: logging.Logger = None) -> AuditLog | None:
+    """Build the audit log from the ``audit_*`` values of a duo.conf section, None if disabled"""
+    if not section.getboolean('audit_enabled', fallback=True):
+        return None
+    return AuditLog(section.get('audit_dir', fallback=os.path.join(instance_path, "audit")),
+                    segment_bytes=section.getint('audit_segment_mb', fallback=64) * 1024 * 1024,
+                    segment_seconds=section.getfloat('audit_segment_seconds', fallback=3600.0),
+                    fsync_interval=section.getfloat('audit_fsync_interval', fallback=1.0),
+                    queue_size=section.getint('audit_queue_size', fallback=10000),
+                    logger=logger)
+
+
+def segments(directory: str, since: float = None, until: float = None) -> list[str]:
+    """Segment files that may hold events between ``since`` and ``until``, oldest first"""
+    found = []
+    for name in os.listdir(directory):
+        match = _SEGMENT_NAME.match(name)
+        if match is None:
+            continue
+        start = int(match.group(1)) / 1000
+        end = None if match.group(2) == "open" else int(match.group(2)) / 1000
+        if until is not None and start > until:
+            continue
+        if since is not None and end is not None and end < since:
+            continue
+        found.append((start, os.path.join(directory, name)))
+    return [path for _, path in sorted(found)]
+
+
+def read_events(directory: str,
+                /,
+                *,
+                since: float = None,
+                until: float = None,
+                events: Iterable[str] = None,
+                tenant: str = None,
+                username: str = None) -> Iterator[AuditEvent]:
+    """Stream the matching events segment by segment, one line in memory at a time"""
+    events = frozenset(events) if events else None
+    for path in segments(directory, since, until):
+        try:
+            fh = open(path, "rb")
+        except FileNotFoundError:
+            # Renamed by a writer closing the segment, it shows up under its final name next time
+            continue
+        with fh:
+            for line in fh:
+                try:
+                    event = AuditEvent.from_json(line)
+                except (ValueError, KeyError):
+                    # A torn last line after a crash
+                    continue
+                if ((since is not None and event.ts < since) or (until is not None and event.ts >= until)
+                        or (events is not None and event.event not in events)
+                        or (tenant is not None and event.tenant != tenant)
+                        or (username is not None and event.username != username)):
+                    continue
+                yield event
+
+
+def aggregate(events: Iterable[AuditEvent], by: tuple = ("event",), interval: float = None) -> dict:
+    """Count events by the ``by`` fields, and by time bucket of ``interval`` seconds if given"""
+    counts = collections.Counter()
+    for event in events:
+        key = tuple(getattr(event, field) for field in by)
+        if interval:
+            key = (event.ts - event.ts % interval,) + key
+        counts[key] += 1
+    return counts
+
+
+_DURATION = re.compile(r"^(\d+(?:\.\d+)?)([smhd])$")
+_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_duration(value: str) -> float:
+    match = _DURATION.match(value.strip())
+    if match is None:
+        raise argparse.ArgumentTypeError(f"Invalid duration '{value}', use e.g. 30s, 15m, 1h or 7d")
+    return float(match.group(1)) * _UNITS[match.group(2)]
+
+
+def parse_time(value: str) -> float:
+    """A duration before now (1h), a Unix timestamp or an ISO 8601 date and time (local time if no zone)"""
+    if _DURATION.match(value.strip()):
+        return time.time() - parse_duration(value)
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid time '{value}'") from None
+
+
+def _isoformat(ts: float) -> str:
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).isoformat(timespec="seconds")
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description="Query the audit events of app_with_duo.py",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("command", choices=["count", "events"],
+                        help="count: number of events by group, events: the matching events as JSON Lines")
+    parser.add_argument("--dir", "-d", default="instance/audit", help="Audit segment directory")
+    parser.add_argument("--since", "-s", type=parse_time, help="Start time: 1h (ago), a Unix timestamp or ISO 8601")
+    parser.add_argument("--until", "-u", type=parse_time, help="End time (exclusive), same formats as --since")
+    parser.add_argument("--event", "-e", action="append", choices=sorted(EVENT_TYPES),
+                        help="Only these event types, can be repeated")
+    parser.add_argument("--tenant", help="Only events of this tenant")
+    parser.add_argument("--username", help="Only events of this user")
+    parser.add_argument("--by", default="event", help=f"count: comma separated fields of {', '.join(GROUP_FIELDS)}")
+    parser.add_argument("--interval", "-i", type=parse_duration, help="count: also group by time buckets, e.g. 5m")
+    args = parser.parse_args(argv)
+
+    events = read_events(args.dir, since=args.since, until=args.until, events=args.event, tenant=args.tenant,
+                         username=args.username)
+    out = sys.stdout
+    if args.command == "events":
+        for event in events:
+            out.write(event.to_json().decode())
+        return
+    by = tuple(field.strip() for field in args.by.split(",") if field.strip())
+    unknown = set(by) - set(GROUP_FIELDS)
+    if unknown:
+        parser.error(f"--by: unknown fields {', '.join(sorted(unknown))}")
+    for key, count in sorted(aggregate(events, by, args.interval).items(), key=lambda item: str(item[0])):
+        row = dict(zip(by, key[1:] if args.interval else key))
+        if args.interval:
+            row = {"time": _isoformat(key[0]), **row}
+        out.write(json.dumps({**row, "count": count}) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+"""
+Benchmarks for the demo application, run from the project root, e.g. ``python -m benchmarks.transport``
+"""
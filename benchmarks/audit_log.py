@@ -0,0 +1,73 @@
+"""
+Audit log cost on the request path and over long histories: emit() latency, writer throughput,
+bytes per event, and a streaming aggregation over all segments with its peak memory
+
+    python -m benchmarks.audit_log --events 500000
+"""
+from __future__ import annotations, print_function
+
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import audit
+
+OUTCOMES = ("success", "duo_redirect", "invalid_credentials", "unknown_user", "fail_open")
+
+
+def write(directory: str, count: int) -> dict:
+    log = audit.AuditLog(directory, queue_size=count + 1, segment_bytes=8 * 1024 * 1024)
+    log.start()
+    samples = []
+    start = time.perf_counter()
+    for i in range(count):
+        begin = time.perf_counter()
+        log.emit(random.choice(OUTCOMES), tenant=f"tenant{i % 4}", username=f"user{i % 5000}", ip="10.0.0.1")
+        samples.append(time.perf_counter() - begin)
+    emitted = time.perf_counter()
+    log.stop(timeout=None)
+    done = time.perf_counter()
+    samples.sort()
+    size = sum(os.path.getsize(path) for path in audit.segments(directory))
+    return {
+            "emit_us_mean":          round(statistics.fmean(samples) * 1e6, 2),
+            "emit_us_p99":           round(samples[int(len(samples) * 0.99)] * 1e6, 2),
+            "writer_events_per_s":   round(count / (done - start)),
+            "drain_after_emit_s":    round(done - emitted, 3),
+            "bytes_per_event":       round(size / count, 1),
+            "writer_stats":          log.stats(),
+    }
+
+
+def read(directory: str, count: int) -> dict:
+    tracemalloc.start()
+    start = time.perf_counter()
+    counts = audit.aggregate(audit.read_events(directory), ("tenant", "event"), 3600)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+            "events_per_s":    round(sum(counts.values()) / elapsed),
+            "groups":          len(counts),
+            "peak_memory_kb":  round(peak / 1024),
+            "all_read":        sum(counts.values()) == count,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--events", "-n", type=int, default=500000, help="Events to write and aggregate")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        results = {"write": write(directory, args.events), "aggregate": read(directory, args.events),
+                   "segments": len(audit.segments(directory))}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
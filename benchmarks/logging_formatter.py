@@ -0,0 +1,123 @@
+"""
+Records per second through the console and file logging paths, before and after the
+LoggingFormatter rewrite (one pre-built formatter per level instead of one per record), and
+the time a request thread spends per record with direct handlers and in queue mode
+
+    python -m benchmarks.logging_formatter --records 50000
+"""
+from __future__ import annotations, print_function
+
+import argparse
+import json
+import logging
+import os
+import queue
+import tempfile
+import time
+from logging.handlers import RotatingFileHandler
+
+import duo_utils
+
+FILE_FORMAT = ("{asctime} | {levelname:8} | {name:<10} | {filename:<15} | " +
+               "{module:<12} | {funcName:>15}():{lineno:_^4} | {message}")
+
+
+class LegacyLoggingFormatter(duo_utils.LoggingFormatter):
+    """The previous implementation, which rebuilt its format string and Formatter for every record"""
+
+    def __init__(self):
+        super().__init__(use_color=True)
+
+    def format(self, record):
+        log_color = self.COLORS[record.levelno]
+        time_color = '\x1b[1;30;47m'
+        format_str = ("(black){asctime}(reset) | (lvl_color){levelname:8}(reset) | " +
+                      "(green){name} | {filename} | " +
+                      "(green){module}(reset) | (green){funcName}:{lineno:<4}(reset) | {message}")
+        format_str = format_str.replace("(black)", time_color)
+        format_str = format_str.replace("(reset)", self.reset)
+        format_str = format_str.replace("(lvl_color)", log_color)
+        format_str = format_str.replace("(green)", self.green + self.bold)
+        formatter = logging.Formatter(format_str, "%Y-%m-%d %H:%M:%S", style="{")
+        return formatter.format(record)
+
+
+def make_records(count: int) -> list[logging.LogRecord]:
+    levels = [logging.INFO, logging.INFO, logging.INFO, logging.WARNING, logging.ERROR]
+    return [logging.LogRecord("app", levels[i % len(levels)], __file__, 42, "User %s logged in.", (f"user{i}",),
+                              None, func="login") for i in range(count)]
+
+
+def records_per_second(handle, records: list[logging.LogRecord]) -> float:
+    start = time.perf_counter()
+    for record in records:
+        handle(record)
+    return round(len(records) / (time.perf_counter() - start), 1)
+
+
+class SlowHandler(logging.Handler):
+    """A sink that takes ``delay`` seconds per record, like a slow disk or a blocked console"""
+
+    def __init__(self, delay: float):
+        super().__init__()
+        self.delay = delay
+
+    def emit(self, record):
+        self.format(record)
+        time.sleep(self.delay)
+
+
+def caller_latency(records: list[logging.LogRecord], delay: float, use_queue: bool) -> dict:
+    """Microseconds the calling thread spends in handle() per record"""
+    sink = SlowHandler(delay)
+    sink.setFormatter(logging.Formatter(FILE_FORMAT, "%Y-%m-%d %H:%M:%S", style="{"))
+    handler, listener = sink, None
+    if use_queue:
+        log_queue = queue.Queue(maxsize=len(records))
+        handler = duo_utils.BoundedQueueHandler(log_queue, "drop")
+        listener = duo_utils.BatchingQueueListener(log_queue, sink)
+        listener.start()
+    start = time.perf_counter()
+    for record in records:
+        handler.handle(record)
+    per_record = (time.perf_counter() - start) / len(records) * 1e6
+    if listener is not None:
+        listener.stop()
+    return {"us_per_record": round(per_record, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--records", "-n", type=int, default=50000, help="Records per scenario")
+    parser.add_argument("--sink-delay", type=float, default=0.0005, help="Seconds per record of the slow sink")
+    args = parser.parse_args()
+    records = make_records(args.records)
+
+    formatters = {
+            "legacy":       LegacyLoggingFormatter(),
+            "colored":      duo_utils.LoggingFormatter(use_color=True),
+            "plain":        duo_utils.LoggingFormatter(use_color=False),
+            "json":         duo_utils.JSONFormatter(),
+    }
+    results = {"format_only": {}, "console": {}, "file": {}}
+    with open(os.devnull, "w") as devnull, tempfile.TemporaryDirectory() as directory:
+        for name, formatter in formatters.items():
+            results["format_only"][name] = records_per_second(formatter.format, records)
+            console = logging.StreamHandler(devnull)
+            console.setFormatter(formatter)
+            results["console"][name] = records_per_second(console.handle, records)
+        for name, formatter in (("text", logging.Formatter(FILE_FORMAT, "%Y-%m-%d %H:%M:%S", style="{")),
+                                ("json", duo_utils.JSONFormatter())):
+            file_handler = RotatingFileHandler(os.path.join(directory, f"{name}.log"), encoding="utf-8")
+            file_handler.setFormatter(formatter)
+            results["file"][name] = records_per_second(file_handler.handle, records)
+            file_handler.close()
+    slow = records[:2000]
+    latency = {"direct": caller_latency(slow, args.sink_delay, False),
+               "queue":  caller_latency(slow, args.sink_delay, True)}
+    print(json.dumps({"records": args.records, "records_per_second": results,
+                      "slow_sink_caller_latency": latency}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Concurrent login load test comparing the synchronous Flask app with the asyncio (ASGI) edition
+
+Each virtual user posts the login form, follows the redirect to the local mock Duo server and
+completes the /duo-callback exchange. Both editions run in their own process against the same
+mock Duo server, which adds ``--latency`` seconds to every Duo API call.
+
+    python -m benchmarks.login_load --users 200 --concurrency 100 --latency 0.05
+"""
+from __future__ import annotations, print_function
+
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from benchmarks.mock_duo import CERT_FILE, CLIENT_ID, CLIENT_SECRET, MockDuoServer
+from benchmarks.transport import summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = "load-test-password"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def config_section(duo_host: str, port: int, rounds: int) -> configparser.SectionProxy:
+    """duo.conf section pointing at the mock Duo server"""
+    config = configparser.ConfigParser()
+    config["duo"] = {
+            "client_id":       CLIENT_ID,
+            "client_secret":   CLIENT_SECRET,
+            "api_hostname":    duo_host,
+            "redirect_uri":    f"http://127.0.0.1:{port}/duo-callback",
+            "duo_certs":       CERT_FILE,
+            "failmode":        "closed",
+            "app_host":        "127.0.0.1",
+            "app_port":        str(port),
+            "bcrypt_rounds":   str(rounds),
+            "http_pool_size":  "100",
+            # Queue every login instead of shedding load, the test measures throughput
+            "hash_queue_size": "10000",
+            "hash_timeout":    "120",
+            # Every virtual user comes from 127.0.0.1
+            "ratelimit_enabled": "false",
+            # Virtual users log in repeatedly, every state is answered
+            "state_max_per_user": "0",
+    }
+    return config["duo"]
+
+
+def serve(edition: str, duo_host: str, port: int, rounds: int):
+    """Run one edition of the app in this process (used by the load test subprocesses)"""
+    section = config_section(duo_host, port, rounds)
+    if edition == "sync":
+        import app_with_duo
+        app_with_duo.configure(section)
+        # What a server worker runs after forking: health checks of the tenants, sweepers, audit writer
+        app_with_duo.init_worker()
+        app_with_duo.app.run(host="127.0.0.1", port=port, threaded=True, debug=False)
+    else:
+        from hypercorn.asyncio import serve as hypercorn_serve
+        from hypercorn.config import Config
+
+        import app_asgi
+        app_asgi.configure(section)
+        hypercorn_config = Config()
+        hypercorn_config.bind = [f"127.0.0.1:{port}"]
+        hypercorn_config.accesslog = None
+        asyncio.run(hypercorn_serve(app_asgi.app, hypercorn_config))
+
+
+async def wait_for_port(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise TimeoutError(f"Application did not start listening on port {port}")
+
+
+async def login_flow(base_url: str, username: str, duo_verify: ssl.SSLContext) -> None:
+    """Complete one login including the Duo redirect round trip"""
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as browser:
+        response = await browser.post("/login", data={"username": username, "password": PASSWORD})
+        if response.status_code != 302:
+            raise RuntimeError(f"Login for {username} failed with status {response.status_code}")
+        async with httpx.AsyncClient(verify=duo_verify, timeout=60) as duo:
+            prompt = await duo.get(response.headers["location"])
+        callback = await browser.get(prompt.headers["location"])
+        if callback.status_code != 200 or b"preferred_username" not in callback.content:
+            raise RuntimeError(f"Duo callback for {username} failed with status {callback.status_code}")
+
+
+async def run_load(base_url: str, users: list[str], concurrency: int) -> dict:
+    duo_verify = ssl.create_default_context(cafile=CERT_FILE)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(username: str):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await login_flow(base_url, username, duo_verify)
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(username) for username in users))
+    result = summarize(latencies, time.perf_counter() - start)
+    result["errors"] = errors
+    return result
+
+
+async def seed_users(base_url: str, users: list[str]):
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        for username in users:
+            await client.post("/register", data={"username": username, "password": PASSWORD})
+
+
+def bench_edition(edition: str, mock: MockDuoServer, args) -> dict:
+    port = free_port()
+    os.makedirs(os.path.join(ROOT, "logs"), exist_ok=True)
+    with tempfile.TemporaryFile() as log:
+        server = subprocess.Popen([sys.executable, "-m", "benchmarks.login_load", "serve", edition,
+                                   "--duo-host", mock.host, "--port", str(port), "--rounds", str(args.rounds)],
+                                  cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            asyncio.run(wait_for_port(port))
+            # Unique usernames so repeated runs can share the application database
+            users = [f"load-{edition}-{uuid.uuid4().hex[:8]}-{i}" for i in range(args.users)]
+            asyncio.run(seed_users(base_url, users))
+            return asyncio.run(run_load(base_url, users, args.concurrency))
+        finally:
+            server.terminate()
+            server.wait(10)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+    serve_parser = subparsers.add_parser("serve", help="Run a single edition (internal)")
+    serve_parser.add_argument("edition", choices=["sync", "async"])
+    serve_parser.add_argument("--duo-host", required=True)
+    serve_parser.add_argument("--port", type=int, required=True)
+    serve_parser.add_argument("--rounds", type=int, default=4)
+    parser.add_argument("--users", "-u", type=int, default=200, help="Number of logins to perform")
+    parser.add_argument("--concurrency", "-c", type=int, default=50, help="Concurrent logins in flight")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mock Duo latency in seconds")
+    parser.add_argument("--rounds", type=int, default=4, help="bcrypt cost factor for the load test users")
+    parser.add_argument("--edition", choices=["sync", "async", "both"], default="both")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        return serve(args.edition, args.duo_host, args.port, args.rounds)
+
+    editions = ["sync", "async"] if args.edition == "both" else [args.edition]
+    with MockDuoServer(latency=args.latency) as mock:
+        results = {edition: bench_edition(edition, mock, args) for edition in editions}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
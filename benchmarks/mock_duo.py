@@ -0,0 +1,201 @@
+"""
+Local stand-in for the Duo OIDC endpoints used by the duo_universal client
+"""
+from __future__ import annotations, print_function
+
+import argparse
+import json
+import os
+import secrets
+import ssl
+import threading
+import time
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import jwt
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CERT_FILE = os.path.join(HERE, "mock_duo_cert.pem")
+KEY_FILE = os.path.join(HERE, "mock_duo_key.pem")
+
+# Values with the lengths required by duo_universal.client.Client
+CLIENT_ID = "DIMOCKCLIENTID000000"
+CLIENT_SECRET = "mock-client-secret-000000000000000000000"
+
+# Duo client secrets are 40 characters, shorter than PyJWT recommends for HS512
+warnings.filterwarnings("ignore", message="The HMAC key is")
+
+
+class _MockDuoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: MockDuoServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: dict = None, headers: dict = None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_form(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        form = parse_qs(self.rfile.read(length).decode()) if length else {}
+        form.update(parse_qs(urlparse(self.path).query))
+        return {key: values[0] for key, values in form.items()}
+
+    def do_POST(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        path = urlparse(self.path).path
+        form = self._read_form()
+        if path == "/oauth/v1/health_check":
+            self.server.count("health_check")
+            if not self.server.healthy:
+                return self._send(503, {"stat": "FAIL", "message": "Service unavailable"})
+            return self._send(200, {"stat": "OK", "response": {"timestamp": int(time.time())}})
+        if path == "/oauth/v1/token":
+            self.server.count("token")
+            username = self.server.pop_code(form.get("code"))
+            if username is None:
+                return self._send(400, {"error": "invalid_grant", "error_description": "Invalid code"})
+            return self._send(200, {"id_token": self.server.id_token(username), "token_type": "Bearer",
+                                    "expires_in": 3600, "access_token": secrets.token_hex(16)})
+        self._send(404, {"stat": "FAIL", "message": "Not found"})
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/oauth/v1/authorize":
+            self.server.count("authorize")
+            form = self._read_form()
+            claims = self.server.decode_request(form["request"])
+            code = self.server.issue_code(claims["duo_uname"])
+            location = claims["redirect_uri"] + "?" + urlencode({"duo_code": code, "state": claims["state"]})
+            return self._send(302, headers={"Location": location})
+        self._send(404, {"stat": "FAIL", "message": "Not found"})
+
+
+class MockDuoServer(ThreadingHTTPServer):
+    """HTTPS server answering health check, authorize and token requests like Duo does.
+
+    Every authorization code handed out by /authorize (or issue_code()) can be exchanged once
+    at /token for an HS512 id_token signed with the client secret. rotate_secret() switches to a
+    new secret, requests signed with the previous one are still accepted.
+    """
+    daemon_threads = True
+
+    def __init__(self,
+                 port: int = 0,
+                 /,
+                 *,
+                 client_id: str = CLIENT_ID,
+                 client_secret: str = CLIENT_SECRET,
+                 latency: float = 0.0,
+                 keep_alive: bool = True):
+        handler = type("MockDuoHandler", (_MockDuoHandler,),
+                       {"protocol_version": "HTTP/1.1" if keep_alive else "HTTP/1.0"})
+        super().__init__(("127.0.0.1", port), handler)
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.previous_secret = None
+        self.latency = latency
+        self.healthy = True
+        self.counters = {}
+        self._codes = {}
+        self._lock = threading.Lock()
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(CERT_FILE, KEY_FILE)
+        # Handshake in the request thread, not in the accept loop
+        self.socket = context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+        self._thread = None
+
+    @property
+    def host(self) -> str:
+        """Value for the api_hostname setting of a Client talking to this server"""
+        return f"localhost:{self.server_address[1]}"
+
+    @property
+    def token_endpoint(self) -> str:
+        return f"https://{self.host}/oauth/v1/token"
+
+    def count(self, name: str):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def issue_code(self, username: str) -> str:
+        code = secrets.token_urlsafe(24)
+        with self._lock:
+            self._codes[code] = username
+        return code
+
+    def pop_code(self, code: str) -> str | None:
+        with self._lock:
+            return self._codes.pop(code, None)
+
+    def rotate_secret(self, client_secret: str):
+        """Sign id_tokens with a new client secret from now on"""
+        self.previous_secret, self.client_secret = self.client_secret, client_secret
+
+    def decode_request(self, request: str) -> dict:
+        """Claims of an /authorize request JWT, signed with the current or the previous secret"""
+        try:
+            return jwt.decode(request, self.client_secret, algorithms=["HS512"], options={"verify_aud": False})
+        except jwt.InvalidSignatureError:
+            if self.previous_secret is None:
+                raise
+            return jwt.decode(request, self.previous_secret, algorithms=["HS512"], options={"verify_aud": False})
+
+    def id_token(self, username: str) -> str:
+        now = int(time.time())
+        claims = {
+                "iss":                self.token_endpoint,
+                "aud":                self.client_id,
+                "sub":                username,
+                "preferred_username": username,
+                "iat":                now,
+                "exp":                now + 300,
+                "auth_result":        {"result": "allow", "status": "allow", "status_msg": "Login Successful"},
+        }
+        return jwt.encode(claims, self.client_secret, algorithm="HS512")
+
+    def start(self) -> MockDuoServer:
+        self._thread = threading.Thread(target=self.serve_forever, name="mock-duo", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> MockDuoServer:
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--port", "-p", type=int, default=8443)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every Duo API call")
+    args = parser.parse_args()
+    with MockDuoServer(args.port, latency=args.latency) as mock:
+        print(f"Mock Duo listening on https://{mock.host} (CA cert: {CERT_FILE})", flush=True)
+        print(f"client_id = {mock.client_id}\nclient_secret = {mock.client_secret}", flush=True)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
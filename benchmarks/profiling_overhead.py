@@ -0,0 +1,68 @@
+"""
+Cost of the profiling hooks: a span() outside and inside a traced request, and a WSGI request with
+five spans through the profiling middleware with profiling off, sampling 1% and tracing every request
+
+    python -m benchmarks.profiling_overhead --requests 100000
+"""
+from __future__ import annotations, print_function
+
+import argparse
+import json
+import math
+import time
+
+import profiling
+
+
+def app(environ, start_response):
+    """Roughly the hooks of a login: a query, bcrypt, a Duo request, logging and a template"""
+    for name in ("db SELECT", "bcrypt check", "duo http", "logging", "render"):
+        with profiling.span(name):
+            pass
+    start_response("200 OK", [])
+    return [b""]
+
+
+def per_call_ns(fn, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return round((time.perf_counter() - start) / count * 1e9, 1)
+
+
+def span_cost(count: int) -> dict:
+    def enter_exit():
+        with profiling.span("x"):
+            pass
+
+    results = {"untraced_ns": per_call_ns(enter_exit, count)}
+    trace = profiling.Trace({})
+    token = profiling._current.set(trace)
+    try:
+        # The trace keeps every span, measure fewer of them
+        results["traced_ns"] = per_call_ns(enter_exit, min(count, 100000))
+    finally:
+        profiling._current.reset(token)
+    return results
+
+
+def request_cost(count: int) -> dict:
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/login"}
+    results = {"bare_app_us": round(per_call_ns(lambda: app(environ, lambda *args: None), count) / 1000, 3)}
+    for name, profiler in (("profiling_off_us", None),
+                           ("sample_1_percent_us", profiling.Profiler(0.01, slow_threshold=math.inf)),
+                           ("sample_all_us", profiling.Profiler(1.0, slow_threshold=math.inf))):
+        wrapped = profiling.profiling_middleware(app, lambda: profiler)
+        results[name] = round(per_call_ns(lambda: wrapped(environ, lambda *args: None), count) / 1000, 3)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--requests", "-n", type=int, default=100000, help="Requests and spans to time")
+    args = parser.parse_args()
+    print(json.dumps({"span": span_cost(args.requests), "request": request_cost(args.requests)}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
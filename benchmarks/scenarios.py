@@ -0,0 +1,310 @@
+"""
+Scripted load scenarios for app_with_duo against the local mock Duo server
+
+The application runs in this process (requests go through the Flask test client, so no HTTP
+server is involved) and the mock Duo server in a subprocess, so the CPU time reported per
+request covers the application and its password hashing workers only.
+
+Scenarios:
+
+- ``login_storm``: concurrent password logins up to the redirect to Duo
+- ``callback_storm``: concurrent /duo-callback requests for logins prepared beforehand
+- ``registration_burst``: concurrent registrations of new users
+- ``mixed``: complete logins, failed logins, registrations and page views
+
+    python -m benchmarks.scenarios --users 2000 --requests 500 --concurrency 16 -o after.json
+    python -m benchmarks.scenarios --baseline after.json
+"""
+from __future__ import annotations, print_function
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from benchmarks import seed
+from benchmarks.login_load import config_section, free_port
+from benchmarks.mock_duo import CERT_FILE
+from benchmarks.transport import summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("login_storm", "callback_storm", "registration_burst", "mixed")
+# Share of each operation in the mixed scenario
+MIXED_WEIGHTS = {"login_flow": 0.6, "failed_login": 0.2, "register": 0.1, "home": 0.1}
+# Values compared against a baseline run
+COMPARED = ("throughput_rps", "p50_ms", "p95_ms", "p99_ms", "cpu_ms_per_request")
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def _proc_cpu_seconds(pid: int) -> float:
+    """User + system CPU time of another process, 0.0 where /proc is not available"""
+    try:
+        with open(f"/proc/{pid}/stat") as fh:
+            fields = fh.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+def cpu_seconds() -> dict:
+    """CPU time of this process and of each child process (the password hashing workers)"""
+    return {"self": time.process_time(),
+            **{child.pid: _proc_cpu_seconds(child.pid) for child in multiprocessing.active_children()}}
+
+
+def cpu_used(before: dict, after: dict) -> float:
+    return sum(value - before.get(key, 0.0) for key, value in after.items())
+
+
+def start_mock_duo(latency: float) -> tuple[subprocess.Popen, str]:
+    port = free_port()
+    process = subprocess.Popen([sys.executable, "-m", "benchmarks.mock_duo", "--port", str(port),
+                                "--latency", str(latency)], cwd=ROOT, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, f"localhost:{port}"
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise BenchmarkError("Mock Duo server did not start")
+
+
+class Harness:
+    """The configured application, its seeded users and helpers for one step of the login flow"""
+
+    def __init__(self, app_module, users: list[str]):
+        self.module = app_module
+        self.app = app_module.app
+        self.users = users
+        self._duo = threading.local()
+
+    def _duo_session(self) -> requests.Session:
+        if getattr(self._duo, "session", None) is None:
+            self._duo.session = requests.Session()
+        return self._duo.session
+
+    def login(self, client, username: str, password: str = seed.DEFAULT_PASSWORD) -> str:
+        """POST /login, return the Duo prompt URL"""
+        response = client.post("/login", data={"username": username, "password": password})
+        if response.status_code != 302:
+            raise BenchmarkError(f"Login for {username} answered {response.status_code}")
+        return response.location
+
+    def authorize(self, prompt_uri: str) -> dict:
+        """What the browser does at Duo: follow the prompt and return the callback parameters"""
+        location = self._duo_session().get(prompt_uri, allow_redirects=False,
+                                                  verify=CERT_FILE).headers["Location"]
+        query = parse_qs(urlparse(location).query)
+        return {"state": query["state"][0], "duo_code": query["duo_code"][0]}
+
+    def callback(self, client, params: dict):
+        response = client.get("/duo-callback", query_string=params)
+        if response.status_code != 200 or b"preferred_username" not in response.data:
+            raise BenchmarkError(f"Duo callback answered {response.status_code}")
+
+    def register(self, client, username: str):
+        response = client.post("/register", data={"username": username, "password": seed.DEFAULT_PASSWORD})
+        if response.status_code != 302:
+            raise BenchmarkError(f"Registration of {username} answered {response.status_code}")
+
+
+def run_tasks(tasks: list, concurrency: int) -> dict:
+    """Run tasks on ``concurrency`` threads. A task returns a list of (operation, seconds) pairs."""
+    latencies = {}
+    errors = 0
+    lock = threading.Lock()
+
+    def run(task):
+        nonlocal errors
+        try:
+            timings = task()
+        except Exception:
+            with lock:
+                errors += 1
+            return
+        with lock:
+            for operation, seconds in timings:
+                latencies.setdefault(operation, []).append(seconds)
+
+    cpu_before = cpu_seconds()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(run, tasks))
+    elapsed = time.perf_counter() - start
+    cpu = cpu_used(cpu_before, cpu_seconds())
+
+    all_latencies = [seconds for values in latencies.values() for seconds in values]
+    result = summarize(all_latencies, elapsed)
+    result["errors"] = errors
+    result["cpu_ms_per_request"] = round(cpu / len(all_latencies) * 1000, 3) if all_latencies else 0.0
+    if len(latencies) > 1:
+        result["operations"] = {operation: summarize(values, elapsed) for operation, values in sorted(latencies.items())}
+    return result
+
+
+def timed(operation: str, call, *args) -> tuple[str, float]:
+    start = time.perf_counter()
+    call(*args)
+    return operation, time.perf_counter() - start
+
+
+def login_storm(harness: Harness, count: int, concurrency: int) -> dict:
+    def task():
+        client = harness.app.test_client()
+        return [timed("login", harness.login, client, random.choice(harness.users))]
+    return run_tasks([task] * count, concurrency)
+
+
+def callback_storm(harness: Harness, count: int, concurrency: int) -> dict:
+    # Logins and Duo prompts are prepared up front, only the callbacks are measured
+    client = harness.app.test_client()
+    pending = [harness.authorize(harness.login(client, random.choice(harness.users))) for _ in range(count)]
+
+    def task(params):
+        return lambda: [timed("callback", harness.callback, harness.app.test_client(), params)]
+    return run_tasks([task(params) for params in pending], concurrency)
+
+
+def registration_burst(harness: Harness, count: int, concurrency: int) -> dict:
+    def task():
+        return [timed("register", harness.register, harness.app.test_client(), f"burst-{uuid.uuid4().hex}")]
+    return run_tasks([task] * count, concurrency)
+
+
+def mixed(harness: Harness, count: int, concurrency: int) -> dict:
+    def login_flow():
+        client = harness.app.test_client()
+        timings = []
+        start = time.perf_counter()
+        prompt_uri = harness.login(client, random.choice(harness.users))
+        timings.append(("login", time.perf_counter() - start))
+        params = harness.authorize(prompt_uri)
+        timings.append(timed("callback", harness.callback, client, params))
+        return timings
+
+    def failed_login():
+        form = {"username": random.choice(harness.users), "password": "wrong"}
+        return [timed("failed_login", lambda: harness.app.test_client().post("/login", data=form))]
+
+    def register():
+        return [timed("register", harness.register, harness.app.test_client(), f"mixed-{uuid.uuid4().hex}")]
+
+    def home():
+        return [timed("home", harness.app.test_client().get, "/")]
+
+    operations = {"login_flow": login_flow, "failed_login": failed_login, "register": register, "home": home}
+    tasks = random.choices(list(operations.values()), weights=[MIXED_WEIGHTS[name] for name in operations], k=count)
+    return run_tasks(tasks, concurrency)
+
+
+def compare(results: dict, baseline: dict) -> dict:
+    """Relative change of the headline numbers against a previous run, in percent"""
+    changes = {}
+    for name, result in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        changes[name] = {key: round((result[key] - previous[key]) / previous[key] * 100, 1)
+                         for key in COMPARED if previous.get(key)}
+    return changes
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--scenario", "-s", choices=SCENARIOS, action="append",
+                        help="Scenario to run, can be repeated [Default: all]")
+    parser.add_argument("--users", "-u", type=int, default=2000, help="Seeded users")
+    parser.add_argument("--requests", "-n", type=int, default=500, help="Requests (or flows) per scenario")
+    parser.add_argument("--concurrency", "-c", type=int, default=16, help="Concurrent requests")
+    parser.add_argument("--latency", type=float, default=0.02, help="Mock Duo latency in seconds")
+    parser.add_argument("--rounds", type=int, default=4, help="bcrypt cost factor")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for user choice and the mixed workload")
+    parser.add_argument("--log-level", default="WARNING", help="Application log level during the run")
+    parser.add_argument("--output", "-o", help="Also write the results to this file")
+    parser.add_argument("--baseline", "-b", help="Results of an earlier run to compare with")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    mock, duo_host = start_mock_duo(args.latency)
+    workdir = tempfile.mkdtemp(prefix="duo-bench-")
+    try:
+        section = config_section(duo_host, free_port(), args.rounds)
+        section["db_uri"] = f"sqlite:///{os.path.join(workdir, 'bench.sqlite')}"
+        section["state_store"] = "sqlite"
+        section["state_store_path"] = os.path.join(workdir, "state.sqlite")
+        section["metrics_log_interval"] = "0"
+
+        # The application logs to ./logs
+        os.chdir(workdir)
+        import app_with_duo
+        app_with_duo.app_logger.setLevel(args.log_level)
+        app_with_duo.configure(section)
+        app_with_duo.init_worker()
+        with app_with_duo.app.app_context():
+            users = seed.seed_users(app_with_duo.db, app_with_duo.Users.__table__, args.users, app_with_duo.hasher)
+        harness = Harness(app_with_duo, users)
+
+        scenarios = {"login_storm": login_storm, "callback_storm": callback_storm,
+                     "registration_burst": registration_burst, "mixed": mixed}
+        results = {
+                "meta":      {
+                        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+                        "revision":  git_revision(),
+                        "python":    platform.python_version(),
+                        "platform":  platform.platform(),
+                        "cpus":      os.cpu_count(),
+                        "params":    {key: value for key, value in vars(args).items()
+                                      if key not in ("output", "baseline")},
+                },
+                "scenarios": {},
+        }
+        for name in args.scenario or SCENARIOS:
+            print(f"Running {name}", file=sys.stderr)
+            results["scenarios"][name] = scenarios[name](harness, args.requests, args.concurrency)
+        app_with_duo.hasher.shutdown()
+    finally:
+        mock.terminate()
+        mock.wait(10)
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            results["change_percent"] = compare(results, json.load(fh))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(output + "\n")
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Synthetic users for the Users table of app_with_duo
+
+All seeded users share one password and therefore one bcrypt hash, so seeding a large table
+only costs a single hash. Usernames are ``<prefix><n>`` with n counting from zero.
+
+    python -m benchmarks.seed --users 10000 --rounds 4
+"""
+from __future__ import annotations, print_function
+
+import argparse
+import configparser
+import json
+
+import password_hasher
+import user_io
+
+DEFAULT_PASSWORD = "bench-password"
+DEFAULT_PREFIX = "bench-user-"
+
+
+def usernames(count: int, prefix: str = DEFAULT_PREFIX) -> list[str]:
+    return [f"{prefix}{n}" for n in range(count)]
+
+
+def seed_users(db,
+               table,
+               count: int,
+               hasher: password_hasher.PasswordHasher,
+               /,
+               *,
+               password: str = DEFAULT_PASSWORD,
+               prefix: str = DEFAULT_PREFIX,
+               batch_size: int = 5000) -> list[str]:
+    """Insert ``count`` users (existing ones are kept) and return their usernames"""
+    names = usernames(count, prefix)
+    password_hash = hasher.hash(password)
+    records = ({"username": username, "password": None, "password_hash": password_hash} for username in names)
+    user_io.import_users(db, table, records, hasher, batch_size=batch_size, on_conflict="skip")
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--users", "-n", type=int, default=10000, help="Number of users")
+    parser.add_argument("--rounds", type=int, default=None, help="bcrypt cost factor [Default: bcrypt_rounds]")
+    parser.add_argument("--password", default=DEFAULT_PASSWORD)
+    parser.add_argument("--prefix", default=DEFAULT_PREFIX)
+    parser.add_argument("--file", "-f", default="instance/duo.conf", help="Configuration file with the database")
+    parser.add_argument("--config", "-c", default="duo", help="Config section")
+    args = parser.parse_args()
+
+    import app_with_duo
+
+    config = configparser.ConfigParser()
+    config.read(args.file)
+    section = config[args.config]
+    if args.rounds is not None:
+        section["bcrypt_rounds"] = str(args.rounds)
+    app_with_duo.configure_storage(section)
+    with app_with_duo.app.app_context():
+        names = seed_users(app_with_duo.db, app_with_duo.Users.__table__, args.users, app_with_duo.hasher,
+                           password=args.password, prefix=args.prefix)
+    app_with_duo.hasher.shutdown()
+    print(json.dumps({"users": len(names), "first": names[0] if names else None, "last": names[-1] if names else None}))
+
+
+if __name__ == '__main__':
+    main()
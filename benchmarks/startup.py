@@ -0,0 +1,89 @@
+"""
+Cold start cost of app_with_duo: module import time, create_app() and the first request
+
+Every run is a fresh interpreter. The schema marker makes every run after the first skip
+create_all(), the first run's numbers are reported separately.
+
+    python -m benchmarks.startup --runs 10
+"""
+from __future__ import annotations, print_function
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.login_load import config_section, free_port
+from benchmarks.mock_duo import MockDuoServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import app_with_duo
+imported = time.perf_counter()
+app = app_with_duo.create_app(sys.argv[1])
+created = time.perf_counter()
+response = app.test_client().get("/login")
+assert response.status_code == 200, response.status_code
+done = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "create_app_ms": (created - imported) * 1000,
+                  "first_request_ms": (done - created) * 1000, "total_ms": (done - start) * 1000,
+                  "duo_universal_imported": "duo_universal" in sys.modules}))
+"""
+
+
+def run_child(config_file: str, workdir: str) -> dict:
+    output = subprocess.run([sys.executable, "-c", CHILD, config_file], cwd=workdir, check=True,
+                            capture_output=True, text=True, env=dict(os.environ, PYTHONPATH=ROOT)).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def import_profile(workdir: str, top: int) -> list[dict]:
+    """Modules imported by app_with_duo with the highest cumulative import time (python -X importtime)"""
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app_with_duo"], cwd=workdir,
+                            capture_output=True, text=True, env=dict(os.environ, PYTHONPATH=ROOT)).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Two spaces of indentation are the direct imports of app_with_duo
+        if name.startswith("   ") and not name.startswith("    "):
+            modules.append({"module": name.strip(), "cumulative_ms": int(cumulative) / 1000})
+    return sorted(modules, key=lambda module: module["cumulative_ms"], reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--runs", "-n", type=int, default=10, help="Fresh interpreters to start")
+    parser.add_argument("--top", type=int, default=10, help="Slowest direct imports to list")
+    args = parser.parse_args()
+
+    with MockDuoServer() as mock, tempfile.TemporaryDirectory() as workdir:
+        section = config_section(mock.host, free_port(), 4)
+        section["db_uri"] = f"sqlite:///{os.path.join(workdir, 'startup.sqlite')}"
+        section["state_store"] = "memory"
+        config_file = os.path.join(workdir, "duo.conf")
+        with open(config_file, "w") as fh:
+            section.parser.write(fh)
+
+        runs = [run_child(config_file, workdir) for _ in range(args.runs)]
+        first, warm = runs[0], runs[1:] or runs
+        results = {
+                "runs":         args.runs,
+                "first_run":    {key: round(value, 1) if isinstance(value, float) else value
+                                 for key, value in first.items()},
+                "median":       {key: round(statistics.median(run[key] for run in warm), 1)
+                                 for key in ("import_ms", "create_app_ms", "first_request_ms", "total_ms")},
+                "slow_imports": import_profile(workdir, args.top),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
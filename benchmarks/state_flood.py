@@ -0,0 +1,68 @@
+"""
+Abandoned-login flood against the Duo state stores: pending states, memory or database size and
+put() latency with and without state_max_pending / state_max_per_user
+
+    python -m benchmarks.state_flood --logins 200000
+"""
+from __future__ import annotations, print_function
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+import state_store
+
+
+def flood(store: state_store.StateStore, logins: int, users: int) -> dict:
+    """Logins whose Duo prompt is never answered, every tenth one from the same user"""
+    start = time.perf_counter()
+    for i in range(logins):
+        username = "victim" if i % 10 == 0 else f"user{i % users}"
+        store.put(uuid.uuid4().hex, {"username": username, "user_id": i, "tenant": "duo"}, user=username)
+    elapsed = time.perf_counter() - start
+    return {"put_us": round(elapsed / logins * 1e6, 2), **store.stats()}
+
+
+def memory_store(logins: int, users: int, **limits) -> dict:
+    results = flood(state_store.MemoryStateStore(**limits), logins, users)
+    # Again with tracemalloc, it slows down put() too much to time it at the same time
+    tracemalloc.start()
+    store = state_store.MemoryStateStore(**limits)
+    flood(store, logins, users)
+    results["memory_kb"] = round(tracemalloc.get_traced_memory()[0] / 1024)
+    tracemalloc.stop()
+    return results
+
+
+def sqlite_store(logins: int, users: int, directory: str, **limits) -> dict:
+    path = os.path.join(directory, f"state-{uuid.uuid4().hex}.sqlite")
+    results = flood(state_store.SQLiteStateStore(path, **limits), logins, users)
+    results["database_kb"] = round(sum(os.path.getsize(path + suffix) for suffix in ("", "-wal")
+                                       if os.path.exists(path + suffix)) / 1024)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--logins", "-n", type=int, default=200000, help="Abandoned logins")
+    parser.add_argument("--users", type=int, default=50000, help="Distinct usernames")
+    parser.add_argument("--max-pending", type=int, default=10000)
+    parser.add_argument("--max-per-user", type=int, default=3)
+    args = parser.parse_args()
+    limits = {"max_pending": args.max_pending, "max_per_user": args.max_per_user}
+    with tempfile.TemporaryDirectory() as directory:
+        results = {
+                "memory_unbounded": memory_store(args.logins, args.users),
+                "memory_bounded":   memory_store(args.logins, args.users, **limits),
+                "sqlite_unbounded": sqlite_store(args.logins, args.users, directory),
+                "sqlite_bounded":   sqlite_store(args.logins, args.users, directory, **limits),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Concurrent registrations and logins against SQLite, with default and tuned storage settings
+
+Registration threads insert users one commit at a time while login threads look users up by
+name, the same statements app_with_duo.register() and login() run.
+
+    python -m benchmarks.storage --threads 8 --seconds 5 --write-ratio 0.2
+"""
+from __future__ import annotations, print_function
+
+import argparse
+import configparser
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+
+import sqlalchemy as sa
+from sqlalchemy.exc import OperationalError
+
+import storage
+from benchmarks.transport import summarize
+
+metadata = sa.MetaData()
+users = sa.Table(
+        "users",
+        metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("username", sa.String(250), unique=True, nullable=False),
+        sa.Column("password", sa.String(250), nullable=False),
+)
+# A bcrypt hash of realistic size, hashing itself is not part of this benchmark
+PASSWORD_HASH = "$2b$12$" + "x" * 53
+
+
+def build_engines(path: str, settings: dict) -> tuple[sa.Engine, storage.ReadReplicas]:
+    config = configparser.ConfigParser()
+    config["db"] = {"db_uri": f"sqlite:///{path}", **settings}
+    section = config["db"]
+    if settings:
+        engine = sa.create_engine(section["db_uri"], **storage.engine_options(section))
+        storage.install_pragmas(engine, storage.sqlite_pragmas(section))
+    else:
+        # SQLAlchemy defaults: rollback journal, no busy timeout tuning
+        engine = sa.create_engine(section["db_uri"])
+    return engine, storage.read_replicas_from_config(section)
+
+
+def run_mix(engine: sa.Engine, replicas: storage.ReadReplicas, threads: int, seconds: float,
+            write_ratio: float, seed_users: list[str]) -> dict:
+    latencies = {"register": [], "login": []}
+    errors = {"register": 0, "login": 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        local = {"register": [], "login": []}
+        local_errors = {"register": 0, "login": 0}
+        while time.perf_counter() < deadline:
+            operation = "register" if random.random() < write_ratio else "login"
+            start = time.perf_counter()
+            try:
+                if operation == "register":
+                    with engine.begin() as conn:
+                        conn.execute(sa.insert(users).values(username=uuid.uuid4().hex, password=PASSWORD_HASH))
+                else:
+                    statement = sa.select(users).where(users.c.username == random.choice(seed_users))
+                    if replicas:
+                        with replicas.session() as session:
+                            session.execute(statement).one()
+                    else:
+                        with engine.connect() as conn:
+                            conn.execute(statement).one()
+                local[operation].append(time.perf_counter() - start)
+            except OperationalError:
+                # "database is locked"
+                local_errors[operation] += 1
+        with lock:
+            for operation in latencies:
+                latencies[operation].extend(local[operation])
+                errors[operation] += local_errors[operation]
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {operation: dict(summarize(latencies[operation], elapsed), errors=errors[operation])
+            for operation in latencies}
+
+
+def bench(settings: dict, args) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.sqlite")
+        if settings.get("db_read_replicas") == "self":
+            settings = dict(settings, db_read_replicas=f"sqlite:///{path}")
+        engine, replicas = build_engines(path, settings)
+        metadata.create_all(engine)
+        seed_users = [f"user{i}" for i in range(args.users)]
+        with engine.begin() as conn:
+            conn.execute(sa.insert(users), [{"username": username, "password": PASSWORD_HASH} for username in seed_users])
+        result = run_mix(engine, replicas, args.threads, args.seconds, args.write_ratio, seed_users)
+        engine.dispose()
+        for replica in replicas.engines:
+            replica.dispose()
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--threads", "-t", type=int, default=8, help="Concurrent client threads")
+    parser.add_argument("--seconds", "-s", type=float, default=5.0, help="Duration of each scenario")
+    parser.add_argument("--write-ratio", type=float, default=0.2, help="Fraction of registrations")
+    parser.add_argument("--users", type=int, default=10000, help="Users in the table before the run")
+    args = parser.parse_args()
+
+    tuned = {"db_journal_mode": "wal", "db_synchronous": "normal", "db_pool_size": str(args.threads)}
+    results = {
+            "default":           bench({}, args),
+            "tuned":             bench(tuned, args),
+            "tuned_with_reader": bench(dict(tuned, db_read_replicas="self"), args),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
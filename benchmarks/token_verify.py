@@ -0,0 +1,93 @@
+"""
+Duo id_token verification: jwt.decode() against duo_tokens.TokenVerifier, and a client secret
+rotation against the local mock Duo server
+
+    python -m benchmarks.token_verify --tokens 20000
+"""
+from __future__ import annotations, print_function
+
+import argparse
+import json
+import time
+import warnings
+
+import jwt
+from duo_universal import client as duo_client_module
+
+import duo_tokens
+import duo_transport
+from benchmarks.mock_duo import CERT_FILE, MockDuoServer
+
+ROTATED_SECRET = "mock-client-secret-rotated-0000000000000"
+
+
+def pyjwt_decode(token: str, secret: str, audience: str, issuer: str) -> dict:
+    """What duo_universal does for every token exchange"""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return jwt.decode(token, secret, audience=audience, issuer=issuer, leeway=duo_client_module.LEEWAY,
+                          algorithms=["HS512"], options={'require': ['exp', 'iat'], 'verify_iat': True})
+
+
+def decode_speed(mock: MockDuoServer, count: int) -> dict:
+    tokens = [mock.id_token(f"user{i}") for i in range(count)]
+    verifier = duo_tokens.TokenVerifier(mock.client_secret)
+    verifier.warm()
+    results = {}
+    for name, decode in (("pyjwt", lambda token: pyjwt_decode(token, mock.client_secret, mock.client_id,
+                                                                 mock.token_endpoint)),
+                         ("token_verifier", lambda token: verifier.decode(token, audience=mock.client_id,
+                                                                          issuer=mock.token_endpoint,
+                                                                          leeway=duo_client_module.LEEWAY))):
+        start = time.perf_counter()
+        for token in tokens:
+            decode(token)
+        elapsed = time.perf_counter() - start
+        results[name] = {"us_per_token": round(elapsed / count * 1e6, 2), "tokens_per_s": round(count / elapsed)}
+    results["speedup"] = round(results["pyjwt"]["us_per_token"] / results["token_verifier"]["us_per_token"], 2)
+    results["verifier_stats"] = verifier.stats()
+    return results
+
+
+def exchange(client: duo_transport.PooledClient, mock: MockDuoServer, username: str) -> bool:
+    try:
+        client.exchange_authorization_code_for_2fa_result(mock.issue_code(username), username)
+        return True
+    except duo_client_module.DuoException:
+        return False
+
+
+def rotation(mock: MockDuoServer, previous_key_ttl: float) -> dict:
+    """The new secret reaches the application before Duo (the mock) signs with it"""
+
+    def client(secret: str) -> duo_transport.PooledClient:
+        return duo_transport.PooledClient(mock.client_id, secret, mock.host, "http://localhost/duo-callback",
+                                          duo_certs=CERT_FILE,
+                                          verifier=duo_tokens.TokenVerifier(secret, previous_key_ttl=previous_key_ttl))
+
+    old = client(mock.client_secret)
+    steps = {"before_rotation": exchange(old, mock, "alice")}
+    new = client(ROTATED_SECRET)
+    new.verifier.accept_previous(old.verifier)
+    steps["old_signature_within_grace"] = exchange(new, mock, "alice")
+    mock.rotate_secret(ROTATED_SECRET)
+    steps["new_signature"] = exchange(new, mock, "alice")
+    # Tokens signed with the old secret once more, after the grace period
+    mock.rotate_secret(mock.previous_secret)
+    time.sleep(previous_key_ttl)
+    steps["old_signature_after_grace_rejected"] = not exchange(new, mock, "alice")
+    return {"steps": steps, "passed": all(steps.values()), "verifier_stats": new.verifier.stats()}
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--tokens", "-n", type=int, default=20000, help="Tokens to verify")
+    parser.add_argument("--grace", type=float, default=0.5, help="Seconds the previous secret stays valid")
+    args = parser.parse_args()
+    with MockDuoServer() as mock:
+        results = {"decode": decode_speed(mock, args.tokens), "rotation": rotation(mock, args.grace)}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Compare Duo request latency with and without connection pooling against the local mock Duo server
+
+    python -m benchmarks.transport --requests 500 --threads 4
+"""
+from __future__ import annotations, print_function
+
+import argparse
+import json
+import statistics
+import threading
+import time
+
+from duo_universal.client import Client
+
+import duo_transport
+from benchmarks.mock_duo import CERT_FILE, MockDuoServer
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of samples"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies: list[float], elapsed: float) -> dict:
+    return {
+            "requests":       len(latencies),
+            "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            "mean_ms":        round(statistics.fmean(latencies) * 1000, 3) if latencies else 0.0,
+            "p50_ms":         round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms":         round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms":         round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def run_calls(call, total: int, threads: int) -> tuple[list[float], float]:
+    """Run ``call`` ``total`` times spread across ``threads`` threads and return per-call latencies"""
+    latencies = []
+    lock = threading.Lock()
+    per_thread = [total // threads + (1 if i < total % threads else 0) for i in range(threads)]
+
+    def worker(count: int):
+        local = []
+        for _ in range(count):
+            start = time.perf_counter()
+            call()
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=worker, args=(count,)) for count in per_thread]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return latencies, time.perf_counter() - start
+
+
+def bench_client(mock: MockDuoServer, client: Client, total: int, threads: int) -> dict:
+    # Warm up so that the pooled client starts with open connections
+    for _ in range(threads):
+        client.health_check()
+    health_latencies, health_elapsed = run_calls(client.health_check, total, threads)
+
+    def exchange():
+        code = mock.issue_code("bench-user")
+        client.exchange_authorization_code_for_2fa_result(code, "bench-user")
+
+    exchange_latencies, exchange_elapsed = run_calls(exchange, total, threads)
+    result = {
+            "health_check": summarize(health_latencies, health_elapsed),
+            "token_exchange": summarize(exchange_latencies, exchange_elapsed),
+    }
+    transport = getattr(client, "transport", None)
+    if transport is not None:
+        result["transport"] = transport.stats.as_dict()
+        transport.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--requests", "-n", type=int, default=300, help="Requests per scenario")
+    parser.add_argument("--threads", "-t", type=int, default=4, help="Concurrent client threads")
+    parser.add_argument("--latency", type=float, default=0.0, help="Artificial server latency in seconds")
+    args = parser.parse_args()
+
+    with MockDuoServer(latency=args.latency) as mock:
+        client_args = dict(client_id=mock.client_id, client_secret=mock.client_secret, host=mock.host,
+                           redirect_uri="http://localhost:8008/duo-callback", duo_certs=CERT_FILE)
+        results = {
+                "unpooled": bench_client(mock, Client(**client_args), args.requests, args.threads),
+                "pooled":   bench_client(mock,
+                                         duo_transport.PooledClient(
+                                                 **client_args,
+                                                 transport=duo_transport.PooledTransport(args.threads)),
+                                         args.requests, args.threads),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
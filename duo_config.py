@@ -0,0 +1,307 @@
+"""
+Validated, immutable duo.conf snapshots and a watcher that reloads them on change or SIGHUP
+"""
+from __future__ import annotations, print_function
+
+import configparser
+import ipaddress
+import logging
+import os
+import signal
+import threading
+import time
+from types import MappingProxyType
+from typing import Callable, Mapping, NamedTuple
+
+# 'secure' is accepted as another name for 'closed'
+FAILMODES = {"open": "open", "closed": "closed", "secure": "closed"}
+
+# Values the Duo client is built from: its settings, HTTP transport and id_token verification
+CLIENT_KEYS = frozenset({"client_id", "client_secret", "api_hostname", "redirect_uri", "duo_certs"})
+CLIENT_PREFIXES = ("http_", "jwt_")
+# Applied by a reload without a restart: the client, the failmode and the tenants
+RELOADABLE_KEYS = CLIENT_KEYS | {"failmode", "tenants"}
+RELOADABLE_PREFIXES = CLIENT_PREFIXES + ("tenant_",)
+# Not inherited by the tenant sections from the main section
+_NOT_INHERITED = ("tenants", "tenant_hosts", "tenant_path", "tenant_max_clients", "tenant_idle_timeout")
+
+# Typed values checked at load time, so a typo fails the (re)load instead of a later request
+_TYPED_KEYS = {
+        "getint":     ("app_port", "bcrypt_rounds", "hash_workers", "hash_queue_size", "http_pool_size",
+                       "http_max_retries", "server_workers", "server_threads", "server_timeout",
+                       "server_graceful_timeout", "server_keepalive", "server_max_requests", "user_cache_size",
+                       "health_failure_threshold", "db_pool_size", "db_max_overflow", "ratelimit_ip_burst",
+                       "ratelimit_user_burst", "ratelimit_max_keys", "user_index_capacity",
+                       "user_index_negative_size", "static_max_age", "tenant_max_clients", "audit_segment_mb",
+                       "audit_queue_size", "state_max_pending", "state_max_per_user", "profile_buffer_size",
+                       "log_max_mb", "log_backup_count", "log_queue_size", "log_batch_size"),
+        "getfloat":   ("health_ttl", "health_jitter", "health_reset_timeout", "http_connect_timeout",
+                       "http_read_timeout", "hash_timeout", "user_cache_ttl", "state_ttl", "state_sweep_interval",
+                       "metrics_log_interval", "ratelimit_ip_period", "ratelimit_user_period",
+                       "user_index_error_rate", "user_index_negative_ttl", "user_index_sync_interval",
+                       "user_index_rebuild_interval", "config_reload_interval", "jwt_previous_key_ttl",
+                       "tenant_idle_timeout", "audit_segment_seconds", "audit_fsync_interval", "profile_sample_rate",
+                       "profile_slow_ms", "log_rotate_interval"),
+        "getboolean": ("http_pool", "http_pool_block", "metrics_enabled", "ratelimit_enabled",
+                       "user_index_enabled", "static_compress", "audit_enabled",
+                       "profile_endpoint_enabled", "log_json"),
+}
+
+# Inclusive (minimum, maximum) of typed values, None for no bound. 0 turns off the *_interval, *_max_* and
+# most *_size values, the others need at least one.
+_RANGES = {
+        "app_port": (1, 65535), "bcrypt_rounds": (4, 31), "hash_workers": (1, None), "hash_queue_size": (0, None),
+        "http_pool_size": (1, None), "http_max_retries": (0, None), "server_workers": (1, None),
+        "server_threads": (1, None), "server_timeout": (0, None), "server_graceful_timeout": (0, None),
+        "server_keepalive": (0, None), "server_max_requests": (0, None), "user_cache_size": (0, None),
+        "health_failure_threshold": (1, None), "db_pool_size": (1, None), "db_max_overflow": (-1, None),
+        "ratelimit_ip_burst": (0, None), "ratelimit_user_burst": (0, None), "ratelimit_max_keys": (1, None),
+        "user_index_capacity": (1, None), "user_index_negative_size": (0, None), "static_max_age": (0, None),
+        "tenant_max_clients": (0, None), "audit_segment_mb": (1, None), "audit_queue_size": (1, None),
+        "state_max_pending": (0, None), "state_max_per_user": (0, None), "profile_buffer_size": (1, None),
+        "log_max_mb": (0, None), "log_backup_count": (0, None), "log_queue_size": (0, None),
+        "log_batch_size": (1, None), "health_jitter": (0, 1), "hash_timeout": (0, None), "user_cache_ttl": (0, None),
+        "state_sweep_interval": (0, None), "metrics_log_interval": (0, None), "user_index_negative_ttl": (0, None),
+        "user_index_sync_interval": (0, None), "user_index_rebuild_interval": (0, None),
+        "config_reload_interval": (0, None), "jwt_previous_key_ttl": (0, None), "tenant_idle_timeout": (0, None),
+        "audit_fsync_interval": (0, None), "profile_sample_rate": (0, 1), "profile_slow_ms": (0, None),
+        "log_rotate_interval": (0, None), "http_connect_timeout": (0, None), "http_read_timeout": (0, None),
+        "health_reset_timeout": (0, None),
+}
+# Typed values that must be above 0: periods and rates the code divides by or takes the logarithm of
+_POSITIVE = frozenset({"health_ttl", "state_ttl", "ratelimit_ip_period",
+                       "ratelimit_user_period", "audit_segment_seconds", "user_index_error_rate"})
+
+
+class ConfigError(ValueError):
+    """duo.conf is missing, unreadable or has invalid values"""
+
+
+class DuoConfig(NamedTuple):
+    """One validated duo.conf section. Replaced as a whole on reload, never modified."""
+    client_id: str
+    client_secret: str
+    api_hostname: str
+    redirect_uri: str
+    failmode: str
+    duo_certs: str | None
+    # Every value of the section, for the components that read their own keys
+    section: configparser.SectionProxy
+    source: str | None = None
+    loaded_at: float = 0.0
+    # Snapshots of the sections listed in ``tenants``, see duo_tenants
+    tenants: tuple = ()
+
+    @property
+    def fail_open(self) -> bool:
+        return self.failmode == "open"
+
+    @property
+    def values(self) -> Mapping[str, str]:
+        return MappingProxyType(dict(self.section))
+
+
+def _copy_section(name: str, values: Mapping[str, str]) -> configparser.SectionProxy:
+    """A private copy of the section, so changes to the caller's parser do not leak into the snapshot"""
+    parser = configparser.ConfigParser(interpolation=None)
+    parser[name] = values
+    return parser[name]
+
+
+def split_values(value: str) -> list[str]:
+    """Items of a comma separated value"""
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def from_section(section: configparser.SectionProxy, source: str = None) -> DuoConfig:
+    """Validate a duo.conf section and return its snapshot. Raises ConfigError.
+
+    Every section named in its ``tenants`` value is validated too. A tenant section inherits the
+    values it does not set from this one.
+    """
+    tenants = []
+    for name in split_values(section.get("tenants", "")):
+        if not section.parser.has_section(name) or name == section.name:
+            raise ConfigError(f"Tenant section [{name}] is missing from {source or 'duo.conf'}")
+        values = {key: section[key] for key in section if key not in _NOT_INHERITED}
+        values.update((key, section.parser[name][key]) for key in section.parser[name])
+        tenants.append(_validate(_copy_section(name, values), source))
+    return _validate(_copy_section(section.name, {key: section[key] for key in section}), source, tuple(tenants))
+
+
+def _range_error(key: str, value) -> str | None:
+    if key in _POSITIVE and value <= 0:
+        return f"{value} must be above 0"
+    if key == "user_index_error_rate" and value >= 1:
+        return f"{value} must be below 1"
+    minimum, maximum = _RANGES.get(key, (None, None))
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        return f"{value} must be {minimum} or more" if maximum is None else f"{value} must be {minimum} to {maximum}"
+    return None
+
+
+def _validate(section: configparser.SectionProxy, source: str | None, tenants: tuple = ()) -> DuoConfig:
+    errors = []
+    for key in ("client_id", "client_secret", "api_hostname", "redirect_uri"):
+        if not section.get(key, "").strip():
+            errors.append(f"{key} is missing")
+    # The same checks as duo_universal.Client, reported for all keys at once
+    if section.get("client_id") and len(section["client_id"].strip()) != 20:
+        errors.append("client_id must be 20 characters long")
+    if section.get("client_secret") and len(section["client_secret"].strip()) != 40:
+        errors.append("client_secret must be 40 characters long")
+    if section.get("redirect_uri") and not section["redirect_uri"].startswith(("http://", "https://")):
+        errors.append("redirect_uri must be an http:// or https:// URL")
+    failmode = FAILMODES.get(section.get("failmode", "closed").strip().lower())
+    if failmode is None:
+        errors.append(f"failmode must be one of {', '.join(FAILMODES)}")
+    if section.get("log_queue_policy", "drop").strip().lower() not in ("drop", "block"):
+        errors.append("log_queue_policy must be drop or block")
+    if section.get("log_level", "INFO").strip().upper() not in logging.getLevelNamesMapping():
+        errors.append("log_level must be a logging level such as INFO or DEBUG")
+    for network in split_values(section.get("profile_allowed_ips", "")):
+        try:
+            ipaddress.ip_network(network, strict=False)
+        except ValueError:
+            errors.append(f"profile_allowed_ips: {network!r} is not an IP address or network")
+    for getter, keys in _TYPED_KEYS.items():
+        for key in keys:
+            if section.get(key, "").strip():
+                try:
+                    value = getattr(section, getter)(key)
+                except ValueError as e:
+                    errors.append(f"{key}: {e}")
+                    continue
+                error = _range_error(key, value)
+                if error:
+                    errors.append(f"{key}: {error}")
+    if errors:
+        raise ConfigError(f"Invalid [{section.name}] section in {source or 'duo.conf'}: {'; '.join(errors)}")
+    return DuoConfig(client_id=section["client_id"].strip(),
+                     client_secret=section["client_secret"].strip(),
+                     api_hostname=section["api_hostname"].strip(),
+                     redirect_uri=section["redirect_uri"].strip(),
+                     failmode=failmode,
+                     duo_certs=section.get("duo_certs") or None,
+                     section=section,
+                     source=source,
+                     loaded_at=time.time(),
+                     tenants=tenants)
+
+
+def load(path: str, section_name: str = "duo") -> DuoConfig:
+    """Read and validate one section of a duo.conf file. Raises ConfigError."""
+    parser = configparser.ConfigParser()
+    try:
+        with open(path) as fh:
+            parser.read_file(fh)
+    except (OSError, configparser.Error) as e:
+        raise ConfigError(f"Unable to read {path}: {e}") from e
+    if not parser.has_section(section_name):
+        raise ConfigError(f"{path} has no [{section_name}] section")
+    return from_section(parser[section_name], source=path)
+
+
+def changed_keys(old: DuoConfig, new: DuoConfig) -> set[str]:
+    old_values, new_values = old.values, new.values
+    return {key for key in old_values.keys() | new_values.keys() if old_values.get(key) != new_values.get(key)}
+
+
+def is_reloadable(key: str) -> bool:
+    return key in RELOADABLE_KEYS or key.startswith(RELOADABLE_PREFIXES)
+
+
+def affects_client(key: str) -> bool:
+    """Whether the Duo client has to be rebuilt when ``key`` changes"""
+    return key in CLIENT_KEYS or key.startswith(CLIENT_PREFIXES)
+
+
+class ConfigWatcher:
+    """Reload a duo.conf section when the file changes or the process receives SIGHUP.
+
+    The file is checked every ``interval`` seconds from a background thread (0 disables polling,
+    SIGHUP still works). ``on_reload(config)`` is called with the new snapshot from that thread;
+    invalid files are logged and the current configuration stays in use.
+    """
+
+    def __init__(self,
+                 path: str,
+                 on_reload: Callable[[DuoConfig], object],
+                 /,
+                 *,
+                 section_name: str = "duo",
+                 interval: float = 5.0,
+                 logger: logging.Logger = None):
+        self.path = path
+        self.on_reload = on_reload
+        self.section_name = section_name
+        self.interval = interval
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.reloads = 0
+        self.failures = 0
+        self._signature = self._stat()
+        self._requested = False
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _stat(self) -> tuple | None:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def check(self, force: bool = False) -> bool:
+        """Reload if the file changed since the last check (or always with ``force``), return True if reloaded"""
+        signature = self._stat()
+        if not force and signature == self._signature:
+            return False
+        # Remembered even if the reload fails, a broken file is reported once and not on every check
+        self._signature = signature
+        try:
+            config = load(self.path, self.section_name)
+            self.on_reload(config)
+        except Exception as e:
+            self.failures += 1
+            self.logger.error("Configuration reload from %s failed, keeping the current configuration: %s",
+                              self.path, e)
+            return False
+        self.reloads += 1
+        return True
+
+    def request_reload(self):
+        """Reload on the next wake up of the watcher thread, safe to call from a signal handler"""
+        self._requested = True
+        self._wake.set()
+
+    def install_signal_handler(self, signum: int = getattr(signal, "SIGHUP", None)) -> bool:
+        """Reload on ``signum``, only possible from the main thread on platforms that have SIGHUP"""
+        if signum is None or threading.current_thread() is not threading.main_thread():
+            return False
+        signal.signal(signum, lambda *_: self.request_reload())
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval if self.interval > 0 else None)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            force, self._requested = self._requested, False
+            self.check(force)
+
+    def start(self):
+        """Start the background watcher thread"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="duo-config-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
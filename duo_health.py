@@ -0,0 +1,158 @@
+"""
+Cached Duo service health status with a background refresher and circuit breaker
+"""
+from __future__ import annotations, print_function
+
+import logging
+import random
+import threading
+import time
+from typing import Callable, NamedTuple
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class HealthStatus(NamedTuple):
+    """Immutable snapshot of the last Duo health check"""
+    healthy: bool
+    checked_at: float
+    error: str | None = None
+
+
+UNKNOWN_STATUS = HealthStatus(healthy=False, checked_at=0.0, error="Health not checked yet.")
+
+
+class CircuitBreaker:
+    """Trip after a number of consecutive failures and allow a single half-open probe after a cool down"""
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """Return True if a call to the protected service may be attempted"""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+            return self.state != OPEN
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+
+class DuoHealthMonitor:
+    """Periodically call a health check function and cache the result for the request path.
+
+    Readers only look at ``self.status``, which is replaced as a whole on every refresh,
+    so no lock is taken on the request path once the first result is published. Health checks
+    run one at a time, requests arriving before the first result wait for it.
+    """
+
+    def __init__(self,
+                 health_check: Callable[[], object],
+                 /,
+                 *,
+                 ttl: float = 30.0,
+                 jitter: float = 0.1,
+                 failure_threshold: int = 3,
+                 reset_timeout: float = 30.0,
+                 logger: logging.Logger = None):
+        self._health_check = health_check
+        self.ttl = ttl
+        self.jitter = jitter
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.status = UNKNOWN_STATUS
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _next_interval(self) -> float:
+        """TTL with random jitter so that several workers do not refresh in lock step"""
+        spread = self.ttl * self.jitter
+        return max(0.1, self.ttl + random.uniform(-spread, spread))
+
+    def refresh(self) -> HealthStatus:
+        """Run a single health check (unless the breaker is open) and publish the result"""
+        with self._refresh_lock:
+            return self._refresh()
+
+    def _refresh(self) -> HealthStatus:
+        if not self.breaker.allow_request():
+            return self.status
+        try:
+            self._health_check()
+        except Exception as e:
+            self.breaker.record_failure()
+            if self.status.healthy or self.status is UNKNOWN_STATUS:
+                self.logger.warning("Duo health check failed: %s", e)
+            self.status = HealthStatus(healthy=False, checked_at=time.time(), error=str(e))
+        else:
+            self.breaker.record_success()
+            if not self.status.healthy:
+                self.logger.info("Duo health check succeeded.")
+            self.status = HealthStatus(healthy=True, checked_at=time.time())
+        return self.status
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            interval = self._next_interval()
+            if self.breaker.state == OPEN:
+                interval = max(interval, self.breaker.reset_timeout)
+            self._stop.wait(interval)
+
+    def start(self):
+        """Start the background refresher thread"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="duo-health-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """Stop the background refresher thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_available(self) -> bool:
+        """Return the cached health status. Stale results (older than 3 TTLs) count as unavailable."""
+        status = self.status
+        if status is UNKNOWN_STATUS:
+            # No result published yet (e.g. refresher not started): the first caller checks inline, the
+            # others wait for its result instead of all calling Duo at once
+            with self._refresh_lock:
+                status = self.status
+                if status is UNKNOWN_STATUS:
+                    status = self._refresh()
+        return status.healthy and time.time() - status.checked_at < 3 * self.ttl
+
+
+def health_monitor_from_config(section, health_check: Callable[[], object], logger: logging.Logger = None
+                               ) -> DuoHealthMonitor:
+    """Build a health monitor from the ``health_*`` values of a duo.conf section"""
+    return DuoHealthMonitor(
+            health_check,
+            ttl=section.getfloat('health_ttl', fallback=30.0),
+            jitter=section.getfloat('health_jitter', fallback=0.1),
+            failure_threshold=section.getint('health_failure_threshold', fallback=3),
+            reset_timeout=section.getfloat('health_reset_timeout', fallback=30.0),
+            logger=logger,
+    )
@@ -0,0 +1,301 @@
+"""
+Several Duo applications (tenants) served by one process: a Duo client, health monitor and failmode
+per duo.conf section, chosen for every request by host name or path prefix
+"""
+from __future__ import annotations, print_function
+
+import logging
+import re
+import threading
+import time
+from typing import Callable, NamedTuple
+
+from flask import has_request_context, request
+from flask.sessions import SecureCookieSessionInterface
+
+import duo_config
+import duo_health
+import duo_utils
+
+# WSGI environ key with the name of the tenant a request was routed to, not set for the default tenant
+ENVIRON_KEY = "duo.tenant"
+
+_COOKIE_UNSAFE = re.compile(r"[^A-Za-z0-9_-]")
+
+
+class DuoContext(NamedTuple):
+    """A configuration snapshot and the Duo client built from it, replaced together on reload"""
+    config: duo_config.DuoConfig
+    client: duo_utils.LazyValue
+
+
+class Tenant:
+    """One Duo application. Requests read ``context`` once and finish with that snapshot."""
+
+    def __init__(self,
+                 config: duo_config.DuoConfig,
+                 build_client: Callable[[duo_config.DuoConfig], object],
+                 /,
+                 *,
+                 logger: logging.Logger = None):
+        self.name = config.section.name
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.last_used = 0.0
+        self.builds = 0
+        self.evictions = 0
+        self._build_client = build_client
+        self._lock = threading.Lock()
+        # Bumped when the client is dropped, checks of the monitors started before then are stale
+        self._generation = 0
+        self.context = self._new_context(config)
+        self.health = self._new_monitor(config)
+
+    def _new_context(self, config: duo_config.DuoConfig) -> DuoContext:
+        def build():
+            self.builds += 1
+            return self._build_client(config)
+
+        return DuoContext(config, duo_utils.LazyValue(build))
+
+    def _new_monitor(self, config: duo_config.DuoConfig) -> duo_health.DuoHealthMonitor:
+        # Health checks do not count as use, the client of an idle tenant can still be evicted
+        generation = self._generation
+        return duo_health.health_monitor_from_config(config.section, lambda: self._health_check(generation),
+                                                     self.logger)
+
+    def _health_check(self, generation: int):
+        # stop(0) does not wait for a check in flight, it must not build the client evict() just dropped
+        with self._lock:
+            if generation != self._generation:
+                return
+            client = self.context.client
+        client.get().health_check()
+
+    @property
+    def hosts(self) -> list[str]:
+        return [host.lower() for host in duo_config.split_values(self.context.config.section.get('tenant_hosts', ''))]
+
+    @property
+    def path_prefix(self) -> str | None:
+        prefix = self.context.config.section.get('tenant_path', '').strip("/ ")
+        return "/" + prefix if prefix else None
+
+    @property
+    def is_built(self) -> bool:
+        return self.context.client.is_built
+
+    def use(self) -> DuoContext:
+        """The current context for a request. Starts the health checks again after an eviction."""
+        self.last_used = time.monotonic()
+        self.health.start()
+        return self.context
+
+    def prepare(self, config: duo_config.DuoConfig) -> tuple[DuoContext, set[str]]:
+        """The context for a reloaded snapshot and the changed keys, apply it with commit()
+
+        A client in use is rebuilt right away, so bad settings fail the reload and the tenant stays warm.
+        """
+        current = self.context
+        changed = duo_config.changed_keys(current.config, config)
+        if not any(duo_config.affects_client(key) for key in changed):
+            return current._replace(config=config), changed
+        context = self._new_context(config)
+        if current.client.is_built:
+            client = context.client.get()
+            if "client_secret" in changed:
+                # Tokens Duo signed with the old secret before it was rotated there still verify for a while
+                client.verifier.accept_previous(current.client.get().verifier)
+        return context, changed
+
+    def commit(self, context: DuoContext):
+        previous, self.context = self.context, context
+        if context.client is not previous.client and context.client.is_built:
+            # The old client stays with the requests still using it, check the new settings right away
+            self.health.refresh()
+
+    def evict(self) -> bool:
+        """Drop the client and stop the health checks until the next use, return False if nothing was built"""
+        with self._lock:
+            if not self.context.client.is_built:
+                return False
+            self._generation += 1
+            self.health.stop(0)
+            self.health = self._new_monitor(self.context.config)
+            self.context = self._new_context(self.context.config)
+            self.evictions += 1
+        return True
+
+    def close(self):
+        with self._lock:
+            self._generation += 1
+        self.health.stop(0)
+
+    def stats(self) -> dict:
+        return {
+                "built":        int(self.is_built),
+                "builds":       self.builds,
+                "evictions":    self.evictions,
+                "idle_seconds": round(time.monotonic() - self.last_used, 1) if self.last_used else 0,
+                "healthy":      int(bool(self.health.status.healthy)),
+                "fail_open":    int(self.context.config.fail_open),
+        }
+
+
+class _Routes(NamedTuple):
+    tenants: dict
+    hosts: dict
+    # (prefix, tenant) pairs, longest prefix first
+    prefixes: list
+
+
+class TenantRegistry:
+    """The default tenant, from the main duo.conf section, and one tenant per section named in its ``tenants``.
+
+    route() sends a request to the tenant listing the request's host name in ``tenant_hosts``, else to
+    the tenant whose ``tenant_path`` starts the path, else to the default tenant. Clients of tenants
+    other than the default one are built on first use and dropped again after ``tenant_idle_timeout``
+    seconds without requests, or when more than ``tenant_max_clients`` are built, least recently used
+    first. Evictions are checked while handling requests, there is no background thread.
+    """
+
+    def __init__(self,
+                 config: duo_config.DuoConfig,
+                 build_client: Callable[[duo_config.DuoConfig], object],
+                 /,
+                 *,
+                 logger: logging.Logger = None):
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.evictions = 0
+        self._build_client = build_client
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+        self.default = Tenant(config, build_client, logger=self.logger)
+        self._apply(config, {tenant.section.name: Tenant(tenant, build_client, logger=self.logger)
+                             for tenant in config.tenants})
+
+    def _apply(self, config: duo_config.DuoConfig, tenants: dict):
+        self.config = config
+        self.max_clients = config.section.getint('tenant_max_clients', fallback=0)
+        self.idle_timeout = config.section.getfloat('tenant_idle_timeout', fallback=3600.0)
+        hosts, prefixes = {}, []
+        for tenant in tenants.values():
+            hosts.update((host, tenant) for host in tenant.hosts)
+            if tenant.path_prefix:
+                prefixes.append((tenant.path_prefix, tenant))
+        prefixes.sort(key=lambda item: len(item[0]), reverse=True)
+        self._routes = _Routes(tenants, hosts, prefixes)
+
+    def __iter__(self):
+        yield self.default
+        yield from self._routes.tenants.values()
+
+    def get(self, name: str = None) -> Tenant:
+        """The tenant of that name, the default tenant for None or a tenant removed by a reload"""
+        return self._routes.tenants.get(name, self.default) if name is not None else self.default
+
+    def route(self, environ: dict) -> Tenant:
+        """Choose the tenant for a WSGI request and record it in the environ. A matched path prefix is
+        moved to SCRIPT_NAME, so the application sees its usual paths and url_for() keeps the prefix."""
+        routes = self._routes
+        host = (environ.get("HTTP_HOST") or environ.get("SERVER_NAME") or "").lower()
+        host = host.split("]")[0] + "]" if host.startswith("[") else host.split(":")[0]
+        tenant = routes.hosts.get(host)
+        if tenant is None:
+            path = environ.get("PATH_INFO", "")
+            for prefix, candidate in routes.prefixes:
+                if path == prefix or path.startswith(prefix + "/"):
+                    environ["SCRIPT_NAME"] = environ.get("SCRIPT_NAME", "") + prefix
+                    environ["PATH_INFO"] = path[len(prefix):]
+                    tenant = candidate
+                    break
+        if tenant is None:
+            return self.default
+        environ[ENVIRON_KEY] = tenant.name
+        return tenant
+
+    def use(self, tenant: Tenant) -> DuoContext:
+        """The tenant's context for a request, evicting idle clients of other tenants when due"""
+        # Read before use(), the health checks it starts may build the client right away
+        first_use = tenant is not self.default and not tenant.is_built
+        context = tenant.use()
+        now = time.monotonic()
+        if now >= self._next_sweep or first_use:
+            self._evict(now, tenant)
+        return context
+
+    def _evict(self, now: float, keep: Tenant):
+        # One request sweeps at a time, the others do not wait for it
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sweep = now + (min(60.0, max(1.0, self.idle_timeout / 4)) if self.idle_timeout > 0 else 60.0)
+            built = sorted((tenant for tenant in self._routes.tenants.values()
+                            if tenant is not keep and tenant.is_built), key=lambda tenant: tenant.last_used)
+            evict = [tenant for tenant in built if self.idle_timeout > 0 and now - tenant.last_used > self.idle_timeout]
+            if self.max_clients > 0:
+                # The tenant being used needs one of the clients
+                excess = len(built) + (keep is not self.default) - self.max_clients
+                evict += [tenant for tenant in built[:max(0, excess)] if tenant not in evict]
+            for tenant in evict:
+                if tenant.evict():
+                    self.evictions += 1
+                    self.logger.info("Evicted the Duo client of tenant %s, unused for %.0f seconds.", tenant.name,
+                                     now - tenant.last_used)
+        finally:
+            self._lock.release()
+
+    def reload(self, config: duo_config.DuoConfig) -> dict[str, set[str]]:
+        """Apply a reloaded snapshot to every tenant and add or remove tenants, return the changed keys by tenant.
+
+        All clients are prepared before any tenant changes, an error leaves the registry as it was.
+        """
+        with self._lock:
+            current = self._routes.tenants
+            tenants, changes, prepared = {}, {}, [(self.default, self.default.prepare(config))]
+            for tenant_config in config.tenants:
+                name = tenant_config.section.name
+                if name in current:
+                    tenants[name] = current[name]
+                    prepared.append((current[name], current[name].prepare(tenant_config)))
+                else:
+                    tenants[name] = Tenant(tenant_config, self._build_client, logger=self.logger)
+                    changes[name] = {"added"}
+            for tenant, (context, changed) in prepared:
+                if changed:
+                    tenant.commit(context)
+                    changes[tenant.name] = changed
+            for name, tenant in current.items():
+                if name not in tenants:
+                    tenant.close()
+                    changes[name] = {"removed"}
+            self._apply(config, tenants)
+        return changes
+
+    def start(self):
+        """Start the health checks of the default tenant, the other tenants start theirs on first use"""
+        self.default.health.start()
+
+    def stats(self) -> dict:
+        """Statistics by (tenant, stat)"""
+        return {(tenant.name, stat): value for tenant in self for stat, value in tenant.stats().items()}
+
+
+def tenant_dispatcher(wsgi_app, registry: Callable[[], TenantRegistry | None]):
+    """WSGI middleware that routes every request to its tenant, see TenantRegistry.route()"""
+
+    def wrapper(environ, start_response):
+        tenants = registry()
+        if tenants is not None:
+            tenants.route(environ)
+        return wsgi_app(environ, start_response)
+
+    return wrapper
+
+
+class TenantSessionInterface(SecureCookieSessionInterface):
+    """A session cookie per tenant, so logging in through one Duo application does not count for another"""
+
+    def get_cookie_name(self, app) -> str:
+        name = super().get_cookie_name(app)
+        tenant = request.environ.get(ENVIRON_KEY) if has_request_context() else None
+        return f"{name}_{_COOKIE_UNSAFE.sub('_', tenant)}" if tenant else name
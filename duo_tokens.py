@@ -0,0 +1,154 @@
+"""
+Verification of Duo id_tokens with PyJWT and HS512 keys prepared once per client secret
+"""
+from __future__ import annotations, print_function
+
+import hashlib
+import hmac
+import json
+import threading
+import time
+from typing import NamedTuple
+
+import jwt
+from jwt.algorithms import HMACAlgorithm
+
+ALGORITHM = "HS512"
+
+# Claims are checked by jwt.decode() after the signature, the same checks as with verify_signature
+_CLAIM_OPTIONS = {"verify_signature": False, "verify_exp": True, "verify_nbf": True, "verify_iat": True,
+                  "verify_aud": True, "verify_iss": True}
+
+
+class _Key(NamedTuple):
+    """HMAC keyed with a client secret, copied for every token so the key schedule is computed once"""
+    mac: hmac.HMAC
+    fingerprint: str
+    # time.monotonic() after which a previous key is no longer accepted, None for the current key
+    expires: float | None = None
+    # Why PyJWT would refuse the secret (empty, an asymmetric key, ...), raised for every token
+    error: jwt.InvalidKeyError | None = None
+
+
+def _prepare(secret: str) -> _Key:
+    key = secret.encode()
+    try:
+        HMACAlgorithm(HMACAlgorithm.SHA512).prepare_key(key)
+        error = None
+    except jwt.InvalidKeyError as e:
+        error = e
+    return _Key(hmac.new(key, digestmod=hashlib.sha512), hashlib.sha256(key).hexdigest()[:12], error=error)
+
+
+class _PreparedHMAC(HMACAlgorithm):
+    """HS512 for _Key objects: PyJWT's key checks ran in _prepare(), not for every token"""
+
+    def __init__(self):
+        super().__init__(HMACAlgorithm.SHA512)
+
+    def prepare_key(self, key: _Key) -> _Key:
+        if not isinstance(key, _Key):
+            raise jwt.InvalidKeyError("Expected a prepared key")
+        if key.error is not None:
+            raise key.error
+        return key
+
+    def check_key_length(self, key: _Key) -> None:
+        # Duo client secrets are 40 characters, below the 64 bytes recommended for HS512
+        return None
+
+    def sign(self, msg: bytes, key: _Key) -> bytes:
+        mac = key.mac.copy()
+        mac.update(msg)
+        return mac.digest()
+
+    def verify(self, msg: bytes, key: _Key, sig: bytes) -> bool:
+        return hmac.compare_digest(self.sign(msg, key), sig)
+
+
+class TokenVerifier:
+    """Verifies the HS512 id_tokens Duo returns from the token exchange.
+
+    Duo signs id_tokens with the client secret, there is no JWKS endpoint and no key to fetch. Tokens
+    are checked like duo_universal checks them, only the key preparation PyJWT repeats for every token
+    is done once: the secret is keyed into an HMAC that is copied per token. The signature is verified
+    by a ``jwt.PyJWS`` that only knows that prepared HS512, the claims by ``jwt.decode()``.
+
+    accept_previous() keeps the secret of the verifier being replaced valid for ``previous_key_ttl``
+    seconds, so tokens Duo signed before a rotated secret reached it still verify.
+    """
+
+    def __init__(self, client_secret: str, /, *, previous_key_ttl: float = 300.0):
+        self.previous_key_ttl = previous_key_ttl
+        self._keys = (_prepare(client_secret),)
+        self._jws = jwt.PyJWS(algorithms=[])
+        self._jws.register_algorithm(ALGORITHM, _PreparedHMAC())
+        self._lock = threading.Lock()
+        self.counters = {"verified": 0, "failed": 0, "previous_key": 0, "rotations": 0}
+
+    @property
+    def fingerprint(self) -> str:
+        """Short hash of the current secret, safe to log"""
+        return self._keys[0].fingerprint
+
+    def _count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def accept_previous(self, previous: TokenVerifier):
+        """Also accept the current secret of ``previous`` for ``previous_key_ttl`` seconds"""
+        key = previous._keys[0]
+        if self.previous_key_ttl <= 0 or key.fingerprint == self.fingerprint:
+            return
+        with self._lock:
+            self._keys = (self._keys[0], key._replace(expires=time.monotonic() + self.previous_key_ttl))
+            self.counters["rotations"] += 1
+
+    def _decode(self, token: str, audience: str | None, issuer: str | None, leeway: float, required) -> dict:
+        now = time.monotonic()
+        keys = [key for key in self._keys if key.expires is None or key.expires >= now]
+        for index, key in enumerate(keys):
+            try:
+                self._jws.decode_complete(token, key, algorithms=[ALGORITHM])
+            except jwt.InvalidSignatureError:
+                if index == len(keys) - 1:
+                    raise
+                continue
+            claims = jwt.decode(token, audience=audience, issuer=issuer, leeway=leeway,
+                                options={**_CLAIM_OPTIONS, 'require': list(required)})
+            if index:
+                self._count("previous_key")
+            return claims
+
+    def decode(self,
+               token: str,
+               /,
+               *,
+               audience: str = None,
+               issuer: str = None,
+               leeway: float = 0,
+               required: tuple = ("exp", "iat")) -> dict:
+        """Verify a token and return its claims. Raises the jwt.PyJWTError of jwt.decode()."""
+        try:
+            claims = self._decode(token, audience, issuer, leeway, required)
+        except jwt.PyJWTError:
+            self._count("failed")
+            raise
+        self._count("verified")
+        return claims
+
+    def warm(self):
+        """Verify a token signed with the current key once, so the first callback does not pay for imports"""
+        now = int(time.time())
+        token = self._jws.encode(json.dumps({"aud": "warm-up", "iat": now, "exp": now + 60}).encode(), self._keys[0],
+                                 algorithm=ALGORITHM)
+        self._decode(token, "warm-up", None, 0, ("exp", "iat"))
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {**self.counters, "keys": sum(1 for key in self._keys if key.expires is None or key.expires >= now)}
+
+
+def verifier_from_config(section, client_secret: str) -> TokenVerifier:
+    """Build the id_token verifier from the ``jwt_*`` values of a duo.conf section"""
+    return TokenVerifier(client_secret, previous_key_ttl=section.getfloat('jwt_previous_key_ttl', fallback=300.0))
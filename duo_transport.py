@@ -0,0 +1,303 @@
+"""
+Pluggable HTTP transport for the Duo Universal client with per-host connection pooling
+"""
+from __future__ import annotations, print_function
+
+import json
+import platform
+import ssl
+import threading
+
+import jwt
+import requests
+from duo_universal import client as duo_client_module
+from duo_universal.client import Client, DuoException
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import duo_tokens
+import profiling
+
+try:
+    import httpx
+except ImportError:  # Only needed by AsyncPooledClient
+    httpx = None
+
+
+class TransportStats:
+    """Thread-safe counters for connection pool usage"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.pool_hits = 0
+        self.pool_misses = 0
+        self.reconnects = 0
+
+    def incr(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                    "requests":    self.requests,
+                    "pool_hits":   self.pool_hits,
+                    "pool_misses": self.pool_misses,
+                    "reconnects":  self.reconnects,
+            }
+
+
+class _CountingPoolMixin:
+    """Classify every connection taken from a urllib3 pool as a hit, miss or reconnect"""
+    stats: TransportStats = None
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        if self.stats is not None:
+            if not getattr(conn, "_duo_pooled", False):
+                # Brand-new connection, TCP and TLS handshakes will be performed
+                conn._duo_pooled = True
+                self.stats.incr("pool_misses")
+            elif getattr(conn, "sock", None) is None:
+                # Previously used connection that was dropped by the server and must reconnect
+                self.stats.incr("reconnects")
+            else:
+                self.stats.incr("pool_hits")
+        return conn
+
+
+class _CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose per-host pools report into a TransportStats instance"""
+
+    def __init__(self, stats: TransportStats, **kwargs):
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        http_pool = type("HTTPConnectionPool", (_CountingHTTPConnectionPool,), {"stats": self._stats})
+        https_pool = type("HTTPSConnectionPool", (_CountingHTTPSConnectionPool,), {"stats": self._stats})
+        self.poolmanager.pool_classes_by_scheme = {"http": http_pool, "https": https_pool}
+
+
+class Transport:
+    """Default transport, a new connection (TCP + TLS handshake) for every request"""
+
+    def __init__(self, connect_timeout: float = None, read_timeout: float = None):
+        self.timeout = (connect_timeout, read_timeout) if connect_timeout or read_timeout else None
+        self.stats = TransportStats()
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        self.stats.incr("requests")
+        self.stats.incr("pool_misses")
+        with profiling.span("duo http", url):
+            return requests.post(url, **kwargs)
+
+    def close(self):
+        pass
+
+
+class PooledTransport(Transport):
+    """Transport using a shared requests.Session with keep-alive connections pooled per host.
+
+    Reusing a kept-alive connection skips both the TCP and the TLS handshake, so no TLS
+    session resumption is needed for the common case of a warm pool.
+    """
+
+    def __init__(self,
+                 pool_size: int = 10,
+                 /,
+                 *,
+                 pool_block: bool = False,
+                 max_retries: int = 0,
+                 connect_timeout: float = None,
+                 read_timeout: float = None):
+        super().__init__(connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = _CountingHTTPAdapter(self.stats,
+                                       pool_connections=pool_size,
+                                       pool_maxsize=pool_size,
+                                       pool_block=pool_block,
+                                       max_retries=max_retries)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        self.stats.incr("requests")
+        with profiling.span("duo http", url):
+            return self.session.post(url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class PooledClient(Client):
+    """duo_universal Client that sends its HTTP requests through a pluggable Transport"""
+
+    def __init__(self, *args, transport: Transport = None, verifier: duo_tokens.TokenVerifier = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.transport = transport if transport is not None else PooledTransport()
+        self.verifier = verifier if verifier is not None else duo_tokens.TokenVerifier(self._client_secret)
+        # Pay for the first id_token verification while the client is built, not in the first callback
+        self.verifier.warm()
+
+    def _health_check_request(self) -> tuple[str, dict]:
+        """Build the URL and form data for a health check request"""
+        health_check_endpoint = duo_client_module.OAUTH_V1_HEALTH_CHECK_ENDPOINT.format(self._api_host)
+        jwt_args = self._create_jwt_args(health_check_endpoint)
+        return health_check_endpoint, {
+                'client_assertion': jwt.encode(jwt_args, self._client_secret, algorithm='HS512'),
+                'client_id':        self._client_id
+        }
+
+    @staticmethod
+    def _parse_health_check(response) -> dict:
+        res = json.loads(response.content)
+        if res['stat'] != 'OK':
+            raise DuoException(res)
+        return res
+
+    def _token_request(self, duoCode) -> tuple[str, dict, dict]:
+        """Build the URL, query parameters and headers for an authorization code exchange"""
+        if not duoCode:
+            raise DuoException(duo_client_module.ERR_CODE)
+        token_endpoint = duo_client_module.OAUTH_V1_TOKEN_ENDPOINT.format(self._api_host)
+        jwt_args = self._create_jwt_args(token_endpoint)
+        all_args = {
+                'grant_type':            'authorization_code',
+                'code':                  duoCode,
+                'redirect_uri':          self._redirect_uri,
+                'client_id':             self._client_id,
+                'client_assertion_type': duo_client_module.CLIENT_ASSERT_TYPE,
+                'client_assertion':      jwt.encode(jwt_args, self._client_secret, algorithm='HS512')
+        }
+        ca_pinning_status = "disabled" if getattr(self, "_disable_ca_pinning", False) else "enabled"
+        user_agent = (f"duo_universal_python/{duo_client_module.__version__} "
+                      f"python/{platform.python_version()} {platform.platform()} "
+                      f"ca_bundle/{getattr(duo_client_module, 'CA_BUNDLE_VERSION', '1.0')} "
+                      f"(ca_pinning={ca_pinning_status})")
+        return token_endpoint, all_args, {"user-agent": user_agent}
+
+    def _parse_token(self, response, username, nonce=None) -> dict:
+        """Validate a token endpoint response and return the decoded id_token"""
+        if response.status_code != duo_client_module.SUCCESS_STATUS_CODE:
+            raise DuoException(json.loads(response.content))
+
+        try:
+            decoded_token = self.verifier.decode(
+                    response.json()['id_token'],
+                    audience=self._client_id,
+                    issuer=duo_client_module.OAUTH_V1_TOKEN_ENDPOINT.format(self._api_host),
+                    leeway=duo_client_module.LEEWAY,
+            )
+        except Exception as e:
+            raise DuoException(e)
+
+        if decoded_token.get('preferred_username') != username:
+            raise DuoException(duo_client_module.ERR_USERNAME)
+        if nonce and decoded_token.get('nonce') != nonce:
+            raise DuoException(duo_client_module.ERR_NONCE)
+        return decoded_token
+
+    def health_check(self):
+        """Checks whether Duo is available, see Client.health_check()"""
+        health_check_endpoint, all_args = self._health_check_request()
+        try:
+            response = self.transport.post(health_check_endpoint,
+                                           data=all_args,
+                                           verify=self._duo_certs,
+                                           proxies=self._http_proxy)
+            return self._parse_health_check(response)
+        except Exception as e:
+            raise DuoException(e)
+
+    def exchange_authorization_code_for_2fa_result(self, duoCode, username, nonce=None):
+        """Exchange the duo_code for a token, see Client.exchange_authorization_code_for_2fa_result()"""
+        token_endpoint, all_args, headers = self._token_request(duoCode)
+        try:
+            response = self.transport.post(token_endpoint,
+                                           params=all_args,
+                                           headers=headers,
+                                           verify=self._duo_certs,
+                                           proxies=self._http_proxy)
+        except Exception as e:
+            raise DuoException(e)
+        return self._parse_token(response, username, nonce)
+
+
+class AsyncPooledClient(PooledClient):
+    """PooledClient with non-blocking variants of the Duo API calls for asyncio applications.
+
+    Requires the optional ``httpx`` package. The synchronous methods keep working, e.g. for the
+    background health monitor thread.
+    """
+
+    def __init__(self, *args, transport: Transport = None, **kwargs):
+        super().__init__(*args, transport=transport, **kwargs)
+        if httpx is None:
+            raise DuoException("The httpx package is required for AsyncPooledClient.")
+        if isinstance(self._duo_certs, str):
+            verify = ssl.create_default_context(cafile=self._duo_certs)
+        else:
+            verify = self._duo_certs
+        pool_size = getattr(self.transport, "pool_size", 10)
+        self._async_client = httpx.AsyncClient(
+                verify=verify,
+                proxy=self._http_proxy['https'] if self._http_proxy else None,
+                timeout=httpx.Timeout(self.transport.timeout[1] if self.transport.timeout else None,
+                                      connect=self.transport.timeout[0] if self.transport.timeout else None),
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def health_check_async(self):
+        """Non-blocking Client.health_check()"""
+        health_check_endpoint, all_args = self._health_check_request()
+        try:
+            response = await self._async_client.post(health_check_endpoint, data=all_args)
+            return self._parse_health_check(response)
+        except Exception as e:
+            raise DuoException(e)
+
+    async def exchange_authorization_code_for_2fa_result_async(self, duoCode, username, nonce=None):
+        """Non-blocking Client.exchange_authorization_code_for_2fa_result()"""
+        token_endpoint, all_args, headers = self._token_request(duoCode)
+        try:
+            response = await self._async_client.post(token_endpoint, params=all_args, headers=headers)
+        except Exception as e:
+            raise DuoException(e)
+        return self._parse_token(response, username, nonce)
+
+    async def aclose(self):
+        await self._async_client.aclose()
+        self.transport.close()
+
+
+def _optional_float(section, key: str) -> float | None:
+    """A float value of the section, None when it is missing or left empty"""
+    value = section.get(key, '').strip()
+    return float(value) if value else None
+
+
+def transport_from_config(section) -> Transport:
+    """Build a Transport from a duo.conf config section. Empty timeouts wait indefinitely."""
+    connect_timeout = _optional_float(section, 'http_connect_timeout')
+    read_timeout = _optional_float(section, 'http_read_timeout')
+    if not section.getboolean('http_pool', fallback=True):
+        return Transport(connect_timeout, read_timeout)
+    return PooledTransport(section.getint('http_pool_size', fallback=10),
+                           pool_block=section.getboolean('http_pool_block', fallback=False),
+                           max_retries=section.getint('http_max_retries', fallback=0),
+                           connect_timeout=connect_timeout,
+                           read_timeout=read_timeout)
@@ -3,10 +3,17 @@ Utility functions
 """
 from __future__ import annotations, print_function
 
+import atexit
+import copy
+import json
 import logging
 import os
-from logging.handlers import RotatingFileHandler
-from typing import LiteralString
+import queue
+import threading
+import time
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import LiteralString, NamedTuple
 
 DEFAULT_LOG_NAME = __name__
 
@@ -38,19 +45,297 @@ class LoggingFormatter(logging.Formatter):
             logging.CRITICAL: '\x1b[1;31;43m'  # Bold (1) Red (31) with Yellow (43) background
     }
 
+    TIME_COLOR = '\x1b[1;30;47m'
+    FORMAT = ("(black){asctime}(reset) | (lvl_color){levelname:8}(reset) | " +
+              "(green){name} | {filename} | " +
+              "(green){module}(reset) | (green){funcName}:{lineno:<4}(reset) | {message}")
+    DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    def __init__(self, use_color: bool = None, stream=None):
+        """Build one formatter per log level up front. Colors are only used when ``stream`` is a terminal,
+        unless ``use_color`` says otherwise, and never when the NO_COLOR environment variable is set."""
+        if use_color is None:
+            use_color = (stream is not None and hasattr(stream, "isatty") and stream.isatty()
+                         and "NO_COLOR" not in os.environ)
+        self.use_color = use_color
+        # Levels without a color of their own (custom levels) fall back to the plain format
+        super().__init__(self._expand(None), self.DATE_FORMAT, style="{")
+        self._formatters = {level: logging.Formatter(self._expand(level), self.DATE_FORMAT, style="{")
+                            for level in self.COLORS}
+
+    def _expand(self, level: int | None) -> str:
+        """Replace the color placeholders of FORMAT, with nothing when colors are disabled"""
+        colored = self.use_color and level is not None
+        replacements = {
+                "(black)":     self.TIME_COLOR if colored else "",
+                "(reset)":     self.reset if colored else "",
+                "(lvl_color)": self.COLORS.get(level, "") if colored else "",
+                "(green)":     self.green + self.bold if colored else "",
+        }
+        format_str = self.FORMAT
+        for placeholder, value in replacements.items():
+            format_str = format_str.replace(placeholder, value)
+        return format_str
+
     def format(self, record):
-        """Method to dynamically color log messages for console output based on message severity"""
-        log_color = self.COLORS[record.levelno]
-        time_color = '\x1b[1;30;47m'
-        format_str = ("(black){asctime}(reset) | (lvl_color){levelname:8}(reset) | " +
-                      "(green){name} | {filename} | " +
-                      "(green){module}(reset) | (green){funcName}:{lineno:<4}(reset) | {message}")
-        format_str = format_str.replace("(black)", time_color)
-        format_str = format_str.replace("(reset)", self.reset)
-        format_str = format_str.replace("(lvl_color)", log_color)
-        format_str = format_str.replace("(green)", self.green + self.bold)
-        formatter = logging.Formatter(format_str, "%Y-%m-%d %H:%M:%S", style="{")
-        return formatter.format(record)
+        """Format with the pre-built formatter for the severity of the record"""
+        return self._formatters.get(record.levelno, super()).format(record)
+
+
+class JSONFormatter(logging.Formatter):
+    """Formatter writing one JSON object per record, for log collectors"""
+
+    FIELDS = ("name", "levelname", "filename", "module", "funcName", "lineno", "process", "threadName")
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S%z"), "message": record.getMessage()}
+        for field in self.FIELDS:
+            entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class SizeTimeRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler that also rolls over every ``rotate_interval`` seconds.
+
+    When ``batched`` is set the stream is only flushed by flush(), e.g. once per batch by a
+    BatchingQueueListener, instead of after every record.
+    """
+
+    def __init__(self, filename: str, /, *,
+                 max_bytes: int = 0,
+                 backup_count: int = 0,
+                 rotate_interval: float = 0,
+                 encoding: str = None):
+        # The file is opened by the first record, not when the logger is created
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding=encoding, delay=True)
+        self.rotate_interval = rotate_interval
+        self.rollover_at = time.time() + rotate_interval if rotate_interval else None
+        self.batched = False
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.rollover_at is not None:
+            self.rollover_at = time.time() + self.rotate_interval
+
+    def emit(self, record):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+            if not self.batched:
+                self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """QueueHandler for a bounded queue that either drops records or blocks when the queue is full.
+
+    Records are only made safe to pass to another thread here. Formatting is left to the
+    handlers of the listener thread.
+    """
+
+    def __init__(self, log_queue: queue.Queue, policy: str = "drop"):
+        super().__init__(log_queue)
+        self.policy = policy
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        # Merge the arguments now, they may be changed by the caller after this returns
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        if self.policy == "block":
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+
+class BatchingQueueListener(QueueListener):
+    """QueueListener that takes up to ``batch_size`` waiting records at a time and flushes its
+    handlers once per batch"""
+
+    def __init__(self, log_queue: queue.Queue, *handlers, batch_size: int = 100):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        q = self.queue
+        while True:
+            batch = [q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = False
+            for record in batch:
+                q.task_done()
+                if record is self._sentinel:
+                    stop = True
+                else:
+                    self.handle(record)
+            for handler in self.handlers:
+                try:
+                    handler.flush()
+                except (OSError, ValueError):
+                    # A closed or failing stream must not stop the writer thread for the other sinks
+                    pass
+            if stop:
+                break
+
+
+class _LoggerConfig(NamedTuple):
+    """Sinks configured for a registered logger, compared to decide whether a call changes anything"""
+    log_to_console: bool
+    logfile_path: str | None
+    log_message_format: str
+    log_json: bool
+    max_bytes: int
+    backup_count: int
+    rotate_interval: float
+    use_queue: bool
+    queue_size: int
+    queue_policy: str
+    batch_size: int
+
+
+# Registered logger name -> (config, handlers attached to the logger, listener or None, sink handlers)
+_REGISTRY = {}
+# Sink key -> handler, shared by every logger writing to the same console or file
+_SINKS = {}
+_LISTENERS = set()
+_REGISTRY_LOCK = threading.RLock()
+
+
+def _sink(key: tuple, settings: tuple, factory) -> logging.Handler:
+    """The shared handler of a sink, rebuilt when it was opened with other ``settings``.
+
+    A file has a single writer: loggers still using the previous handler switch to the new one.
+    """
+    handler = _SINKS.get(key)
+    if handler is not None and handler.sink_settings == settings:
+        return handler
+    new = _SINKS[key] = factory()
+    new.sink_settings = settings
+    if handler is not None:
+        for name, (config, attached, listener, sinks) in _REGISTRY.items():
+            if handler not in sinks:
+                continue
+            sinks[sinks.index(handler)] = new
+            if listener is not None:
+                listener.handlers = tuple(new if h is handler else h for h in listener.handlers)
+            else:
+                # attached is the sinks list itself for loggers without a queue
+                logger = logging.getLogger(name)
+                logger.removeHandler(handler)
+                logger.addHandler(new)
+        handler.close()
+    return new
+
+
+def _close_unused_sinks():
+    used = {id(handler) for _, _, _, sinks in _REGISTRY.values() for handler in sinks}
+    for key, handler in list(_SINKS.items()):
+        if id(handler) not in used:
+            del _SINKS[key]
+            handler.close()
+
+
+def _sinks_for(config: _LoggerConfig) -> list[logging.Handler]:
+    handlers = []
+    if config.log_to_console:
+        def console():
+            handler = logging.StreamHandler()
+            handler.setFormatter(JSONFormatter() if config.log_json else LoggingFormatter(stream=handler.stream))
+            return handler
+        handlers.append(_sink(("console", config.log_json), (), console))
+
+    if config.logfile_path is not None:
+        def logfile():
+            os.makedirs(os.path.dirname(config.logfile_path), exist_ok=True)
+            handler = SizeTimeRotatingFileHandler(config.logfile_path,
+                                                  max_bytes=config.max_bytes,
+                                                  backup_count=config.backup_count,
+                                                  rotate_interval=config.rotate_interval,
+                                                  encoding="utf-8")
+            if config.log_json:
+                handler.setFormatter(JSONFormatter())
+            else:
+                handler.setFormatter(logging.Formatter(config.log_message_format, "%Y-%m-%d %H:%M:%S", style="{"))
+            return handler
+        # The last logger configured for a file decides its format and rotation
+        settings = (config.log_message_format, config.log_json, config.max_bytes, config.backup_count,
+                    config.rotate_interval)
+        handlers.append(_sink(("file", config.logfile_path), settings, logfile))
+    return handlers
+
+
+def _update_batching():
+    """File sinks skip the per-record flush only while every logger using them goes through a listener"""
+    direct = {id(handler) for config, handlers, listener, sinks in _REGISTRY.values() if listener is None
+              for handler in handlers}
+    for handler in _SINKS.values():
+        if isinstance(handler, SizeTimeRotatingFileHandler):
+            handler.batched = id(handler) not in direct
+
+
+def _start_queue_listener(handlers: list, config: _LoggerConfig) -> tuple[BoundedQueueHandler, QueueListener]:
+    """Route records through a bounded queue to a background thread that owns the real handlers"""
+    log_queue = queue.Queue(maxsize=config.queue_size)
+    listener = BatchingQueueListener(log_queue, *handlers, batch_size=config.batch_size)
+    queue_handler = BoundedQueueHandler(log_queue, config.queue_policy)
+    listener.queue_handler = queue_handler
+    listener.pid = os.getpid()
+    listener.start()
+    _LISTENERS.add(listener)
+    return queue_handler, listener
+
+
+def _stop_listeners():
+    for listener in list(_LISTENERS):
+        listener.stop()
+    _LISTENERS.clear()
+
+
+def restart_listeners_after_fork():
+    """Start the queue listener threads again in a forked server worker, they do not survive fork().
+
+    Call it from the worker start up hook (e.g. gunicorn's post_worker_init), not from an at-fork hook,
+    which would also start them in every bcrypt pool process. Does nothing in the process that started them.
+    """
+    with _REGISTRY_LOCK:
+        for listener in _LISTENERS:
+            if listener.pid == os.getpid():
+                continue
+            listener.queue = listener.queue_handler.queue = queue.Queue(maxsize=listener.queue.maxsize)
+            listener._thread = None
+            listener.pid = os.getpid()
+            listener.start()
+
+
+atexit.register(_stop_listeners)
 
 
 def get_logger(
@@ -61,38 +346,202 @@ def get_logger(
         log_to_console: bool = True,
         log_to_file: bool = True,
         logfile_name: str = None,
-        log_message_format: LiteralString = None) -> logging.Logger:
-    """Create a logging instance and return a logger"""
-    if logfile_name is None:
-        logger_name = DEFAULT_LOG_NAME
-    if logger_name in LOGGERS:
-        logger = LOGGERS[logger_name]
-        logger.info("Existing logger instance found.")
-    else:
-        logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.getLevelName(log_level))
-    logger.propagate = False
+        log_message_format: LiteralString = None,
+        log_json: bool = False,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 5,
+        rotate_interval: float = 0,
+        use_queue: bool = False,
+        queue_size: int = 10000,
+        queue_policy: str = "drop",
+        batch_size: int = 100) -> logging.Logger:
+    """Create or reconfigure a logger and return it.
+
+    Calls are idempotent per logger name: repeating a call returns the registered logger without
+    adding handlers, a changed level is applied in place and changed sinks replace the previous ones.
+    Console and file handlers are shared by all loggers writing to the same sink, changed file settings
+    (format, JSON, rotation) reopen the file for all of them.
 
+    Log files roll over at ``max_bytes`` and/or every ``rotate_interval`` seconds. With ``use_queue``
+    the calling thread only puts records on a bounded queue (``queue_policy`` "drop" or "block" when it
+    is full) and a background thread formats and writes them in batches of up to ``batch_size``.
+    """
+    if logger_name is None:
+        logger_name = DEFAULT_LOG_NAME
     if log_message_format is None:
         # log_message_format = "[{asctime}] [{levelname:<8}] {name}: {message}"
         log_message_format = ("{asctime} | {levelname:8} | {name:<10} | {filename:<15} | " +
                               "{module:<12} | {funcName:>15}():{lineno:_^4} | {message}")
+    logfile_path = None
+    if log_to_file:
+        logfile_path = os.path.join(os.getcwd(), 'logs', logfile_name or logger_name + '.log')
+    config = _LoggerConfig(log_to_console, logfile_path, log_message_format, log_json, max_bytes, backup_count,
+                           rotate_interval, use_queue, queue_size, queue_policy, batch_size)
 
-    # Console handler
-    if log_to_console:
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(LoggingFormatter())
-        logger.addHandler(console_handler)
+    with _REGISTRY_LOCK:
+        logger = logging.getLogger(logger_name)
+        logger.setLevel(logging.getLevelName(log_level))
+        logger.propagate = False
+        registered = _REGISTRY.get(logger_name)
+        if registered is not None and registered[0] == config:
+            return logger
+        if registered is not None:
+            remove_logger(logger_name)
 
-    # File handler
-    if log_to_file:
-        if logfile_name is None:
-            logfile_name = logger_name + '.log'
-        log_path = os.path.join(os.getcwd(), 'logs', logfile_name)
-        file_handler = RotatingFileHandler(filename=log_path, encoding="utf-8")
-        file_handler_formatter = logging.Formatter(log_message_format, "%Y-%m-%d %H:%M:%S", style="{")
-        file_handler.setFormatter(file_handler_formatter)
-        logger.addHandler(file_handler)
+        handlers = _sinks_for(config)
+        listener = None
+        if use_queue:
+            queue_handler, listener = _start_queue_listener(handlers, config)
+            attached = [queue_handler]
+        else:
+            attached = handlers
+        for handler in attached:
+            logger.addHandler(handler)
+        _REGISTRY[logger_name] = (config, attached, listener, handlers)
+        LOGGERS[logger_name] = logger
+        _update_batching()
     logger.info(" --- [ Logging started for %s ] ---", logger_name)
-    LOGGERS[logger_name] = logger
     return logger
+
+
+def logging_options_from_config(section) -> dict:
+    """get_logger() keyword arguments from the ``log_*`` values of a duo.conf section"""
+    queue_policy = section.get('log_queue_policy', fallback='drop').lower()
+    if queue_policy not in ("drop", "block"):
+        raise ValueError(f"Unknown log_queue_policy '{queue_policy}'")
+    return {
+            "log_level":       section.get('log_level', fallback='INFO').upper(),
+            "log_json":        section.getboolean('log_json', fallback=False),
+            "max_bytes":       section.getint('log_max_mb', fallback=10) * 1024 * 1024,
+            "backup_count":    section.getint('log_backup_count', fallback=5),
+            "rotate_interval": section.getfloat('log_rotate_interval', fallback=0.0),
+            "queue_size":      section.getint('log_queue_size', fallback=10000),
+            "queue_policy":    queue_policy,
+            "batch_size":      section.getint('log_batch_size', fallback=100),
+    }
+
+
+def log_queue_stats() -> dict:
+    """Records waiting and records dropped because the queue was full, by (logger, stat), for queued loggers"""
+    with _REGISTRY_LOCK:
+        registered = [(name, attached[0]) for name, (config, attached, listener, sinks) in _REGISTRY.items()
+                      if listener is not None]
+    return {(name, stat): value for name, handler in registered
+            for stat, value in (("queued", handler.queue.qsize()), ("dropped", handler.dropped))}
+
+
+def remove_logger(logger_name: str = None):
+    """Detach the handlers get_logger() added to a logger and stop its queue listener. Sinks that no other
+    logger writes to are closed."""
+    logger_name = logger_name or DEFAULT_LOG_NAME
+    with _REGISTRY_LOCK:
+        registered = _REGISTRY.pop(logger_name, None)
+        LOGGERS.pop(logger_name, None)
+        if registered is None:
+            return
+        _, attached, listener, _ = registered
+        logger = logging.getLogger(logger_name)
+        for handler in attached:
+            logger.removeHandler(handler)
+        if listener is not None:
+            listener.stop()
+            _LISTENERS.discard(listener)
+        _close_unused_sinks()
+        _update_batching()
+
+
+class TTLCache:
+    """Thread-safe bounded LRU cache whose entries expire after ``ttl`` seconds"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                    "size":        len(self._data),
+                    "hits":        self.hits,
+                    "misses":      self.misses,
+                    "evictions":   self.evictions,
+                    "expirations": self.expirations,
+            }
+
+
+class LazyValue:
+    """Value built by ``factory`` on first use. Thread-safe, the factory runs at most once."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._value = None
+        self._built = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self._value = self._factory()
+                    self._built = True
+        return self._value
+
+    @property
+    def is_built(self) -> bool:
+        return self._built
+
+
+def start_periodic_dump(snapshot, logger: logging.Logger, interval: float = 60.0, /, *,
+                        label: str = "Metrics") -> threading.Event:
+    """Log ``snapshot()`` as JSON every ``interval`` seconds from a daemon thread. Set the returned event to stop."""
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                logger.info("%s: %s", label, json.dumps(snapshot(), sort_keys=True, default=str))
+            except Exception:
+                logger.exception("Unable to dump %s", label.lower())
+
+    threading.Thread(target=run, name="duo-metrics-dump", daemon=True).start()
+    return stop
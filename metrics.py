@@ -0,0 +1,198 @@
+"""
+Counters and latency histograms rendered in the Prometheus text exposition format
+
+Metrics are kept per process. With several server workers each worker reports its own values,
+scrape them through the worker that answers or aggregate in Prometheus.
+"""
+from __future__ import annotations, print_function
+
+import bisect
+import math
+import threading
+import time
+from typing import Callable
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a cached lookup up to a slow bcrypt check or Duo round trip
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with optional labels. By convention the name ends in ``_total``."""
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            yield self.name, labels, "", value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {",".join(labels) or self.name: value for labels, value in self._values.items()}
+
+
+class _Timer:
+    """Context manager that observes the elapsed time into a histogram"""
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+class Histogram:
+    """Cumulative histogram with fixed upper bounds, one series per label combination"""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def time(self, *labels) -> _Timer:
+        """``with histogram.time("stage"):`` observes the duration of the block"""
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._series.items())
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield self.name + "_bucket", labels, f'le="{_format_value(bound)}"', cumulative
+            yield self.name + "_sum", labels, "", total
+            yield self.name + "_count", labels, "", cumulative
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {",".join(labels) or self.name: {"count": sum(counts),
+                                                    "mean_seconds": total / sum(counts) if sum(counts) else 0.0}
+                    for labels, (counts, total) in self._series.items()}
+
+
+class Gauge:
+    """Gauge read from a callback when rendered, e.g. the statistics another component already keeps.
+
+    The callback returns a number, or a dictionary of label value -> number for a single label
+    (a tuple of label values for several labels).
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Callable, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+
+    def _read(self) -> dict:
+        value = self.callback()
+        if isinstance(value, dict):
+            return {tuple(map(str, key)) if isinstance(key, tuple) else (str(key),): number
+                    for key, number in value.items() if isinstance(number, (int, float))}
+        return {(): value}
+
+    def samples(self):
+        for labels, value in sorted(self._read().items()):
+            yield self.name, labels, "", value
+
+    def snapshot(self) -> dict:
+        return {",".join(labels) or self.name: value for labels, value in self._read().items()}
+
+
+class MetricsRegistry:
+    """A set of metrics rendered together on /metrics"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            # Registering a name again returns the existing metric, so configure() can run more than once
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._add(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, callback: Callable, labelnames: tuple = ()) -> Gauge:
+        with self._lock:
+            # Callbacks are replaced, they usually refer to objects rebuilt by configure()
+            gauge = self._metrics[name] = Gauge(name, documentation, callback, labelnames)
+        return gauge
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, extra, value in metric.samples():
+                lines.append(f"{name}{_format_labels(metric.labelnames, labels, extra)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Compact dictionary of all metrics, for logging"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
@@ -0,0 +1,227 @@
+"""
+Password hashing service running bcrypt in a bounded process pool
+"""
+from __future__ import annotations, print_function
+
+import asyncio
+import itertools
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+import bcrypt
+
+import profiling
+
+DEFAULT_ROUNDS = 12
+# $2a$, $2b$ or $2y$, a two digit cost factor, then 22 characters of salt and 31 of hash
+BCRYPT_PATTERN = re.compile(r"\$2[aby]\$[0-9]{2}\$[./A-Za-z0-9]{53}")
+# bcrypt only uses the first 72 bytes, bcrypt 5 raises ValueError for longer passwords
+MAX_PASSWORD_BYTES = 72
+
+
+class HasherBusy(Exception):
+    """Raised when the hashing queue is full or an operation timed out"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class InvalidPassword(ValueError):
+    """Raised for a password that is missing or not a string, e.g. a form without the field, or too long for bcrypt"""
+
+
+def _encode(password) -> bytes:
+    if not isinstance(password, str):
+        raise InvalidPassword("Password is missing.")
+    encoded = password.encode("utf-8")
+    if len(encoded) > MAX_PASSWORD_BYTES:
+        raise InvalidPassword(f"Password is longer than {MAX_PASSWORD_BYTES} bytes.")
+    return encoded
+
+
+def _hash_password(password: bytes, rounds: int) -> str:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode()
+
+
+def _check_password(pw_hash: bytes, password: bytes) -> bool:
+    return bcrypt.checkpw(password, pw_hash)
+
+
+def hash_rounds(pw_hash: str) -> int:
+    """Return the cost factor of a bcrypt hash such as ``$2b$12$...``"""
+    try:
+        return int(pw_hash.split("$")[2])
+    except (IndexError, ValueError):
+        return 0
+
+
+def is_bcrypt_hash(pw_hash) -> bool:
+    """Whether a value is a bcrypt hash check() can verify, e.g. a hash from a user import"""
+    return isinstance(pw_hash, str) and BCRYPT_PATTERN.fullmatch(pw_hash) is not None
+
+
+class OperationStats:
+    """Call count and timing for a single hashing operation"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.rejected = 0
+
+    def as_dict(self) -> dict:
+        return {
+                "count":        self.count,
+                "rejected":     self.rejected,
+                "mean_seconds": self.total_seconds / self.count if self.count else 0.0,
+                "max_seconds":  self.max_seconds,
+        }
+
+
+class PasswordHasher:
+    """Hash and verify passwords with bcrypt in a pool of worker processes.
+
+    At most ``max_workers + max_queue`` operations are admitted at a time, anything beyond
+    that is rejected right away with HasherBusy so the caller can answer with a 503.
+    """
+
+    def __init__(self,
+                 rounds: int = DEFAULT_ROUNDS,
+                 /,
+                 *,
+                 max_workers: int = None,
+                 max_queue: int = None,
+                 timeout: float = 10.0):
+        self.rounds = rounds
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_queue = max_queue if max_queue is not None else self.max_workers * 4
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.max_queue)
+        self._executor = None
+        self._lock = threading.Lock()
+        self.stats = {"hash": OperationStats(), "check": OperationStats()}
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        # Worker processes are started on first use, not at import time
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def _admit(self, stats: OperationStats):
+        """Take a slot in the bounded queue or reject the operation"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                stats.rejected += 1
+            raise HasherBusy("Password hashing queue is full.", retry_after=max(1, round(self.timeout / 4)))
+
+    def _timed_out(self, stats: OperationStats) -> HasherBusy:
+        with self._lock:
+            stats.rejected += 1
+        return HasherBusy("Password hashing timed out.", retry_after=max(1, round(self.timeout / 2)))
+
+    def _submit(self, stats: OperationStats, fn, *args):
+        """Run fn in a worker process in an admitted slot, which is freed once the worker is done with it"""
+        self._admit(stats)
+        start = time.perf_counter()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self._release(stats, start)
+            raise
+        # Not freed on a timeout: the worker is still busy and the queue must not grow past its bound
+        future.add_done_callback(lambda _: self._release(stats, start))
+        return future
+
+    def _release(self, stats: OperationStats, start: float):
+        self._slots.release()
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            stats.count += 1
+            stats.total_seconds += elapsed
+            stats.max_seconds = max(stats.max_seconds, elapsed)
+
+    def _run(self, operation: str, fn, *args):
+        stats = self.stats[operation]
+        with profiling.span(f"bcrypt {operation}"):
+            future = self._submit(stats, fn, *args)
+            try:
+                return future.result(timeout=self.timeout)
+            except FutureTimeoutError:
+                # Frees the slot right away if no worker picked it up yet
+                future.cancel()
+                raise self._timed_out(stats)
+
+    async def _run_async(self, operation: str, fn, *args):
+        """Same as _run() but awaits the worker process instead of blocking the event loop"""
+        stats = self.stats[operation]
+        future = self._submit(stats, fn, *args)
+        try:
+            # On a timeout wait_for() cancels the future, which only frees the slot if it was still queued
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise self._timed_out(stats)
+
+    def hash(self, password: str) -> str:
+        """Return a bcrypt hash of the password using the configured cost factor"""
+        return self._run("hash", _hash_password, _encode(password), self.rounds)
+
+    def check(self, pw_hash: str, password: str) -> bool:
+        """Verify a password against a stored bcrypt hash, False if there is none"""
+        password = _encode(password)
+        if not pw_hash:
+            return False
+        return self._run("check", _check_password, pw_hash.encode("utf-8"), password)
+
+    async def hash_async(self, password: str) -> str:
+        """Non-blocking hash()"""
+        return await self._run_async("hash", _hash_password, _encode(password), self.rounds)
+
+    async def check_async(self, pw_hash: str, password: str) -> bool:
+        """Non-blocking check()"""
+        password = _encode(password)
+        if not pw_hash:
+            return False
+        return await self._run_async("check", _check_password, pw_hash.encode("utf-8"), password)
+
+    def hash_many(self, passwords: list[str]) -> list[str]:
+        """Hash a batch of passwords across all workers, e.g. for bulk imports. Bypasses the request queue limit."""
+        if not passwords:
+            return []
+        stats = self.stats["hash"]
+        start = time.perf_counter()
+        chunksize = max(1, len(passwords) // (self.max_workers * 4))
+        hashes = list(self.executor.map(_hash_password,
+                                        (_encode(password) for password in passwords),
+                                        itertools.repeat(self.rounds),
+                                        chunksize=chunksize))
+        with self._lock:
+            stats.count += len(passwords)
+            stats.total_seconds += time.perf_counter() - start
+        return hashes
+
+    def needs_rehash(self, pw_hash: str) -> bool:
+        """Return True if the stored hash was created with a lower cost factor than configured"""
+        return hash_rounds(pw_hash) < self.rounds
+
+    def get_stats(self) -> dict:
+        return {operation: stats.as_dict() for operation, stats in self.stats.items()}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def hasher_from_config(section) -> PasswordHasher:
+    """Build a PasswordHasher from a duo.conf config section"""
+    return PasswordHasher(section.getint('bcrypt_rounds', fallback=DEFAULT_ROUNDS),
+                          max_workers=section.getint('hash_workers', fallback=None),
+                          max_queue=section.getint('hash_queue_size', fallback=None),
+                          timeout=section.getfloat('hash_timeout', fallback=10.0))
@@ -0,0 +1,338 @@
+"""
+Sampled per-request span trees: time spent in database queries, bcrypt, Duo HTTP requests, template
+rendering and logging, a ring buffer of the slow requests and output for flame graph tools
+"""
+from __future__ import annotations, print_function
+
+import collections
+import contextvars
+import hmac
+import ipaddress
+import logging
+import random
+import threading
+import time
+from typing import Callable
+
+# The trace of the request being handled, None when the request is not sampled
+_current = contextvars.ContextVar("duo_trace", default=None)
+
+
+class Span:
+    __slots__ = ("name", "detail", "start", "end", "children")
+
+    def __init__(self, name: str, detail: str = None):
+        self.name = name
+        self.detail = detail
+        self.start = time.perf_counter()
+        self.end = None
+        self.children = []
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self, origin: float) -> dict:
+        span = {"name": self.name, "start_ms": round((self.start - origin) * 1000, 3),
+                "duration_ms": round(self.duration * 1000, 3)}
+        if self.detail:
+            span["detail"] = self.detail
+        if self.children:
+            span["children"] = [child.to_dict(origin) for child in self.children]
+        return span
+
+
+class Trace:
+    """The spans of one request, only used by the thread handling it"""
+
+    def __init__(self, environ: dict):
+        self.environ = environ
+        self.method = environ.get("REQUEST_METHOD", "GET")
+        self.started_at = time.time()
+        self.root = Span("request")
+        self.status = None
+        self.path = environ.get("PATH_INFO", "")
+        self.tenant = None
+        self._stack = [self.root]
+
+    def open(self, name: str, detail: str = None) -> Span:
+        span = Span(name, detail)
+        self._stack[-1].children.append(span)
+        self._stack.append(span)
+        return span
+
+    def close(self, span: Span):
+        span.end = time.perf_counter()
+        # Spans closed out of order (a hook that never fired) close their open children too
+        while len(self._stack) > 1:
+            if self._stack.pop() is span:
+                break
+
+    def finish(self):
+        for span in reversed(self._stack):
+            if span.end is None:
+                span.end = time.perf_counter()
+        # Read at the end, after the tenant dispatcher has routed the request
+        self.path = self.environ.get("SCRIPT_NAME", "") + self.environ.get("PATH_INFO", "")
+        # duo_tenants.ENVIRON_KEY, not imported to keep this module free of the Flask imports
+        self.tenant = self.environ.get("duo.tenant")
+
+    @property
+    def duration(self) -> float:
+        return self.root.duration
+
+    def to_dict(self) -> dict:
+        return {"method": self.method, "path": self.path, "tenant": self.tenant, "status": self.status,
+                "started_at": self.started_at, "duration_ms": round(self.duration * 1000, 3),
+                "spans": self.root.to_dict(self.root.start).get("children", [])}
+
+    def folded(self) -> dict[str, int]:
+        """Self time in microseconds by semicolon separated stack, the input format of flamegraph.pl"""
+        stacks = collections.Counter()
+
+        def walk(span: Span, stack: str):
+            self_time = span.duration - sum(child.duration for child in span.children)
+            stacks[stack] += max(0, round(self_time * 1e6))
+            for child in span.children:
+                walk(child, f"{stack};{child.name}")
+
+        walk(self.root, f"{self.method} {self.path}")
+        return stacks
+
+
+class _NoSpan:
+    """Returned by span() outside of sampled requests, costs one context variable lookup"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _SpanContext:
+    __slots__ = ("trace", "name", "detail", "span")
+
+    def __init__(self, trace: Trace, name: str, detail: str = None):
+        self.trace = trace
+        self.name = name
+        self.detail = detail
+
+    def __enter__(self) -> Span:
+        self.span = self.trace.open(self.name, self.detail)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.trace.close(self.span)
+        return False
+
+
+def span(name: str, detail: str = None):
+    """``with profiling.span("bcrypt"):`` records the block in the trace of a sampled request"""
+    trace = _current.get()
+    if trace is None:
+        return _NO_SPAN
+    return _SpanContext(trace, name, detail)
+
+
+def open_span(name: str, detail: str = None) -> Span | None:
+    """For hooks with separate start and end callbacks, pass the result to close_span()"""
+    trace = _current.get()
+    return trace.open(name, detail) if trace is not None else None
+
+
+def close_span(opened: Span | None):
+    trace = _current.get()
+    if opened is not None and trace is not None:
+        trace.close(opened)
+
+
+class Profiler:
+    """Traces ``sample_rate`` of the requests (0 to 1). Traced requests that take ``slow_threshold``
+    seconds or more are kept in a ring buffer of ``buffer_size`` traces, per process."""
+
+    def __init__(self,
+                 sample_rate: float = 0.01,
+                 /,
+                 *,
+                 slow_threshold: float = 0.5,
+                 buffer_size: int = 100,
+                 logger: logging.Logger = None):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.slow = collections.deque(maxlen=buffer_size)
+        self.counters = {"requests": 0, "sampled": 0, "slow": 0}
+        # Guards the ring buffer and the counters, every request thread updates them
+        self._lock = threading.Lock()
+
+    def _count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def sample(self, environ: dict) -> Trace | None:
+        self._count("requests")
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        self._count("sampled")
+        return Trace(environ)
+
+    def record(self, trace: Trace):
+        trace.finish()
+        if trace.duration < self.slow_threshold:
+            return
+        with self._lock:
+            self.counters["slow"] += 1
+            self.slow.append(trace)
+        self.logger.warning("Slow request %s %s took %.0f ms: %s", trace.method, trace.path, trace.duration * 1000,
+                            ", ".join(f"{child.name} {child.duration * 1000:.0f} ms" for child in trace.root.children)
+                            or "no spans")
+
+    def traces(self) -> list[dict]:
+        """The slow requests in the buffer, newest first"""
+        return [trace.to_dict() for trace in reversed(self._snapshot())]
+
+    def folded(self) -> str:
+        """The slow requests as collapsed stacks (microseconds), for flamegraph.pl, inferno or speedscope"""
+        stacks = collections.Counter()
+        for trace in self._snapshot():
+            stacks.update(trace.folded())
+        return "".join(f"{stack} {value}\n" for stack, value in sorted(stacks.items()) if value)
+
+    def _snapshot(self) -> list[Trace]:
+        with self._lock:
+            return list(self.slow)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.counters, "buffered": len(self.slow)}
+
+
+class EndpointAccess:
+    """Who may read the traces: clients whose address is in one of the ``allowed`` networks, or requests
+    with an ``Authorization: Bearer <token>`` header when ``token`` is set. Nobody when neither is set.
+
+    Behind a reverse proxy the client address is the proxy's unless ProxyFix is configured, so allowing
+    loopback there allows every client of the proxy; use a token instead."""
+
+    def __init__(self, allowed=(), /, *, token: str = None):
+        self.allowed = tuple(ipaddress.ip_network(network.strip(), strict=False) for network in allowed)
+        self.token = token or None
+
+    def permits(self, remote_addr: str | None, authorization: str | None = None) -> bool:
+        if self.token is not None:
+            scheme, _, credentials = (authorization or "").partition(" ")
+            if scheme.lower() == "bearer" and hmac.compare_digest(credentials.strip().encode(), self.token.encode()):
+                return True
+        try:
+            address = ipaddress.ip_address(remote_addr or "")
+        except ValueError:
+            return False
+        return any(address in network for network in self.allowed)
+
+
+def profiling_middleware(wsgi_app, profiler: Callable[[], Profiler | None]):
+    """WSGI middleware that traces the requests the profiler samples"""
+
+    def wrapper(environ, start_response):
+        current = profiler()
+        trace = current.sample(environ) if current is not None else None
+        if trace is None:
+            return wsgi_app(environ, start_response)
+
+        def capture_status(status, headers, exc_info=None):
+            trace.status = int(status.split(" ", 1)[0])
+            return start_response(status, headers, exc_info)
+
+        token = _current.set(trace)
+        try:
+            # Flask renders the whole response before returning it
+            return wsgi_app(environ, capture_status)
+        finally:
+            _current.reset(token)
+            current.record(trace)
+
+    return wrapper
+
+
+_instrumented = set()
+
+
+def instrument_sqlalchemy():
+    """Record every query of every SQLAlchemy engine as a span"""
+    if "sqlalchemy" in _instrumented:
+        return
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        opened = open_span("db " + (statement.split(None, 1) or ["query"])[0].upper(), statement[:200])
+        if opened is not None:
+            conn.info.setdefault("duo_spans", []).append(opened)
+
+    def after(conn, *args):
+        spans = conn.info.get("duo_spans")
+        if spans:
+            close_span(spans.pop())
+
+    event.listen(Engine, "before_cursor_execute", before)
+    event.listen(Engine, "after_cursor_execute", after)
+    event.listen(Engine, "handle_error", lambda context: after(context.connection) if context.connection else None)
+    _instrumented.add("sqlalchemy")
+
+
+def instrument_logging(logger: logging.Logger):
+    """Record the time the handlers of ``logger`` take on the request thread as spans"""
+    for handler in logger.handlers:
+        if getattr(handler, "_duo_traced", False):
+            continue
+
+        def emit(record, _emit=handler.emit):
+            with span("logging"):
+                _emit(record)
+
+        handler.emit = emit
+        handler._duo_traced = True
+
+
+def instrument_templates(app):
+    """Record Jinja template rendering of a Flask app as spans"""
+    if ("templates", app) in _instrumented:
+        return
+    from flask import before_render_template, g, template_rendered
+
+    def before(sender, template, context, **extra):
+        opened = open_span("render", template.name)
+        if opened is not None:
+            g.setdefault("_duo_render_spans", []).append(opened)
+
+    def after(sender, template, context, **extra):
+        spans = g.get("_duo_render_spans")
+        if spans:
+            close_span(spans.pop())
+
+    before_render_template.connect(before, app, weak=False)
+    template_rendered.connect(after, app, weak=False)
+    _instrumented.add(("templates", app))
+
+
+def endpoint_access_from_config(section) -> EndpointAccess:
+    """Build the /admin/profile access check from ``profile_allowed_ips`` and ``profile_token``,
+    raises ValueError for an address or network that does not parse"""
+    allowed = [network for network in section.get('profile_allowed_ips', fallback='').split(",") if network.strip()]
+    return EndpointAccess(allowed, token=section.get('profile_token', fallback=''))
+
+
+def profiler_from_config(section, logger: logging.Logger = None) -> Profiler | None:
+    """Build the profiler from the ``profile_*`` values of a duo.conf section, None if sampling is off"""
+    sample_rate = section.getfloat('profile_sample_rate', fallback=0.0)
+    if sample_rate <= 0:
+        return None
+    return Profiler(min(sample_rate, 1.0),
+                    slow_threshold=section.getfloat('profile_slow_ms', fallback=500.0) / 1000,
+                    buffer_size=section.getint('profile_buffer_size', fallback=100),
+                    logger=logger)
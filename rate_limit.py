@@ -0,0 +1,227 @@
+"""
+Token bucket rate limiting of login attempts by client IP and by username
+"""
+from __future__ import annotations, print_function
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a client IP or username has no tokens left"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimit(NamedTuple):
+    """Up to ``burst`` attempts at once, refilled evenly over ``period`` seconds"""
+    burst: int
+    period: float
+
+    @property
+    def rate(self) -> float:
+        return self.burst / self.period
+
+
+def _take(tokens: float, updated: float, now: float, limit: RateLimit) -> tuple[float, float]:
+    """Refill a bucket and take one token. Returns the new token count and the seconds to wait (0 if allowed)."""
+    tokens = min(limit.burst, tokens + (now - updated) * limit.rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / limit.rate
+
+
+class RateLimiterBackend:
+    """Storage for token buckets. Buckets that are full again are idle and can be forgotten."""
+
+    def __init__(self, sweep_interval: float = 60.0):
+        self.sweep_interval = sweep_interval
+        self._stop = threading.Event()
+        self._sweeper = None
+
+    def hit(self, key: str, limit: RateLimit) -> float:
+        """Take a token from the bucket for ``key``, return 0 if allowed or the seconds until the next token"""
+        raise NotImplementedError
+
+    def sweep(self, max_period: float) -> int:
+        """Forget buckets untouched for ``max_period`` seconds, return the number removed"""
+        raise NotImplementedError
+
+    def start_sweeper(self, max_period: float, interval: float = None):
+        """Start a background thread that removes idle buckets every ``interval`` seconds"""
+        if self._sweeper is not None and self._sweeper.is_alive():
+            return
+        interval = interval or self.sweep_interval
+
+        def run():
+            while not self._stop.wait(interval):
+                self.sweep(max_period)
+
+        self._stop.clear()
+        self._sweeper = threading.Thread(target=run, name="duo-ratelimit-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._stop.set()
+        self._sweeper = None
+
+
+class MemoryRateLimiter(RateLimiterBackend):
+    """Buckets in an LRU ordered dictionary of at most ``max_keys`` entries, per process
+
+    Beyond ``max_keys`` the least recently used bucket is dropped even if it is not full again, and its
+    key starts over with a full burst. Someone trying more than ``max_keys`` usernames or addresses
+    within a period therefore resets the limits of the oldest ones: size ``max_keys`` above the keys
+    expected in ``ratelimit_user_period`` and watch ``evictions``.
+    """
+
+    def __init__(self, max_keys: int = 100000, sweep_interval: float = 60.0):
+        super().__init__(sweep_interval)
+        self.max_keys = max_keys
+        self.evictions = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key: str, limit: RateLimit) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (limit.burst, now))
+            tokens, wait = _take(tokens, updated, now, limit)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                # The least recently used bucket, most likely idle and full again
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+        return wait
+
+    def sweep(self, max_period: float) -> int:
+        cutoff = time.monotonic() - max_period
+        removed = 0
+        with self._lock:
+            # Oldest first, stop at the first bucket used after the cutoff
+            while self._buckets:
+                key, (_, updated) = next(iter(self._buckets.items()))
+                if updated >= cutoff:
+                    break
+                del self._buckets[key]
+                removed += 1
+        return removed
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SQLiteRateLimiter(RateLimiterBackend):
+    """Buckets in a SQLite file shared by all worker processes on a host, e.g. on /dev/shm"""
+
+    def __init__(self, path: str, sweep_interval: float = 60.0):
+        super().__init__(sweep_interval)
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS duo_ratelimit "
+                     "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS duo_ratelimit_updated ON duo_ratelimit (updated)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def hit(self, key: str, limit: RateLimit) -> float:
+        now = time.time()
+        conn = self._connect()
+        # IMMEDIATE takes the write lock up front, so two workers can not both take the last token
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM duo_ratelimit WHERE key = ?", (key,)).fetchone()
+            tokens, wait = _take(*(row or (limit.burst, now)), now, limit)
+            conn.execute("INSERT OR REPLACE INTO duo_ratelimit (key, tokens, updated) VALUES (?, ?, ?)",
+                         (key, tokens, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def sweep(self, max_period: float) -> int:
+        return self._connect().execute("DELETE FROM duo_ratelimit WHERE updated < ?",
+                                       (time.time() - max_period,)).rowcount
+
+
+class LoginRateLimiter:
+    """Limits login attempts per client IP and per username, checked before any password or Duo work
+
+    The client IP is what the WSGI server reports. Behind a reverse proxy that is the proxy's address,
+    so every client shares one bucket, unless the application is wrapped in werkzeug's ProxyFix.
+    """
+
+    def __init__(self, backend: RateLimiterBackend, per_ip: RateLimit = None, per_username: RateLimit = None):
+        self.backend = backend
+        self.per_ip = per_ip
+        self.per_username = per_username
+        self.rejected = {"ip": 0, "username": 0}
+        self._lock = threading.Lock()
+
+    def _reject(self, key_type: str, message: str, wait: float):
+        with self._lock:
+            self.rejected[key_type] += 1
+        raise RateLimitExceeded(message, math.ceil(wait))
+
+    @property
+    def max_period(self) -> float:
+        return max(limit.period for limit in (self.per_ip, self.per_username) if limit is not None)
+
+    def check(self, ip: str | None, username: str):
+        """Take a token for the IP and the username, raise RateLimitExceeded if either is exhausted"""
+        if self.per_ip is not None and ip:
+            wait = self.backend.hit("ip:" + ip, self.per_ip)
+            if wait:
+                self._reject("ip", f"Too many login attempts from {ip}.", wait)
+        if self.per_username is not None:
+            wait = self.backend.hit("user:" + username.strip().lower(), self.per_username)
+            if wait:
+                self._reject("username", f"Too many login attempts for {username}.", wait)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.rejected)
+
+    def start_sweeper(self):
+        self.backend.start_sweeper(self.max_period)
+
+
+def rate_limiter_from_config(section, instance_path: str) -> LoginRateLimiter | None:
+    """Build the login rate limiter from the ``ratelimit_*`` values of a duo.conf section, None if disabled"""
+    if not section.getboolean('ratelimit_enabled', fallback=True):
+        return None
+    per_ip = RateLimit(section.getint('ratelimit_ip_burst', fallback=20),
+                       section.getfloat('ratelimit_ip_period', fallback=60.0))
+    per_username = RateLimit(section.getint('ratelimit_user_burst', fallback=5),
+                             section.getfloat('ratelimit_user_period', fallback=300.0))
+    if per_ip.burst <= 0 and per_username.burst <= 0:
+        return None
+    sweep_interval = section.getfloat('ratelimit_sweep_interval', fallback=60.0)
+    backend_name = section.get('ratelimit_store', fallback='memory').lower()
+    if backend_name == "sqlite":
+        path = section.get('ratelimit_store_path', fallback=os.path.join(instance_path, "ratelimit.sqlite"))
+        backend = SQLiteRateLimiter(path, sweep_interval)
+    elif backend_name == "memory":
+        backend = MemoryRateLimiter(section.getint('ratelimit_max_keys', fallback=100000), sweep_interval)
+    else:
+        raise ValueError(f"Unknown ratelimit_store backend '{backend_name}'")
+    return LoginRateLimiter(backend,
+                            per_ip if per_ip.burst > 0 else None,
+                            per_username if per_username.burst > 0 else None)
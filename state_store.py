@@ -0,0 +1,413 @@
+"""
+Server-side store for pending Duo authentications, keyed by the Duo state nonce
+"""
+from __future__ import annotations, print_function
+
+import collections
+import contextlib
+import heapq
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from typing import NamedTuple
+
+# duo_universal generates alphanumeric states of 36 characters, accept up to the maximum length Duo allows
+STATE_PATTERN = re.compile(r"^[A-Za-z0-9_-]{16,1024}$")
+
+
+class StateStore:
+    """Base class for state stores. Every state can be consumed once, until it expires.
+
+    At most ``max_pending`` states are kept (0 = no limit), the oldest are dropped first once expired
+    states are gone. A user has at most ``max_per_user`` pending states, starting another login drops
+    the user's oldest one. Abandoned or flooded logins can not grow the store beyond these limits.
+    """
+
+    def __init__(self, ttl: float = 600.0, sweep_interval: float = 60.0, max_pending: int = 0, max_per_user: int = 0):
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.max_pending = max_pending
+        self.max_per_user = max_per_user
+        # Per process for the shared stores
+        self.counters = {"expired": 0, "evicted_capacity": 0, "evicted_user": 0}
+        self._counters_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sweeper = None
+
+    def put(self, state: str, data: dict, user: str = None):
+        """Save the data for a new state of ``user``"""
+        raise NotImplementedError
+
+    def _count(self, counter: str, amount: int = 1):
+        # For stores without a lock of their own, put() runs on several request threads
+        if amount:
+            with self._counters_lock:
+                self.counters[counter] += amount
+
+    def consume(self, state: str) -> dict | None:
+        """Remove a state and return its data, or None if it is unknown, expired or already used"""
+        raise NotImplementedError
+
+    def sweep(self) -> int:
+        """Delete expired states, return the number removed"""
+        raise NotImplementedError
+
+    def pending(self) -> tuple[int, float]:
+        """The number of pending states and the time the oldest of them was saved (0 if none)"""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        count, oldest = self.pending()
+        return {**self.counters, "pending": count, "oldest_age_seconds": round(time.time() - oldest, 1) if count else 0}
+
+    def start_sweeper(self, interval: float = None):
+        """Start a background thread that removes expired states every ``interval`` seconds"""
+        if self._sweeper is not None and self._sweeper.is_alive():
+            return
+        interval = interval or self.sweep_interval
+
+        def run():
+            while not self._stop.wait(interval):
+                self.sweep()
+
+        self._stop.clear()
+        self._sweeper = threading.Thread(target=run, name="duo-state-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._stop.set()
+        self._sweeper = None
+
+
+class _Entry(NamedTuple):
+    data: dict
+    expires: float
+    user: str | None
+
+
+class MemoryStateStore(StateStore):
+    """Dictionary backed store, only shared between threads of a single process.
+
+    Expiry times are kept in a heap, so sweeps and evictions only touch the oldest states. Entries of
+    consumed states stay in the heap until they reach the top or the heap is rebuilt.
+    """
+
+    def __init__(self, ttl: float = 600.0, sweep_interval: float = 60.0, max_pending: int = 0, max_per_user: int = 0):
+        super().__init__(ttl, sweep_interval, max_pending, max_per_user)
+        self._data = {}
+        # (expires, state)
+        self._expiry = []
+        # Pending states by user, oldest first
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def put(self, state: str, data: dict, user: str = None):
+        now = time.time()
+        with self._lock:
+            self._remove(state)
+            if self.max_pending > 0 and len(self._data) >= self.max_pending:
+                self.counters["expired"] += self._expire(now)
+                while len(self._data) >= self.max_pending and self._pop_oldest():
+                    self.counters["evicted_capacity"] += 1
+            if user is not None and self.max_per_user > 0:
+                states = self._users.get(user, ())
+                while len(states) >= self.max_per_user:
+                    self._remove(states[0])
+                    self.counters["evicted_user"] += 1
+            entry = self._data[state] = _Entry(data, now + self.ttl, user)
+            heapq.heappush(self._expiry, (entry.expires, state))
+            if user is not None:
+                self._users.setdefault(user, collections.deque()).append(state)
+            if len(self._expiry) > 2 * len(self._data) + 1024:
+                self._expiry = [(entry.expires, state) for state, entry in self._data.items()]
+                heapq.heapify(self._expiry)
+
+    def _remove(self, state: str) -> _Entry | None:
+        entry = self._data.pop(state, None)
+        if entry is not None and entry.user is not None:
+            states = self._users[entry.user]
+            states.remove(state)
+            if not states:
+                del self._users[entry.user]
+        return entry
+
+    def _is_current(self, item: tuple) -> bool:
+        entry = self._data.get(item[1])
+        return entry is not None and entry.expires == item[0]
+
+    def _pop_oldest(self) -> bool:
+        while self._expiry:
+            item = heapq.heappop(self._expiry)
+            if self._is_current(item):
+                self._remove(item[1])
+                return True
+        return False
+
+    def _expire(self, now: float) -> int:
+        removed = 0
+        while self._expiry and self._expiry[0][0] < now:
+            item = heapq.heappop(self._expiry)
+            if self._is_current(item):
+                self._remove(item[1])
+                removed += 1
+        return removed
+
+    def consume(self, state: str) -> dict | None:
+        with self._lock:
+            entry = self._remove(state)
+        if entry is None or entry.expires < time.time():
+            return None
+        return entry.data
+
+    def sweep(self) -> int:
+        with self._lock:
+            removed = self._expire(time.time())
+            self.counters["expired"] += removed
+        return removed
+
+    def pending(self) -> tuple[int, float]:
+        with self._lock:
+            # Expired states are not pending, drop them as the sweeper would
+            self.counters["expired"] += self._expire(time.time())
+            while self._expiry and not self._is_current(self._expiry[0]):
+                heapq.heappop(self._expiry)
+            return len(self._data), self._expiry[0][0] - self.ttl if self._expiry else 0.0
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteStateStore(StateStore):
+    """SQLite backed store that can be shared by all worker processes on a host. The limits are
+    enforced in the same transaction as the insert, for the states of all workers."""
+
+    def __init__(self, path: str, ttl: float = 600.0, sweep_interval: float = 60.0, max_pending: int = 0,
+                 max_per_user: int = 0):
+        super().__init__(ttl, sweep_interval, max_pending, max_per_user)
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS duo_state "
+                         "(state TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL, username TEXT)")
+            if "username" not in {row[1] for row in conn.execute("PRAGMA table_info(duo_state)")}:
+                # Created before per-user limits
+                conn.execute("ALTER TABLE duo_state ADD COLUMN username TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS duo_state_expires ON duo_state (expires)")
+            conn.execute("CREATE INDEX IF NOT EXISTS duo_state_username ON duo_state (username, expires)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def put(self, state: str, data: dict, user: str = None):
+        now = time.time()
+        if not self.max_pending and not (user is not None and self.max_per_user):
+            self._connect().execute("INSERT OR REPLACE INTO duo_state (state, data, expires, username) "
+                                    "VALUES (?, ?, ?, ?)", (state, json.dumps(data), now + self.ttl, user))
+            return
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO duo_state (state, data, expires, username) VALUES (?, ?, ?, ?)",
+                         (state, json.dumps(data), now + self.ttl, user))
+            if user is not None and self.max_per_user > 0:
+                self._count("evicted_user", conn.execute(
+                        "DELETE FROM duo_state WHERE state IN (SELECT state FROM duo_state WHERE username = ? "
+                        "ORDER BY expires DESC LIMIT -1 OFFSET ?)", (user, self.max_per_user)).rowcount)
+            if self.max_pending > 0:
+                excess = conn.execute("SELECT COUNT(*) FROM duo_state").fetchone()[0] - self.max_pending
+                if excess > 0:
+                    expired = conn.execute("DELETE FROM duo_state WHERE expires < ?", (now,)).rowcount
+                    self._count("expired", expired)
+                    if excess > expired:
+                        self._count("evicted_capacity", conn.execute(
+                                "DELETE FROM duo_state WHERE state IN "
+                                "(SELECT state FROM duo_state ORDER BY expires LIMIT ?)", (excess - expired,)).rowcount)
+
+    def consume(self, state: str) -> dict | None:
+        # DELETE ... RETURNING makes the lookup and removal atomic, only one worker gets the row
+        row = self._connect().execute("DELETE FROM duo_state WHERE state = ? RETURNING data, expires",
+                                      (state,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0])
+
+    def sweep(self) -> int:
+        removed = self._connect().execute("DELETE FROM duo_state WHERE expires < ?", (time.time(),)).rowcount
+        self._count("expired", removed)
+        return removed
+
+    def pending(self) -> tuple[int, float]:
+        count, oldest = self._connect().execute("SELECT COUNT(*), MIN(expires) FROM duo_state WHERE expires >= ?",
+                                                (time.time(),)).fetchone()
+        return count, oldest - self.ttl if count else 0.0
+
+
+class FileStateStore(StateStore):
+    """One file per state in a directory, e.g. on /dev/shm to share states through memory.
+
+    A state is consumed by renaming its file, which is atomic, so a replayed callback racing the
+    original one on another worker can not succeed as well. max_pending is enforced when a state is
+    saved by listing the directory (concurrent saves can each add one more). A full directory is
+    trimmed to 90% of the limit, so a flood does not read every file's time for every new state.
+    max_per_user is only enforced by sweep(), which reads every file.
+    """
+
+    def __init__(self, directory: str, ttl: float = 600.0, sweep_interval: float = 60.0, max_pending: int = 0,
+                 max_per_user: int = 0):
+        super().__init__(ttl, sweep_interval, max_pending, max_per_user)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, state: str) -> str:
+        if not STATE_PATTERN.match(state or ""):
+            raise ValueError("Invalid state value.")
+        return os.path.join(self.directory, state + ".json")
+
+    def put(self, state: str, data: dict, user: str = None):
+        path = self._path(state)
+        if self.max_pending > 0:
+            self._trim()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as fh:
+            json.dump({"data": data, "expires": time.time() + self.ttl, "user": user}, fh)
+        os.replace(tmp_path, path)
+
+    def _trim(self):
+        """Drop the oldest states, expired ones first, if the directory holds max_pending of them"""
+        with os.scandir(self.directory) as entries:
+            states = [entry for entry in entries if entry.name.endswith(".json")]
+        if len(states) < self.max_pending:
+            return
+        # (saved, path), the modification time is when the state was saved
+        saved = []
+        for entry in states:
+            try:
+                saved.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                continue
+        expired_before = time.time() - self.ttl
+        for mtime, path in heapq.nsmallest(len(saved) - self.max_pending * 9 // 10, saved):
+            self._count("expired" if mtime < expired_before else "evicted_capacity", self._discard(path))
+
+    def consume(self, state: str) -> dict | None:
+        try:
+            path = self._path(state)
+        except ValueError:
+            return None
+        claimed = f"{path}.{uuid.uuid4().hex}.claimed"
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return None
+        try:
+            with open(claimed) as fh:
+                entry = json.load(fh)
+            expires, data = entry["expires"], entry["data"]
+        except (ValueError, KeyError, TypeError):
+            # Truncated or not written by this store, the login starts over like for an unknown state
+            return None
+        finally:
+            os.unlink(claimed)
+        if expires < time.time():
+            return None
+        return data
+
+    def sweep(self) -> int:
+        removed = 0
+        now = time.time()
+        # (expires, user, path) of the pending states
+        pending = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.name.endswith(".json"):
+                        with open(entry.path) as fh:
+                            saved = json.load(fh)
+                        expired = saved["expires"] < now
+                        if not expired:
+                            pending.append((saved["expires"], saved.get("user"), entry.path))
+                    else:
+                        # Leftover temporary or claimed files
+                        expired = entry.stat().st_mtime + self.ttl < now
+                    if expired:
+                        os.unlink(entry.path)
+                        removed += 1
+                except (OSError, ValueError, KeyError):
+                    continue
+        self._count("expired", removed)
+        # Newest first, the newest states of every user and overall are kept
+        pending.sort(reverse=True)
+        per_user, kept = collections.Counter(), []
+        for expires, user, path in pending:
+            if user is not None and self.max_per_user > 0:
+                per_user[user] += 1
+                if per_user[user] > self.max_per_user:
+                    self._count("evicted_user", self._discard(path))
+                    continue
+            kept.append(path)
+        if self.max_pending > 0:
+            for path in kept[self.max_pending:]:
+                self._count("evicted_capacity", self._discard(path))
+        return removed
+
+    @staticmethod
+    def _discard(path: str) -> int:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return 0
+        return 1
+
+    def pending(self) -> tuple[int, float]:
+        # The modification time is when the state was saved, no need to read the files
+        count, oldest, now = 0, 0.0, time.time()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    saved = entry.stat().st_mtime if entry.name.endswith(".json") else 0.0
+                    if saved + self.ttl >= now:
+                        oldest = min(oldest, saved) if count else saved
+                        count += 1
+                except OSError:
+                    continue
+        return count, oldest
+
+
+def state_store_from_config(section, instance_path: str) -> StateStore:
+    """Build the state store selected by ``state_store`` (memory, sqlite or file) in a duo.conf section"""
+    backend = section.get('state_store', fallback='memory').lower()
+    options = {
+            "ttl":            section.getfloat('state_ttl', fallback=600.0),
+            "sweep_interval": section.getfloat('state_sweep_interval', fallback=60.0),
+            "max_pending":    section.getint('state_max_pending', fallback=10000),
+            "max_per_user":   section.getint('state_max_per_user', fallback=3),
+    }
+    if backend == "sqlite":
+        path = section.get('state_store_path', fallback=os.path.join(instance_path, "state.sqlite"))
+        return SQLiteStateStore(path, **options)
+    if backend == "file":
+        path = section.get('state_store_path', fallback=os.path.join(instance_path, "state"))
+        return FileStateStore(path, **options)
+    if backend != "memory":
+        raise ValueError(f"Unknown state_store backend '{backend}'")
+    return MemoryStateStore(**options)
@@ -0,0 +1,148 @@
+"""
+Database engine configuration: SQLite pragmas, connection pooling and read-only replicas
+"""
+from __future__ import annotations, print_function
+
+import hashlib
+import itertools
+import os
+import threading
+
+from sqlalchemy import MetaData, create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import NoResultFound
+from sqlalchemy.orm import Session
+
+DEFAULT_DATABASE_URI = "sqlite:///db.sqlite"
+
+
+def sqlite_pragmas(section) -> dict:
+    """PRAGMA values for every new SQLite connection from a duo.conf section"""
+    return {
+            "journal_mode": section.get('db_journal_mode', fallback='wal'),
+            "synchronous":  section.get('db_synchronous', fallback='normal'),
+            # Negative values are KiB instead of pages
+            "cache_size":   -section.getint('db_cache_size_kib', fallback=65536),
+            "mmap_size":    section.getint('db_mmap_size', fallback=268435456),
+            "busy_timeout": section.getint('db_busy_timeout', fallback=5000),
+            "temp_store":   "memory",
+    }
+
+
+def engine_options(section) -> dict:
+    """Keyword arguments for create_engine() (or SQLALCHEMY_ENGINE_OPTIONS) from a duo.conf section"""
+    options = {
+            "pool_size":     section.getint('db_pool_size', fallback=10),
+            "max_overflow":  section.getint('db_max_overflow', fallback=10),
+            "pool_timeout":  section.getfloat('db_pool_timeout', fallback=30.0),
+            "pool_pre_ping": section.getboolean('db_pool_pre_ping', fallback=False),
+    }
+    if section.get('db_uri', fallback=DEFAULT_DATABASE_URI).startswith("sqlite"):
+        options["connect_args"] = {
+                # Pooled connections are handed to whichever request thread checks them out
+                "check_same_thread": False,
+                "timeout":           section.getint('db_busy_timeout', fallback=5000) / 1000,
+        }
+    return options
+
+
+def install_pragmas(engine: Engine, pragmas: dict, /, *, read_only: bool = False):
+    """Run the PRAGMA statements on every new connection of a SQLite engine"""
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            if read_only and name in ("journal_mode", "synchronous"):
+                # Only the writer decides the journal mode
+                continue
+            cursor.execute(f"PRAGMA {name}={value}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+    # Connections opened before the listener was added do not have the settings yet
+    engine.dispose()
+
+
+def ensure_schema(engine: Engine, metadata: MetaData, version: int, /, *, marker_dir: str = None) -> bool:
+    """Create the tables unless the database is already marked as having schema ``version``.
+
+    SQLite keeps the marker in ``PRAGMA user_version``, so checking it is one query and no schema
+    introspection. Other databases use a marker file in ``marker_dir`` (without one the tables are
+    always checked). Returns True if create_all() ran.
+    """
+    marker = None
+    if engine.dialect.name == "sqlite":
+        with engine.connect() as conn:
+            if conn.exec_driver_sql("PRAGMA user_version").scalar() == version:
+                return False
+    elif marker_dir:
+        url_hash = hashlib.sha256(engine.url.render_as_string(hide_password=True).encode()).hexdigest()[:16]
+        marker = os.path.join(marker_dir, f"schema-{url_hash}.version")
+        try:
+            with open(marker) as fh:
+                if int(fh.read().strip()) == version:
+                    return False
+        except (OSError, ValueError):
+            pass
+
+    metadata.create_all(engine)
+    if engine.dialect.name == "sqlite":
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+    elif marker is not None:
+        os.makedirs(marker_dir, exist_ok=True)
+        with open(marker, "w") as fh:
+            fh.write(str(version))
+    return True
+
+
+class ReadReplicas:
+    """Round-robin sessions over read-only engines, used for the login lookups.
+
+    For SQLite a replica can simply be the primary file opened a second time: in WAL mode
+    readers never wait for the writer.
+    """
+
+    def __init__(self, uris: list[str], options: dict, pragmas: dict):
+        self.engines = []
+        for uri in uris:
+            engine = create_engine(uri, **options)
+            install_pragmas(engine, pragmas, read_only=True)
+            self.engines.append(engine)
+        self._next = itertools.cycle(range(len(self.engines)))
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.engines)
+
+    def session(self) -> Session:
+        with self._lock:
+            engine = self.engines[next(self._next)]
+        return Session(engine, expire_on_commit=False)
+
+    def scalar_one(self, statement, primary: Session):
+        """The single result of ``statement`` from a replica, or from ``primary`` if the replica does not have it.
+
+        A replica may lag behind the primary, e.g. right after a registration. Raises NoResultFound.
+        """
+        if not self.engines:
+            return primary.execute(statement).scalar_one()
+        try:
+            with self.session() as session:
+                return session.execute(statement).scalar_one()
+        except NoResultFound:
+            return primary.execute(statement).scalar_one()
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose(close=False)
+
+
+def read_replicas_from_config(section) -> ReadReplicas:
+    """Build the read replicas listed (comma separated URIs) in ``db_read_replicas``"""
+    uris = [uri.strip() for uri in section.get('db_read_replicas', fallback='').split(",") if uri.strip()]
+    return ReadReplicas(uris, engine_options(section), sqlite_pragmas(section))
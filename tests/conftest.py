@@ -0,0 +1,9 @@
+"""
+The application modules live in the repository root, next to this directory
+"""
+from __future__ import annotations, print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
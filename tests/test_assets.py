@@ -0,0 +1,118 @@
+"""
+StaticAssets serves fingerprinted URLs with an immutable Cache-Control, answers a matching If-None-Match with 304
+and negotiates the br and gzip encodings, and conditional_pages revalidates HTML pages
+"""
+from __future__ import annotations, print_function
+
+import gzip
+import hashlib
+
+import flask
+import pytest
+
+import assets
+
+CSS = b"body { color: #333; }\n" * 40
+
+
+@pytest.fixture
+def app(tmp_path):
+    static = tmp_path / "static"
+    (static / "img").mkdir(parents=True)
+    (static / "style.css").write_bytes(CSS)
+    (static / "img" / "dot.gif").write_bytes(b"GIF89a")
+    app = flask.Flask(__name__, static_folder=str(static))
+    static_assets = assets.StaticAssets(app)
+    app.extensions["static_assets"] = static_assets
+
+    @app.route("/")
+    def index():
+        return f"<link href='{flask.url_for('static', filename='style.css')}'>"
+
+    assets.conditional_pages(app)
+    return app
+
+
+def fingerprint(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()[:12]
+
+
+def test_served_from_the_static_folder_until_loaded(app):
+    client = app.test_client()
+    with app.test_request_context():
+        assert flask.url_for("static", filename="style.css") == "/static/style.css"
+    response = client.get("/static/style.css")
+    assert response.status_code == 200 and response.data == CSS
+    response.close()
+
+
+def test_fingerprinted_urls(app):
+    app.extensions["static_assets"].load()
+    digest = fingerprint(CSS)
+    with app.test_request_context():
+        assert flask.url_for("static", filename="style.css") == f"/static/style.{digest}.css"
+        assert flask.url_for("static", filename="img/dot.gif") == f"/static/img/dot.{fingerprint(b'GIF89a')}.gif"
+        # Files that are not in the static folder keep their name
+        assert flask.url_for("static", filename="missing.css") == "/static/missing.css"
+    client = app.test_client()
+    response = client.get(f"/static/style.{digest}.css")
+    assert response.data == CSS and response.mimetype == "text/css"
+    assert response.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    # The unversioned URL may change with the next deployment
+    assert client.get("/static/style.css").headers["Cache-Control"] == "public, no-cache"
+    assert client.get("/static/missing.css").status_code == 404
+
+
+def test_etag_and_304(app):
+    app.extensions["static_assets"].load()
+    client = app.test_client()
+    url = f"/static/style.{fingerprint(CSS)}.css"
+    response = client.get(url)
+    assert response.headers["ETag"] == f'"{fingerprint(CSS)}"'
+    response = client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304 and response.data == b""
+    assert client.get(url, headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+@pytest.mark.parametrize("accept, encoding", [
+        ("", None),
+        ("gzip, deflate", "gzip"),
+        ("gzip;q=0", None),
+        ("br", None),
+        ("identity", None),
+])
+def test_gzip_negotiation(app, monkeypatch, accept, encoding):
+    # br is only offered with the optional brotli package
+    monkeypatch.setattr(assets, "brotli", None)
+    app.extensions["static_assets"].load()
+    response = app.test_client().get("/static/style.css", headers={"Accept-Encoding": accept})
+    assert response.headers.get("Content-Encoding") == encoding
+    assert "Accept-Encoding" in response.headers["Vary"]
+    body = gzip.decompress(response.data) if encoding == "gzip" else response.data
+    assert body == CSS
+    # Every encoding has its own strong ETag
+    assert response.headers["ETag"] == (f'"{fingerprint(CSS)}-gzip"' if encoding else f'"{fingerprint(CSS)}"')
+
+
+def test_brotli_preferred(app):
+    brotli = pytest.importorskip("brotli")
+    app.extensions["static_assets"].load()
+    response = app.test_client().get("/static/style.css", headers={"Accept-Encoding": "gzip, br"})
+    assert response.headers["Content-Encoding"] == "br"
+    assert brotli.decompress(response.data) == CSS
+
+
+def test_small_or_uncompressed_files(app):
+    static_assets = app.extensions["static_assets"]
+    static_assets.load()
+    assert set(static_assets.assets["img/dot.gif"].bodies) == {"identity"}
+    static_assets.load(compress=False)
+    response = app.test_client().get("/static/style.css", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers and response.data == CSS
+
+
+def test_conditional_pages(app):
+    client = app.test_client()
+    response = client.get("/")
+    assert response.headers["Cache-Control"] == "private, no-cache"
+    assert client.get("/", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
@@ -0,0 +1,129 @@
+"""
+Audit segments roll over by size and age, read_events() picks segments by the time range in their names and skips
+torn lines, aggregate() counts by fields and time buckets, and emit() drops and counts events when the queue is full
+"""
+from __future__ import annotations, print_function
+
+import json
+import os
+import threading
+
+import pytest
+
+import audit
+
+
+def event(ts: float, name: str = "success", tenant: str = "duo", username: str = "alice") -> audit.AuditEvent:
+    return audit.AuditEvent(ts, name, tenant, username, "10.0.0.1")
+
+
+def names(directory) -> list[str]:
+    return sorted(name.rsplit("-", 1)[0] for name in os.listdir(directory))
+
+
+def test_emit_written_on_stop(tmp_path):
+    log = audit.AuditLog(str(tmp_path))
+    log.emit("duo_redirect", tenant="duo", username="alice", ip="10.0.0.1")
+    log.emit("success", tenant="duo", username="alice", ip="10.0.0.1")
+    log.start()
+    log.emit("logout", username="alice")
+    log.stop()
+    assert [e.event for e in audit.read_events(str(tmp_path))] == ["duo_redirect", "success", "logout"]
+    stats = log.stats()
+    assert stats["written"] == 3 and stats["segments"] == 1 and stats["dropped"] == 0 and stats["queued"] == 0
+    # Closed segments carry their end time instead of "open"
+    assert "open" not in os.listdir(str(tmp_path))[0]
+
+
+def test_unknown_event_type(tmp_path):
+    with pytest.raises(ValueError, match="Unknown audit event type"):
+        audit.AuditLog(str(tmp_path)).emit("hacked")
+
+
+def test_rollover_by_size(tmp_path):
+    line = len(event(1000.0).to_json())
+    log = audit.AuditLog(str(tmp_path), segment_bytes=2 * line)
+    for ts in (1000.0, 1001.0, 1002.0):
+        log._write([event(ts)])
+    log._close_segment()
+    # The segment is full once it reaches segment_bytes, the next batch starts a new one
+    assert names(tmp_path) == ["audit-0000001000000-0000001001001", "audit-0000001002000-0000001002001"]
+    assert log.counters["segments"] == 2 and log.counters["written"] == 3
+
+
+def test_rollover_by_age(tmp_path):
+    log = audit.AuditLog(str(tmp_path), segment_seconds=60)
+    for ts in (1000.0, 1059.0, 1060.0):
+        log._write([event(ts)])
+    log._close_segment()
+    assert names(tmp_path) == ["audit-0000001000000-0000001059001", "audit-0000001060000-0000001060001"]
+
+
+@pytest.fixture
+def segments(tmp_path):
+    log = audit.AuditLog(str(tmp_path), segment_seconds=60)
+    log._write([event(1000.0, "duo_redirect"), event(1001.0, "success", username="bob")])
+    log._write([event(1002.0, "fail_open", tenant="acme")])
+    log._write([event(2000.0, "invalid_credentials"), event(2001.0, "success")])
+    log._close_segment()
+    # A segment still being written, with a torn last line as after a crash
+    log._write([event(3000.0, "logout")])
+    log._segment["file"].write(b'{"ts":3001.0,"ev')
+    yield str(tmp_path)
+    log._segment["file"].close()
+
+
+def test_segments_selected_by_name(segments):
+    assert len(audit.segments(segments)) == 3
+    # Ends before since or starts after until
+    assert len(audit.segments(segments, since=1500)) == 2
+    assert len(audit.segments(segments, until=1500)) == 1
+    # The open segment may hold any later event
+    assert len(audit.segments(segments, since=5000)) == 1
+
+
+def test_read_events(segments):
+    assert [e.ts for e in audit.read_events(segments)] == [1000.0, 1001.0, 1002.0, 2000.0, 2001.0, 3000.0]
+    # since is inclusive, until exclusive
+    assert [e.ts for e in audit.read_events(segments, since=1001.0, until=2001.0)] == [1001.0, 1002.0, 2000.0]
+    assert [e.ts for e in audit.read_events(segments, events=["success", "logout"])] == [1001.0, 2001.0, 3000.0]
+    assert [e.ts for e in audit.read_events(segments, tenant="acme")] == [1002.0]
+    assert [e.ts for e in audit.read_events(segments, username="bob")] == [1001.0]
+
+
+def test_aggregate(segments):
+    assert audit.aggregate(audit.read_events(segments, until=2500)) == {
+            ("duo_redirect",): 1, ("success",): 2, ("fail_open",): 1, ("invalid_credentials",): 1}
+    assert audit.aggregate(audit.read_events(segments), by=("tenant",), interval=1000) == {
+            (1000.0, "duo"): 2, (1000.0, "acme"): 1, (2000.0, "duo"): 2, (3000.0, "duo"): 1}
+
+
+def test_count_command(segments, capsys):
+    audit.main(["count", "--dir", segments, "--event", "success", "--by", "username"])
+    rows = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert rows == [{"username": "alice", "count": 1}, {"username": "bob", "count": 1}]
+
+
+def test_full_queue_drops_and_counts(tmp_path):
+    # Not started, nothing takes events off the queue
+    log = audit.AuditLog(str(tmp_path), queue_size=2)
+    for _ in range(5):
+        log.emit("success")
+    assert log.stats()["dropped"] == 3 and log.stats()["queued"] == 2
+
+
+def test_drops_counted_from_many_threads(tmp_path):
+    log = audit.AuditLog(str(tmp_path), queue_size=1)
+    barrier = threading.Barrier(8)
+
+    def emit():
+        barrier.wait()
+        for _ in range(2000):
+            log.emit("success")
+
+    threads = [threading.Thread(target=emit) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert log.stats()["dropped"] == 8 * 2000 - 1
@@ -0,0 +1,223 @@
+"""
+duo.conf snapshots: tenant inheritance, validation errors reported at once, range checks, the change signature of
+ConfigWatcher, SIGHUP and forced reloads, and failed reloads that keep the current configuration
+"""
+from __future__ import annotations, print_function
+
+import configparser
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import duo_config
+
+VALID = {
+        "client_id": "DIXXXXXXXXXXXXXXXXXX",
+        "client_secret": "s" * 40,
+        "api_hostname": "api-main.duosecurity.com",
+        "redirect_uri": "https://example.com/duo-callback",
+}
+
+
+def section(values: dict = None, **tenants) -> configparser.SectionProxy:
+    parser = configparser.ConfigParser()
+    parser["duo"] = {**VALID, **(values or {})}
+    parser.read_dict(tenants)
+    return parser["duo"]
+
+
+def write(path, values: dict = None):
+    parser = configparser.ConfigParser()
+    parser["duo"] = {**VALID, **(values or {})}
+    with open(path, "w") as fh:
+        parser.write(fh)
+
+
+def test_snapshot():
+    config = duo_config.from_section(section({"failmode": "Secure", "duo_certs": ""}), source="duo.conf")
+    assert config.client_id == VALID["client_id"]
+    assert config.failmode == "closed" and not config.fail_open
+    assert config.duo_certs is None
+    assert config.source == "duo.conf"
+
+
+def test_snapshot_is_a_copy():
+    values = section()
+    config = duo_config.from_section(values)
+    values["failmode"] = "open"
+    assert "failmode" not in config.values
+    with pytest.raises(TypeError):
+        config.values["failmode"] = "open"
+
+
+def test_tenant_inheritance():
+    config = duo_config.from_section(section({"tenants": "acme", "failmode": "open", "tenant_max_clients": "3",
+                                              "tenant_path": "/main"},
+                                             acme={"api_hostname": "api-acme.duosecurity.com",
+                                                   "tenant_hosts": "acme.example.com"}))
+    acme, = config.tenants
+    assert acme.section.name == "acme"
+    assert acme.api_hostname == "api-acme.duosecurity.com"
+    # Inherited from the main section
+    assert acme.client_secret == VALID["client_secret"] and acme.fail_open
+    # Tenant settings of the main section are not
+    assert "tenant_max_clients" not in acme.values and "tenant_path" not in acme.values
+    assert "tenants" not in acme.values
+
+
+@pytest.mark.parametrize("tenants", ["missing", "duo"])
+def test_tenant_section_missing(tenants):
+    with pytest.raises(duo_config.ConfigError, match=rf"Tenant section \[{tenants}\] is missing"):
+        duo_config.from_section(section({"tenants": tenants}))
+
+
+def test_tenant_validated():
+    with pytest.raises(duo_config.ConfigError, match=r"\[acme\].*client_secret must be 40 characters"):
+        duo_config.from_section(section({"tenants": "acme"}, acme={"client_secret": "short"}))
+
+
+def test_all_errors_reported_at_once():
+    with pytest.raises(duo_config.ConfigError) as excinfo:
+        duo_config.from_section(section({"client_id": "short", "api_hostname": "", "redirect_uri": "ftp://x",
+                                         "failmode": "maybe", "log_level": "LOUD", "bcrypt_rounds": "twelve",
+                                         "metrics_enabled": "perhaps", "profile_allowed_ips": "localhost"}))
+    message = str(excinfo.value)
+    for expected in ("client_id must be 20 characters", "api_hostname is missing", "redirect_uri must be",
+                     "failmode must be one of", "log_level must be", "bcrypt_rounds:", "metrics_enabled:",
+                     "profile_allowed_ips:"):
+        assert expected in message
+
+
+@pytest.mark.parametrize("key, value", [
+        ("bcrypt_rounds", "2"),
+        ("bcrypt_rounds", "32"),
+        ("hash_workers", "0"),
+        ("hash_queue_size", "-1"),
+        ("app_port", "70000"),
+        ("health_failure_threshold", "0"),
+        ("health_jitter", "1.5"),
+        ("profile_sample_rate", "-0.1"),
+        ("ratelimit_user_period", "0"),
+        ("state_ttl", "-5"),
+        ("user_index_error_rate", "1"),
+        ("log_batch_size", "0"),
+])
+def test_out_of_range(key, value):
+    with pytest.raises(duo_config.ConfigError, match=f"{key}: {value}"):
+        duo_config.from_section(section({key: value}))
+
+
+@pytest.mark.parametrize("key, value", [
+        ("bcrypt_rounds", "4"),
+        ("bcrypt_rounds", "31"),
+        ("hash_queue_size", "0"),
+        ("db_max_overflow", "-1"),
+        ("profile_sample_rate", "1"),
+        ("config_reload_interval", "0"),
+        ("http_read_timeout", ""),
+])
+def test_in_range(key, value):
+    assert duo_config.from_section(section({key: value})).section[key] == value
+
+
+def test_changed_keys():
+    old = duo_config.from_section(section())
+    new = duo_config.from_section(section({"client_secret": "t" * 40, "bcrypt_rounds": "10"}))
+    changed = duo_config.changed_keys(old, new)
+    assert changed == {"client_secret", "bcrypt_rounds"}
+    assert {key for key in changed if duo_config.is_reloadable(key)} == {"client_secret"}
+    assert duo_config.affects_client("client_secret") and duo_config.affects_client("http_read_timeout")
+    assert not duo_config.affects_client("failmode") and duo_config.is_reloadable("failmode")
+
+
+@pytest.fixture
+def watched(tmp_path):
+    path = str(tmp_path / "duo.conf")
+    write(path)
+    reloaded = []
+    watcher = duo_config.ConfigWatcher(path, reloaded.append, interval=0)
+    yield path, watcher, reloaded
+    watcher.stop(1)
+
+
+def test_reload_on_change_only(watched):
+    path, watcher, reloaded = watched
+    assert not watcher.check()
+    write(path, {"failmode": "open"})
+    # A different size changes the signature even within the mtime resolution
+    assert watcher.check()
+    assert reloaded[-1].fail_open
+    assert not watcher.check()
+    # Same size, newer mtime
+    write(path, {"failmode": "open"})
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+    assert watcher.check()
+    assert watcher.reloads == 2
+
+
+def test_forced_reload(watched):
+    path, watcher, reloaded = watched
+    assert watcher.check(force=True)
+    assert len(reloaded) == 1 and watcher.reloads == 1
+
+
+def test_failed_reload_keeps_the_current_configuration(watched):
+    path, watcher, reloaded = watched
+    write(path, {"client_secret": "short"})
+    assert not watcher.check()
+    assert reloaded == [] and watcher.failures == 1
+    # Reported once, not on every check of the same broken file
+    assert not watcher.check()
+    assert watcher.failures == 1
+    write(path, {"failmode": "open"})
+    assert watcher.check()
+    assert reloaded[-1].fail_open
+
+
+def test_failing_on_reload_keeps_the_current_configuration(tmp_path):
+    path = str(tmp_path / "duo.conf")
+    write(path)
+
+    def on_reload(config):
+        raise ValueError("Cannot build the Duo client")
+
+    watcher = duo_config.ConfigWatcher(path, on_reload, interval=0)
+    assert not watcher.check(force=True)
+    assert watcher.failures == 1 and watcher.reloads == 0
+
+
+def test_unreadable_file(tmp_path):
+    with pytest.raises(duo_config.ConfigError, match="Unable to read"):
+        duo_config.load(str(tmp_path / "missing.conf"))
+    path = tmp_path / "other.conf"
+    path.write_text("[other]\nkey = value\n")
+    with pytest.raises(duo_config.ConfigError, match=r"no \[duo\] section"):
+        duo_config.load(str(path))
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGHUP"), reason="No SIGHUP on this platform")
+def test_sighup_reloads_unchanged_file(watched):
+    path, watcher, reloaded = watched
+    previous = signal.getsignal(signal.SIGHUP)
+    try:
+        assert watcher.install_signal_handler()
+        watcher.start()
+        os.kill(os.getpid(), signal.SIGHUP)
+        deadline = time.monotonic() + 5
+        while not reloaded and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(reloaded) == 1
+    finally:
+        signal.signal(signal.SIGHUP, previous)
+
+
+def test_signal_handler_only_from_the_main_thread(watched):
+    path, watcher, reloaded = watched
+    result = []
+    thread = threading.Thread(target=lambda: result.append(watcher.install_signal_handler()))
+    thread.start()
+    thread.join()
+    assert result == [False]
@@ -0,0 +1,88 @@
+"""
+DuoHealthMonitor checks Duo once for concurrent first requests and pauses checks while the breaker is open
+"""
+from __future__ import annotations, print_function
+
+import threading
+import time
+
+import duo_health
+
+
+class StubCheck:
+    """Health check that fails while ``failing`` is set, counting and optionally slowing down the calls"""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.failing = False
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        if self.failing:
+            raise ConnectionError("Duo unreachable")
+
+
+def test_concurrent_first_requests_check_once():
+    check = StubCheck(delay=0.2)
+    monitor = duo_health.DuoHealthMonitor(check)
+    barrier = threading.Barrier(16)
+    results = []
+
+    def request():
+        barrier.wait()
+        results.append(monitor.is_available())
+
+    threads = [threading.Thread(target=request) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert check.calls == 1
+    assert results == [True] * 16
+
+
+def test_failed_first_check_is_shared():
+    check = StubCheck()
+    check.failing = True
+    monitor = duo_health.DuoHealthMonitor(check)
+    assert not monitor.is_available()
+    assert not monitor.is_available()
+    assert check.calls == 1
+    assert monitor.status.error == "Duo unreachable"
+
+
+def test_breaker_transitions():
+    check = StubCheck()
+    monitor = duo_health.DuoHealthMonitor(check, failure_threshold=2, reset_timeout=0.2)
+    assert monitor.refresh().healthy
+    check.failing = True
+    monitor.refresh()
+    assert monitor.breaker.state == duo_health.CLOSED
+    monitor.refresh()
+    assert monitor.breaker.state == duo_health.OPEN
+    # No calls to Duo while open
+    calls = check.calls
+    assert not monitor.refresh().healthy
+    assert check.calls == calls
+    # A single half-open probe after the reset timeout, a failure opens the breaker again
+    time.sleep(0.25)
+    monitor.refresh()
+    assert check.calls == calls + 1
+    assert monitor.breaker.state == duo_health.OPEN
+    # A successful probe closes it
+    check.failing = False
+    time.sleep(0.25)
+    assert monitor.refresh().healthy
+    assert monitor.breaker.state == duo_health.CLOSED
+    assert monitor.is_available()
+
+
+def test_stale_status_is_unavailable():
+    monitor = duo_health.DuoHealthMonitor(StubCheck(), ttl=0.05)
+    assert monitor.is_available()
+    time.sleep(0.2)
+    assert not monitor.is_available()
@@ -0,0 +1,220 @@
+"""
+TenantRegistry routes requests by host and path, builds clients lazily, evicts idle ones, applies reloads
+all or nothing, and TenantSessionInterface gives every tenant its own session cookie
+"""
+from __future__ import annotations, print_function
+
+import configparser
+import time
+
+import flask
+import pytest
+
+import duo_config
+import duo_tenants
+
+SECTION = {
+        "client_id": "DIXXXXXXXXXXXXXXXXXX",
+        "client_secret": "s" * 40,
+        "api_hostname": "api-main.duosecurity.com",
+        "redirect_uri": "https://example.com/duo-callback",
+        "tenants": "acme, beta",
+        "tenant_idle_timeout": "3600",
+}
+
+
+class StubVerifier:
+
+    def __init__(self):
+        self.previous = None
+
+    def accept_previous(self, verifier):
+        self.previous = verifier
+
+
+class StubClient:
+
+    def __init__(self, config: duo_config.DuoConfig):
+        self.config = config
+        self.verifier = StubVerifier()
+        self.checks = 0
+
+    def health_check(self):
+        self.checks += 1
+
+
+class Builder:
+    """build_client() stand-in recording the configs it built clients for, failing for ``fail_for`` hosts"""
+
+    def __init__(self):
+        self.built = []
+        self.fail_for = set()
+
+    def __call__(self, config: duo_config.DuoConfig) -> StubClient:
+        if config.api_hostname in self.fail_for:
+            raise ValueError(f"Cannot reach {config.api_hostname}")
+        self.built.append(config.section.name)
+        return StubClient(config)
+
+
+def load(main: dict = None, acme: dict = None, **sections) -> duo_config.DuoConfig:
+    parser = configparser.ConfigParser()
+    parser["duo"] = {**SECTION, **(main or {})}
+    parser["acme"] = {"api_hostname": "api-acme.duosecurity.com", "tenant_hosts": "acme.example.com, Login.Acme.test",
+                      **(acme or {})}
+    parser["beta"] = {"tenant_path": "/beta"}
+    parser.read_dict(sections)
+    return duo_config.from_section(parser["duo"])
+
+
+@pytest.fixture
+def builder():
+    return Builder()
+
+
+@pytest.fixture
+def registry(builder):
+    registry = duo_tenants.TenantRegistry(load(), builder)
+    yield registry
+    for tenant in registry:
+        tenant.close()
+
+
+@pytest.mark.parametrize("host, path, tenant, script_name, path_info", [
+        ("acme.example.com", "/login", "acme", "", "/login"),
+        ("LOGIN.ACME.TEST:8443", "/login", "acme", "", "/login"),
+        ("localhost", "/beta/login", "beta", "/beta", "/login"),
+        ("localhost", "/beta", "beta", "/beta", ""),
+        ("localhost", "/betamax/login", None, "", "/betamax/login"),
+        ("localhost", "/login", None, "", "/login"),
+        ("[::1]:8008", "/beta/duo-callback", "beta", "/beta", "/duo-callback"),
+        # The host wins over the path
+        ("acme.example.com", "/beta/login", "acme", "", "/beta/login"),
+], ids=["host", "host-port-case", "prefix", "prefix-only", "prefix-not-a-segment", "default", "ipv6-host",
+        "host-first"])
+def test_route(registry, host, path, tenant, script_name, path_info):
+    environ = {"HTTP_HOST": host, "PATH_INFO": path, "SCRIPT_NAME": ""}
+    routed = registry.route(environ)
+    assert routed is registry.get(tenant)
+    assert environ.get(duo_tenants.ENVIRON_KEY) == tenant
+    assert (environ["SCRIPT_NAME"], environ["PATH_INFO"]) == (script_name, path_info)
+
+
+def test_tenant_inherits_main_section(registry):
+    acme = registry.get("acme").context.config
+    assert acme.api_hostname == "api-acme.duosecurity.com"
+    assert acme.client_id == SECTION["client_id"]
+    assert registry.get("removed") is registry.default
+
+
+def test_clients_built_on_first_use(registry, builder):
+    assert builder.built == []
+    assert not any(tenant.is_built for tenant in registry)
+    context = registry.use(registry.get("acme"))
+    # use() starts the health checks, the client is built by the first login or check
+    client = context.client.get()
+    assert client.config.section.name == "acme"
+    assert context.client.get() is client
+    assert builder.built.count("acme") == 1
+    assert not registry.get("beta").is_built
+
+
+def test_idle_clients_evicted(builder):
+    registry = duo_tenants.TenantRegistry(load({"tenant_idle_timeout": "0.05"}), builder)
+    try:
+        registry.use(registry.get("acme")).client.get()
+        time.sleep(0.1)
+        # Using a tenant without a client sweeps right away
+        registry.use(registry.get("beta")).client.get()
+        assert not registry.get("acme").is_built
+        assert registry.get("beta").is_built
+        assert registry.evictions == 1
+        # The next use builds a new client
+        registry.use(registry.get("acme")).client.get()
+        assert builder.built.count("acme") == 2
+    finally:
+        for tenant in registry:
+            tenant.close()
+
+
+def test_max_clients_evicts_least_recently_used(builder):
+    registry = duo_tenants.TenantRegistry(load({"tenant_max_clients": "1"}), builder)
+    try:
+        registry.use(registry.get("acme")).client.get()
+        registry.use(registry.get("beta")).client.get()
+        assert not registry.get("acme").is_built
+        assert registry.get("acme").stats()["evictions"] == 1
+    finally:
+        for tenant in registry:
+            tenant.close()
+
+
+def test_check_in_flight_does_not_rebuild_evicted_client(registry, builder):
+    acme = registry.get("acme")
+    acme.use().client.get()
+    stale = acme.health
+    assert acme.evict()
+    # The stopped monitor's thread may still be running a check
+    stale.refresh()
+    assert not acme.is_built
+    assert builder.built.count("acme") == 1
+    # The new monitor builds the next client
+    acme.health.refresh()
+    assert acme.is_built
+
+
+def test_reload_rebuilds_changed_clients(registry, builder):
+    default = registry.default
+    old_client = default.use().client.get()
+    changes = registry.reload(load({"client_secret": "t" * 40, "failmode": "open", "tenants": "acme, gamma"},
+                                   gamma={"tenant_path": "/gamma"}))
+    assert changes["duo"] == {"client_secret", "failmode", "tenants"}
+    assert changes["beta"] == {"removed"} and changes["gamma"] == {"added"}
+    # A built client is rebuilt during the reload and keeps accepting tokens signed with the old secret
+    client = default.context.client.get()
+    assert client is not old_client and client.verifier.previous is old_client.verifier
+    assert default.context.config.fail_open
+    assert registry.get("beta") is registry.default
+
+
+def test_reload_failure_changes_nothing(registry, builder):
+    registry.use(registry.get("acme")).client.get()
+    before = {tenant.name: tenant.context for tenant in registry}
+    builder.fail_for.add("api-acme2.duosecurity.com")
+    with pytest.raises(ValueError):
+        registry.reload(load({"failmode": "open"}, acme={"api_hostname": "api-acme2.duosecurity.com"}))
+    assert {tenant.name: tenant.context for tenant in registry} == before
+    assert not registry.default.context.config.fail_open
+
+
+def test_prepare_commit_without_client_changes(registry):
+    acme = registry.get("acme")
+    client = acme.use().client
+    context, changed = acme.prepare(load(acme={"failmode": "open"}).tenants[0])
+    assert changed == {"failmode"}
+    assert context.client is client
+    assert not acme.context.config.fail_open
+    acme.commit(context)
+    assert acme.context.config.fail_open and acme.context.client is client
+
+
+def test_session_cookie_per_tenant(registry):
+    app = flask.Flask(__name__)
+    app.secret_key = "test"
+    app.session_interface = duo_tenants.TenantSessionInterface()
+    app.wsgi_app = duo_tenants.tenant_dispatcher(app.wsgi_app, lambda: registry)
+
+    @app.route("/login")
+    def login():
+        flask.session["user"] = "alice"
+        return "ok"
+
+    client = app.test_client()
+    cookies = {
+            "default": client.get("/login").headers["Set-Cookie"],
+            "path": client.get("/beta/login").headers["Set-Cookie"],
+            "host": client.get("/login", headers={"Host": "acme.example.com"}).headers["Set-Cookie"],
+    }
+    assert cookies["default"].startswith("session=")
+    assert cookies["path"].startswith("session_beta=") and "Path=/" in cookies["path"]
+    assert cookies["host"].startswith("session_acme=")
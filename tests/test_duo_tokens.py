@@ -0,0 +1,107 @@
+"""
+TokenVerifier rejects what jwt.decode() rejects, counts every failure, accepts a previous secret and only uses
+PyJWT's public API
+"""
+from __future__ import annotations, print_function
+
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+import jwt
+import pytest
+
+import duo_tokens
+
+SECRET = "a" * 40
+CLIENT_ID = "DIXXXXXXXXXXXXXXXXXX"
+ISSUER = "https://api-test.duosecurity.com/oauth/v1/token"
+
+
+def segment(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def token(secret: str = SECRET, algorithm: str = "HS512", headers: dict = None, **claims) -> str:
+    """Signed by hand, jwt.encode() refuses some of the malformed claims"""
+    now = int(time.time())
+    payload = {"aud": CLIENT_ID, "iss": ISSUER, "iat": now, "exp": now + 300, **claims}
+    signing_input = ".".join(segment(json.dumps(part).encode()) for part in (
+            {"alg": algorithm, "typ": "JWT", **(headers or {})},
+            {key: value for key, value in payload.items() if value is not None}))
+    digest = hashlib.sha256 if algorithm == "HS256" else hashlib.sha512
+    return f"{signing_input}.{segment(hmac.new(secret.encode(), signing_input.encode(), digest).digest())}"
+
+
+def decode(verifier: duo_tokens.TokenVerifier, value: str) -> dict:
+    return verifier.decode(value, audience=CLIENT_ID, issuer=ISSUER, leeway=60)
+
+
+def test_valid_token():
+    verifier = duo_tokens.TokenVerifier(SECRET)
+    assert decode(verifier, token(preferred_username="alice"))["preferred_username"] == "alice"
+    assert verifier.stats()["verified"] == 1
+
+
+@pytest.mark.parametrize("value", [
+        pytest.param(token(aud=123), id="aud-int"),
+        pytest.param(token(aud={"client": CLIENT_ID}), id="aud-dict"),
+        pytest.param(token(aud=[CLIENT_ID, 1]), id="aud-list-int"),
+        pytest.param(token(aud=None), id="aud-missing"),
+        pytest.param(token(iss=["x"]), id="iss-list"),
+        pytest.param(token(exp="soon"), id="exp-str"),
+        pytest.param(token(exp=int(time.time()) - 3600), id="expired"),
+        pytest.param(token(iat=None), id="iat-missing"),
+        pytest.param(token(iat=int(time.time()) + 3600), id="iat-future"),
+        pytest.param(token(headers={"crit": ["exp"]}), id="crit-unsupported"),
+        pytest.param(token(headers={"crit": "b64"}), id="crit-str"),
+        pytest.param(token(algorithm="HS256"), id="hs256"),
+        pytest.param(token(secret="b" * 40), id="other-secret"),
+        pytest.param("not.a.token", id="garbage"),
+        pytest.param("", id="empty"),
+        pytest.param(None, id="none"),
+])
+def test_malformed_tokens_rejected_and_counted(value):
+    verifier = duo_tokens.TokenVerifier(SECRET)
+    with pytest.raises(jwt.PyJWTError):
+        decode(verifier, value)
+    assert verifier.stats()["failed"] == 1
+
+
+def test_same_rejections_as_pyjwt():
+    verifier = duo_tokens.TokenVerifier(SECRET)
+    now = int(time.time())
+    for value in (token(aud=123), token(headers={"crit": ["exp"]}), token(exp="soon"), token(iat=now + 3600),
+                  token(iss="https://other.example.com"), token(nbf=now + 3600), token(algorithm="HS256")):
+        with pytest.raises(jwt.PyJWTError) as expected:
+            jwt.decode(value, SECRET, algorithms=["HS512"], audience=CLIENT_ID, issuer=ISSUER, leeway=60,
+                       options={'require': ['exp', 'iat'], 'verify_iat': True})
+        with pytest.raises(expected.type):
+            decode(verifier, value)
+
+
+def test_previous_key_until_it_expires():
+    old = duo_tokens.TokenVerifier(SECRET)
+    new = duo_tokens.TokenVerifier("b" * 40, previous_key_ttl=0.2)
+    new.accept_previous(old)
+    assert decode(new, token())["aud"] == CLIENT_ID
+    assert decode(new, token(secret="b" * 40))["aud"] == CLIENT_ID
+    assert new.stats()["previous_key"] == 1
+    time.sleep(0.3)
+    with pytest.raises(jwt.InvalidSignatureError):
+        decode(new, token())
+    assert new.stats()["keys"] == 1
+
+
+def test_pyjwt_api_in_use():
+    # The public PyJWS API TokenVerifier relies on, requirements.txt pins the tested PyJWT versions
+    jws = jwt.PyJWS(algorithms=[])
+    assert jws.get_algorithms() == []
+    jws.register_algorithm(duo_tokens.ALGORITHM, duo_tokens._PreparedHMAC())
+    assert jws.get_algorithms() == [duo_tokens.ALGORITHM]
+    verifier = duo_tokens.TokenVerifier(SECRET)
+    verifier.warm()
+    # The module level jwt.decode() keeps PyJWT's own HS512
+    assert jwt.decode(token(), SECRET, algorithms=["HS512"], audience=CLIENT_ID)["aud"] == CLIENT_ID
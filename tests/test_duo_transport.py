@@ -0,0 +1,88 @@
+"""
+PooledTransport counts connections taken from its pools as hits, misses and reconnects against a local keep-alive
+server, and transport_from_config treats empty timeouts as waiting indefinitely
+"""
+from __future__ import annotations, print_function
+
+import configparser
+import http.server
+import threading
+
+import pytest
+
+import duo_transport
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b'{"stat": "OK"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.path == "/close":
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_pooled_connections_reused(server):
+    transport = duo_transport.PooledTransport(2)
+    try:
+        for _ in range(3):
+            assert transport.post(f"{server}/health", data={"a": "b"}).status_code == 200
+        assert transport.stats.as_dict() == {"requests": 3, "pool_hits": 2, "pool_misses": 1, "reconnects": 0}
+        # A connection the server closed is taken from the pool again and has to reconnect
+        transport.post(f"{server}/close")
+        transport.post(f"{server}/health")
+        assert transport.stats.as_dict() == {"requests": 5, "pool_hits": 3, "pool_misses": 1, "reconnects": 1}
+    finally:
+        transport.close()
+
+
+def test_unpooled_transport_counts_every_request_as_a_miss(server):
+    transport = duo_transport.Transport()
+    for _ in range(2):
+        transport.post(f"{server}/health")
+    assert transport.stats.as_dict() == {"requests": 2, "pool_hits": 0, "pool_misses": 2, "reconnects": 0}
+
+
+def section(values: dict) -> configparser.SectionProxy:
+    parser = configparser.ConfigParser()
+    parser["duo"] = values
+    return parser["duo"]
+
+
+@pytest.mark.parametrize("values, timeout", [
+        ({}, None),
+        ({"http_connect_timeout": "", "http_read_timeout": " "}, None),
+        ({"http_connect_timeout": "3.05"}, (3.05, None)),
+        ({"http_connect_timeout": "", "http_read_timeout": "10"}, (None, 10.0)),
+        ({"http_connect_timeout": "3", "http_read_timeout": "10"}, (3.0, 10.0)),
+])
+def test_empty_timeouts_wait_indefinitely(values, timeout):
+    transport = duo_transport.transport_from_config(section(values))
+    assert transport.timeout == timeout
+
+
+def test_transport_from_config():
+    transport = duo_transport.transport_from_config(section({"http_pool_size": "4", "http_max_retries": "2"}))
+    assert isinstance(transport, duo_transport.PooledTransport) and transport.pool_size == 4
+    assert transport.session.get_adapter("https://api.duosecurity.com").max_retries.total == 2
+    transport.close()
+    assert type(duo_transport.transport_from_config(section({"http_pool": "false"}))) is duo_transport.Transport
@@ -0,0 +1,235 @@
+"""
+get_logger() stays idempotent: repeated and concurrent calls neither add handlers nor write a record twice.
+Queue listeners are restarted by forked server workers, not by the bcrypt pool processes, and keep running when a
+stream fails.
+"""
+from __future__ import annotations, print_function
+
+import configparser
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+import duo_utils
+
+
+class CountingStream:
+    """Wraps a handler's stream and counts the write() calls"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        return self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@pytest.fixture
+def logger_name(tmp_path, monkeypatch, request):
+    # Log files are written to ./logs
+    monkeypatch.chdir(tmp_path)
+    name = f"test_{request.node.name}"
+    yield name
+    duo_utils.remove_logger(name)
+
+
+def file_handler(logger_name: str) -> duo_utils.SizeTimeRotatingFileHandler:
+    return next(handler for key, handler in duo_utils._SINKS.items()
+                if key[0] == "file" and key[1].endswith(logger_name + ".log"))
+
+
+def writes_per_record(logger: logging.Logger, handler: logging.Handler) -> int:
+    stream = handler.stream = CountingStream(handler.stream)
+    try:
+        logger.info("one record")
+        handler.flush()
+        return stream.writes
+    finally:
+        handler.stream = stream.stream
+
+
+def test_repeated_calls_keep_one_handler_and_constant_writes(logger_name):
+    logger = duo_utils.get_logger(logger_name, log_to_console=False)
+    handler = file_handler(logger_name)
+    expected_writes = writes_per_record(logger, handler)
+    sinks = len(duo_utils._SINKS)
+    for _ in range(50):
+        assert duo_utils.get_logger(logger_name, log_to_console=False) is logger
+    assert logger.handlers == [handler]
+    assert len(duo_utils._SINKS) == sinks
+    assert expected_writes >= 1
+    assert writes_per_record(logger, handler) == expected_writes
+
+
+def test_concurrent_calls_keep_one_handler(logger_name):
+    logger = duo_utils.get_logger(logger_name, log_to_console=False)
+    handler = file_handler(logger_name)
+    expected_writes = writes_per_record(logger, handler)
+    barrier = threading.Barrier(8)
+
+    def call():
+        barrier.wait()
+        for _ in range(25):
+            duo_utils.get_logger(logger_name, log_to_console=False)
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert logger.handlers == [handler]
+    assert writes_per_record(logger, handler) == expected_writes
+
+
+def test_queue_logger_keeps_one_listener(logger_name):
+    logger = duo_utils.get_logger(logger_name, log_to_console=False, use_queue=True)
+    listeners = len(duo_utils._LISTENERS)
+    for _ in range(20):
+        duo_utils.get_logger(logger_name, log_to_console=False, use_queue=True)
+    assert len(logger.handlers) == 1
+    assert isinstance(logger.handlers[0], duo_utils.BoundedQueueHandler)
+    assert len(duo_utils._LISTENERS) == listeners
+
+
+def test_changed_sinks_replace_the_previous_handlers(logger_name):
+    logger = duo_utils.get_logger(logger_name, log_to_console=False)
+    duo_utils.get_logger(logger_name, log_to_console=True)
+    assert len(logger.handlers) == 2
+    duo_utils.get_logger(logger_name, log_to_console=False)
+    assert len(logger.handlers) == 1
+
+
+def test_pool_processes_start_no_listener_threads(logger_name):
+    duo_utils.get_logger(logger_name, log_to_console=False, use_queue=True)
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("fork")) as pool:
+        assert pool.submit(threading.active_count).result() == 1
+
+
+def test_forked_worker_restarts_listeners(logger_name):
+    logger = duo_utils.get_logger(logger_name, log_to_console=False, use_queue=True)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            duo_utils.restart_listeners_after_fork()
+            logger.info("from the worker")
+            duo_utils._stop_listeners()
+            with open(file_handler(logger_name).baseFilename) as fh:
+                os._exit(0 if "from the worker" in fh.read() else 1)
+        finally:
+            os._exit(2)
+    assert os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) == 0
+    # Nothing to restart in the process that started the listeners
+    threads = threading.active_count()
+    duo_utils.restart_listeners_after_fork()
+    assert threading.active_count() == threads
+
+
+def test_changed_file_settings_rebuild_the_handler(logger_name):
+    logger = duo_utils.get_logger(logger_name, log_to_console=False)
+    old = file_handler(logger_name)
+    logger.info("before")
+    duo_utils.get_logger(logger_name, log_to_console=False, log_message_format="{levelname}: {message}",
+                         max_bytes=1024, backup_count=2, rotate_interval=60)
+    new = file_handler(logger_name)
+    assert new is not old and old.stream is None
+    assert logger.handlers == [new]
+    assert (new.maxBytes, new.backupCount, new.rotate_interval) == (1024, 2, 60)
+    logger.info("after")
+    with open(new.baseFilename) as fh:
+        assert fh.read().endswith("INFO: after\n")
+    duo_utils.get_logger(logger_name, log_to_console=False, log_json=True)
+    assert isinstance(file_handler(logger_name).formatter, duo_utils.JSONFormatter)
+
+
+def test_loggers_sharing_a_file_follow_the_new_settings(logger_name):
+    other = logger_name + "_other"
+    try:
+        direct = duo_utils.get_logger(other, log_to_console=False, logfile_name=logger_name + ".log")
+        queued = duo_utils.get_logger(logger_name, log_to_console=False, use_queue=True)
+        old = file_handler(logger_name)
+        duo_utils.get_logger(logger_name, log_to_console=False, use_queue=True, max_bytes=2048)
+        new = file_handler(logger_name)
+        assert new.maxBytes == 2048 and old.stream is None
+        assert direct.handlers == [new]
+        listener = duo_utils._REGISTRY[logger_name][2]
+        assert listener.handlers == (new,)
+        assert queued.handlers[0].queue is listener.queue
+    finally:
+        duo_utils.remove_logger(other)
+
+
+def test_removed_logger_closes_its_file(logger_name):
+    logger = duo_utils.get_logger(logger_name, log_to_console=False)
+    handler = file_handler(logger_name)
+    logger.info("opens the file")
+    assert handler.stream is not None
+    duo_utils.remove_logger(logger_name)
+    assert handler.stream is None
+    assert handler not in duo_utils._SINKS.values()
+
+
+def test_logging_options_from_config():
+    config = configparser.ConfigParser()
+    config["duo"] = {"log_json": "true", "log_max_mb": "2", "log_rotate_interval": "3600", "log_queue_size": "50",
+                     "log_queue_policy": "block", "log_batch_size": "10", "log_level": "debug"}
+    options = duo_utils.logging_options_from_config(config["duo"])
+    assert options == {"log_level": "DEBUG", "log_json": True, "max_bytes": 2 * 1024 * 1024, "backup_count": 5,
+                       "rotate_interval": 3600.0, "queue_size": 50, "queue_policy": "block", "batch_size": 10}
+    config["duo"]["log_queue_policy"] = "spill"
+    with pytest.raises(ValueError):
+        duo_utils.logging_options_from_config(config["duo"])
+
+
+def test_dropped_records_counted_from_threads():
+    handler = duo_utils.BoundedQueueHandler(queue.Queue(maxsize=1))
+    record = logging.makeLogRecord({"msg": "record"})
+    threads = [threading.Thread(target=lambda: [handler.handle(record) for _ in range(500)]) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert handler.dropped == 8 * 500 - 1
+
+
+def test_log_queue_stats(logger_name):
+    logger = duo_utils.get_logger(logger_name, log_to_console=False, use_queue=True, queue_size=5)
+    handler = logger.handlers[0]
+    handler.dropped = 3
+    stats = duo_utils.log_queue_stats()
+    assert stats[(logger_name, "dropped")] == 3
+    assert stats[(logger_name, "queued")] >= 0
+
+
+def test_failing_flush_keeps_the_writer_running(logger_name):
+    logger = duo_utils.get_logger(logger_name, log_to_console=False, use_queue=True)
+    handler = file_handler(logger_name)
+    listener = duo_utils._REGISTRY[logger_name][2]
+    # Opens the file
+    logger.info("start")
+    logger.handlers[0].queue.join()
+
+    class ClosedOnFlush(CountingStream):
+        def flush(self):
+            raise ValueError("I/O operation on closed file.")
+
+    stream = handler.stream = ClosedOnFlush(handler.stream)
+    try:
+        logger.info("first")
+        logger.info("second")
+        deadline = time.monotonic() + 5
+        while stream.writes < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert stream.writes >= 2
+        assert listener._thread.is_alive()
+    finally:
+        handler.stream = stream.stream
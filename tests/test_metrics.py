@@ -0,0 +1,94 @@
+"""
+Counters, histograms and gauges render in the Prometheus text format with cumulative, inclusive buckets
+"""
+from __future__ import annotations, print_function
+
+import threading
+
+import metrics
+
+
+def sample_lines(text: str) -> list[str]:
+    return [line for line in text.splitlines() if not line.startswith("#")]
+
+
+def test_counter_rendering():
+    registry = metrics.MetricsRegistry()
+    logins = registry.counter("duo_logins_total", "Login outcomes", ("tenant", "outcome"))
+    logins.inc("duo", "success")
+    logins.inc("duo", "success", amount=2)
+    logins.inc('a"b\\c\nd', "failure")
+    text = registry.render()
+    assert text.startswith("# HELP duo_logins_total Login outcomes\n# TYPE duo_logins_total counter\n")
+    assert sample_lines(text) == [
+            'duo_logins_total{tenant="a\\"b\\\\c\\nd",outcome="failure"} 1',
+            'duo_logins_total{tenant="duo",outcome="success"} 3',
+    ]
+    assert text.endswith("\n")
+
+
+def test_histogram_buckets():
+    registry = metrics.MetricsRegistry()
+    latency = registry.histogram("duo_stage_seconds", "Stage latency", ("stage",), buckets=(0.5, 0.1, 1.0))
+    assert latency.buckets == (0.1, 0.5, 1.0)
+    # An observation equal to a bound counts in that bucket, le is inclusive
+    for value in (0.05, 0.1, 0.3, 1.0, 7.5):
+        latency.observe(value, "lookup")
+    assert sample_lines(registry.render()) == [
+            'duo_stage_seconds_bucket{stage="lookup",le="0.1"} 2',
+            'duo_stage_seconds_bucket{stage="lookup",le="0.5"} 3',
+            'duo_stage_seconds_bucket{stage="lookup",le="1.0"} 4',
+            'duo_stage_seconds_bucket{stage="lookup",le="+Inf"} 5',
+            'duo_stage_seconds_sum{stage="lookup"} 8.95',
+            'duo_stage_seconds_count{stage="lookup"} 5',
+    ]
+    assert latency.snapshot() == {"lookup": {"count": 5, "mean_seconds": 8.95 / 5}}
+
+
+def test_histogram_timer():
+    latency = metrics.Histogram("duo_seconds", "Latency")
+    with latency.time():
+        pass
+    name, labels, extra, value = list(latency.samples())[0]
+    assert (name, labels, extra, value) == ("duo_seconds_bucket", (), 'le="0.0005"', 1)
+
+
+def test_gauges():
+    registry = metrics.MetricsRegistry()
+    registry.gauge("duo_up", "Health", lambda: 1)
+    registry.gauge("duo_pool", "Pool", lambda: {"idle": 2, "busy": 1.5, "name": "skipped"}, ("state",))
+    registry.gauge("duo_tenants", "Tenants", lambda: {("acme", "built"): 1}, ("tenant", "stat"))
+    assert sample_lines(registry.render()) == [
+            "duo_up 1",
+            'duo_pool{state="busy"} 1.5',
+            'duo_pool{state="idle"} 2',
+            'duo_tenants{tenant="acme",stat="built"} 1',
+    ]
+    # Registering again replaces the callback, configure() rebuilds the objects it reads
+    registry.gauge("duo_up", "Health", lambda: 0)
+    assert "duo_up 0" in sample_lines(registry.render())
+
+
+def test_registering_a_counter_again_keeps_its_values():
+    registry = metrics.MetricsRegistry()
+    registry.counter("duo_total", "Total").inc()
+    assert registry.counter("duo_total", "Total").value() == 1
+    assert registry.snapshot() == {"duo_total": {"duo_total": 1}}
+
+
+def test_concurrent_increments():
+    counter = metrics.Counter("duo_total", "Total", ("worker",))
+    histogram = metrics.Histogram("duo_seconds", "Latency")
+
+    def work():
+        for _ in range(2000):
+            counter.inc("a")
+            histogram.observe(0.01)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.value("a") == 16000
+    assert histogram.snapshot()["duo_seconds"]["count"] == 16000
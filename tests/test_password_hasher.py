@@ -0,0 +1,73 @@
+"""
+PasswordHasher keeps the slot of a timed out operation until its worker is done, and rejects missing passwords
+and passwords bcrypt can not hash
+"""
+from __future__ import annotations, print_function
+
+import time
+
+import pytest
+
+import password_hasher
+
+
+@pytest.fixture
+def hasher():
+    hasher = password_hasher.PasswordHasher(4, max_workers=1, max_queue=0, timeout=0.2)
+    # Start the worker process outside of the timed operations
+    hasher.check(hasher.hash("warm-up"), "warm-up")
+    yield hasher
+    hasher.shutdown()
+
+
+def test_slot_held_until_timed_out_operation_ends(hasher):
+    with pytest.raises(password_hasher.HasherBusy, match="timed out"):
+        hasher._run("hash", time.sleep, 1.0)
+    # The worker still runs the operation, nothing else is admitted
+    with pytest.raises(password_hasher.HasherBusy, match="queue is full"):
+        hasher.hash("password")
+    time.sleep(1.2)
+    assert hasher.check(hasher.hash("password"), "password")
+
+
+@pytest.mark.parametrize("password", [None, b"password", 123])
+def test_invalid_password(hasher, password):
+    with pytest.raises(password_hasher.InvalidPassword):
+        hasher.hash(password)
+    with pytest.raises(password_hasher.InvalidPassword):
+        hasher.check(hasher.hash("password"), password)
+    # Also a ValueError, for callers that do not know the hasher
+    with pytest.raises(ValueError):
+        hasher.check(None, password)
+
+
+def test_no_stored_hash(hasher):
+    assert not hasher.check(None, "password")
+    assert not hasher.check("", "password")
+
+
+@pytest.mark.parametrize("password, valid", [
+        ("x" * 72, True),
+        ("x" * 73, False),
+        ("é" * 36, True),
+        ("é" * 37, False),
+], ids=["72-ascii", "73-ascii", "72-bytes-utf8", "74-bytes-utf8"])
+def test_password_length_in_bytes(hasher, password, valid):
+    if valid:
+        assert hasher.check(hasher.hash(password), password)
+        return
+    with pytest.raises(password_hasher.InvalidPassword, match="longer than 72 bytes"):
+        hasher.hash(password)
+    with pytest.raises(password_hasher.InvalidPassword):
+        hasher.check(hasher.hash("password"), password)
+
+
+def test_too_long_password_answers_400():
+    app_with_duo = pytest.importorskip("app_with_duo")
+    app = app_with_duo.app
+    with app.test_request_context("/register", method="POST", data={"username": "alice", "password": "x" * 100}):
+        with pytest.raises(password_hasher.InvalidPassword) as excinfo:
+            password_hasher._encode("x" * 100)
+        response = app.make_response(app.handle_user_exception(excinfo.value))
+    assert response.status_code == 400
+    assert b"longer than 72 bytes" in response.data
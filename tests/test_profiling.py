@@ -0,0 +1,84 @@
+"""
+Only allowed addresses or the configured token read the profiler traces, and the ring buffer can be read while
+requests record into it
+"""
+from __future__ import annotations, print_function
+
+import configparser
+import threading
+
+import pytest
+
+import profiling
+
+
+def section(**values):
+    parser = configparser.ConfigParser()
+    parser["duo"] = values
+    return parser["duo"]
+
+
+def test_nobody_allowed_by_default():
+    access = profiling.endpoint_access_from_config(section())
+    assert not access.permits("127.0.0.1")
+    assert not access.permits("127.0.0.1", "Bearer ")
+
+
+@pytest.mark.parametrize("remote_addr, authorization, permitted", [
+        ("127.0.0.1", None, True),
+        ("::1", None, True),
+        ("10.0.0.7", None, True),
+        ("10.0.1.7", None, False),
+        # A local reverse proxy forwarding for anyone is not enough without the loopback entry
+        ("127.0.0.2", None, False),
+        ("203.0.113.9", "Bearer s3cret-token", True),
+        ("203.0.113.9", "bearer s3cret-token", True),
+        ("203.0.113.9", "Bearer wrong", False),
+        ("203.0.113.9", "Basic s3cret-token", False),
+        (None, None, False),
+        ("not an address", None, False),
+], ids=["loopback", "loopback-v6", "network", "outside-network", "other-loopback", "token", "token-lowercase",
+        "wrong-token", "wrong-scheme", "no-address", "bad-address"])
+def test_allowlist_and_token(remote_addr, authorization, permitted):
+    access = profiling.endpoint_access_from_config(
+            section(profile_allowed_ips="127.0.0.1, ::1, 10.0.0.0/24", profile_token="s3cret-token"))
+    assert access.permits(remote_addr, authorization) is permitted
+
+
+def test_invalid_allowlist():
+    with pytest.raises(ValueError):
+        profiling.endpoint_access_from_config(section(profile_allowed_ips="localhost"))
+
+
+def test_traces_while_recording():
+    profiler = profiling.Profiler(1.0, slow_threshold=0, buffer_size=5)
+    stop = threading.Event()
+    errors = []
+
+    def requests():
+        while not stop.is_set():
+            trace = profiler.sample({"REQUEST_METHOD": "GET", "PATH_INFO": "/login"})
+            trace.close(trace.open("db SELECT"))
+            profiler.record(trace)
+
+    def reader():
+        try:
+            for _ in range(500):
+                assert len(profiler.traces()) <= 5
+                profiler.folded()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=requests) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        reader()
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    assert not errors
+    stats = profiler.stats()
+    assert stats["requests"] == stats["sampled"] == stats["slow"]
+    assert stats["buffered"] == 5
@@ -0,0 +1,146 @@
+"""
+Token buckets in memory and in SQLite refill over their period, limit IPs and usernames separately, and the
+login form answers 429 with Retry-After
+"""
+from __future__ import annotations, print_function
+
+import configparser
+import threading
+import time
+
+import pytest
+
+import duo_config
+import duo_tenants
+import rate_limit
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return rate_limit.MemoryRateLimiter()
+    return rate_limit.SQLiteRateLimiter(str(tmp_path / "ratelimit.sqlite"))
+
+
+def test_burst_then_refill(backend):
+    limit = rate_limit.RateLimit(3, 0.3)
+    assert [backend.hit("ip:10.0.0.1", limit) for _ in range(3)] == [0, 0, 0]
+    wait = backend.hit("ip:10.0.0.1", limit)
+    # One token every 0.1 seconds
+    assert 0 < wait <= 0.1
+    # Other keys have their own bucket
+    assert backend.hit("ip:10.0.0.2", limit) == 0
+    time.sleep(wait + 0.02)
+    assert backend.hit("ip:10.0.0.1", limit) == 0
+    assert backend.hit("ip:10.0.0.1", limit) > 0
+
+
+def test_sweep_forgets_idle_buckets(backend):
+    limit = rate_limit.RateLimit(1, 60)
+    backend.hit("user:alice", limit)
+    time.sleep(0.05)
+    backend.hit("user:bob", limit)
+    assert backend.sweep(0.03) == 1
+    # alice starts over with a full bucket, bob is still limited
+    assert backend.hit("user:alice", limit) == 0
+    assert backend.hit("user:bob", limit) > 0
+
+
+def test_sqlite_buckets_shared_between_connections(tmp_path):
+    path = str(tmp_path / "ratelimit.sqlite")
+    limit = rate_limit.RateLimit(10, 60)
+    waits = []
+
+    def worker():
+        # A backend per thread, like one per worker process
+        backend = rate_limit.SQLiteRateLimiter(path)
+        waits.extend(backend.hit("user:alice", limit) for _ in range(5))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(1 for wait in waits if wait == 0) == 10
+
+
+def test_memory_eviction_starts_over():
+    backend = rate_limit.MemoryRateLimiter(max_keys=2)
+    limit = rate_limit.RateLimit(1, 60)
+    backend.hit("user:alice", limit)
+    backend.hit("user:bob", limit)
+    backend.hit("user:carol", limit)
+    assert backend.evictions == 1 and len(backend) == 2
+    # The least recently used bucket was dropped, documented in MemoryRateLimiter
+    assert backend.hit("user:alice", limit) == 0
+    assert backend.hit("user:carol", limit) > 0
+
+
+def test_ip_and_username_limits():
+    limiter = rate_limit.LoginRateLimiter(rate_limit.MemoryRateLimiter(),
+                                          per_ip=rate_limit.RateLimit(2, 60),
+                                          per_username=rate_limit.RateLimit(2, 60))
+    limiter.check("10.0.0.1", "alice")
+    # Usernames are compared case insensitively
+    limiter.check("10.0.0.2", " Alice ")
+    with pytest.raises(rate_limit.RateLimitExceeded, match="for alice") as excinfo:
+        limiter.check("10.0.0.3", "alice")
+    assert excinfo.value.retry_after == 30
+    # Another username from the same IP counts against the IP
+    limiter.check("10.0.0.1", "bob")
+    with pytest.raises(rate_limit.RateLimitExceeded, match="from 10.0.0.1"):
+        limiter.check("10.0.0.1", "carol")
+    # No IP, e.g. a unix socket: only the username limit applies
+    limiter.check(None, "dave")
+    assert limiter.stats() == {"ip": 1, "username": 1}
+
+
+def test_rejections_counted_from_many_threads():
+    limiter = rate_limit.LoginRateLimiter(rate_limit.MemoryRateLimiter(), per_username=rate_limit.RateLimit(1, 60))
+    limiter.check(None, "alice")
+    barrier = threading.Barrier(8)
+
+    def attempts():
+        barrier.wait()
+        for _ in range(500):
+            with pytest.raises(rate_limit.RateLimitExceeded):
+                limiter.check(None, "alice")
+
+    threads = [threading.Thread(target=attempts) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert limiter.stats()["username"] == 4000
+
+
+@pytest.mark.parametrize("values, backend_type", [
+        ({}, rate_limit.MemoryRateLimiter),
+        ({"ratelimit_store": "SQLite"}, rate_limit.SQLiteRateLimiter),
+        ({"ratelimit_ip_burst": "0", "ratelimit_user_burst": "0"}, None),
+        ({"ratelimit_enabled": "false"}, None),
+])
+def test_from_config(tmp_path, values, backend_type):
+    parser = configparser.ConfigParser()
+    parser["duo"] = values
+    limiter = rate_limit.rate_limiter_from_config(parser["duo"], str(tmp_path))
+    assert (type(limiter.backend) if limiter is not None else None) is backend_type
+
+
+def test_login_answers_429_with_retry_after(monkeypatch):
+    app_with_duo = pytest.importorskip("app_with_duo")
+    parser = configparser.ConfigParser()
+    parser["duo"] = {"client_id": "DIXXXXXXXXXXXXXXXXXX", "client_secret": "s" * 40,
+                     "api_hostname": "api.duosecurity.com", "redirect_uri": "https://example.com/duo-callback"}
+    monkeypatch.setattr(app_with_duo, "audit_log", None)
+    monkeypatch.setattr(app_with_duo, "tenant_registry",
+                        duo_tenants.TenantRegistry(duo_config.from_section(parser["duo"]), lambda config: None))
+    limiter = rate_limit.LoginRateLimiter(rate_limit.MemoryRateLimiter(), per_username=rate_limit.RateLimit(1, 90))
+    limiter.check(None, "alice")
+    with app_with_duo.app.test_request_context("/login", method="POST", data={"username": "alice"}):
+        with pytest.raises(rate_limit.RateLimitExceeded) as excinfo:
+            limiter.check(None, "alice")
+        response = app_with_duo.app.make_response(app_with_duo.app.handle_user_exception(excinfo.value))
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "90"
+    assert b"Too many login attempts" in response.data
@@ -0,0 +1,78 @@
+"""
+The file store stays within max_pending between sweeps and drops corrupt states, evictions are counted from every
+thread, and only live states count as pending
+"""
+from __future__ import annotations, print_function
+
+import os
+import threading
+import time
+import uuid
+
+import pytest
+
+import state_store
+
+
+def flood(store: state_store.StateStore, logins: int, threads: int = 8):
+    def run():
+        for i in range(logins // threads):
+            store.put(uuid.uuid4().hex, {"user_id": i}, user=f"user{i}")
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def test_file_store_bounded_without_sweep(tmp_path):
+    store = state_store.FileStateStore(str(tmp_path), max_pending=50)
+    flood(store, 400)
+    count, _ = store.pending()
+    # Threads that listed the directory at the same time may each add their state
+    assert count <= 50 + 8
+    assert count + store.counters["evicted_capacity"] == 400
+
+
+def test_file_store_keeps_newest(tmp_path):
+    store = state_store.FileStateStore(str(tmp_path), max_pending=10)
+    states = [uuid.uuid4().hex for _ in range(25)]
+    for i, state in enumerate(states):
+        store.put(state, {"user_id": i})
+    assert store.consume(states[-1]) == {"user_id": 24}
+    assert store.consume(states[0]) is None
+
+
+def test_sqlite_counters_from_threads(tmp_path):
+    store = state_store.SQLiteStateStore(str(tmp_path / "state.sqlite"), max_pending=50)
+    flood(store, 400)
+    count, _ = store.pending()
+    assert count == 50
+    assert store.counters["evicted_capacity"] == 350
+
+
+@pytest.mark.parametrize("content", ["", '{"expires": ', "[1, 2]", '{"data": {}}', "null"],
+                         ids=["empty", "truncated", "list", "no-expiry", "null"])
+def test_file_store_corrupt_state(tmp_path, content):
+    store = state_store.FileStateStore(str(tmp_path))
+    state = uuid.uuid4().hex
+    store.put(state, {"user_id": 1})
+    with open(os.path.join(str(tmp_path), state + ".json"), "w") as fh:
+        fh.write(content)
+    assert store.consume(state) is None
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_memory_store_pending_counts_live_states():
+    store = state_store.MemoryStateStore(ttl=0.1)
+    for i in range(3):
+        store.put(uuid.uuid4().hex, {"user_id": i})
+    time.sleep(0.15)
+    live = uuid.uuid4().hex
+    store.put(live, {"user_id": 3})
+    count, oldest = store.pending()
+    assert count == 1
+    assert time.time() - oldest < 0.1
+    assert store.stats()["expired"] == 3
+    assert store.consume(live) == {"user_id": 3}
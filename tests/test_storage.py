@@ -0,0 +1,109 @@
+"""
+ensure_schema() creates the tables once per schema version using PRAGMA user_version, and read replicas are
+read-only, used in turn and fall back to the primary for rows they do not have yet
+"""
+from __future__ import annotations, print_function
+
+import configparser
+
+import pytest
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, inspect, insert, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import NoResultFound, OperationalError
+from sqlalchemy.orm import Session
+
+import storage
+
+metadata = MetaData()
+users = Table("users", metadata, Column("id", Integer, primary_key=True), Column("username", String))
+
+
+def section(values: dict = None) -> configparser.SectionProxy:
+    parser = configparser.ConfigParser()
+    parser["duo"] = values or {}
+    return parser["duo"]
+
+
+def engine_for(path) -> Engine:
+    engine = create_engine(f"sqlite:///{path}")
+    storage.install_pragmas(engine, storage.sqlite_pragmas(section()))
+    return engine
+
+
+def user_version(engine) -> int:
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def test_ensure_schema_once_per_version(tmp_path):
+    engine = engine_for(tmp_path / "db.sqlite")
+    assert storage.ensure_schema(engine, metadata, 1)
+    assert user_version(engine) == 1 and inspect(engine).has_table("users")
+    # Marked as version 1, not even inspected again
+    assert not storage.ensure_schema(engine, metadata, 1)
+
+
+def test_ensure_schema_migrates_to_a_new_version(tmp_path):
+    engine = engine_for(tmp_path / "db.sqlite")
+    storage.ensure_schema(engine, metadata, 1)
+    with engine.begin() as conn:
+        conn.execute(insert(users).values(username="alice"))
+    newer = MetaData()
+    for table in metadata.tables.values():
+        table.to_metadata(newer)
+    Table("audit", newer, Column("id", Integer, primary_key=True))
+    assert storage.ensure_schema(engine, newer, 2)
+    assert user_version(engine) == 2 and inspect(engine).has_table("audit")
+    # Existing tables and rows are kept
+    with engine.connect() as conn:
+        assert conn.execute(select(users.c.username)).scalar_one() == "alice"
+
+
+@pytest.fixture
+def primary(tmp_path):
+    engine = engine_for(tmp_path / "db.sqlite")
+    storage.ensure_schema(engine, metadata, 1)
+    with engine.begin() as conn:
+        conn.execute(insert(users).values(username="alice"))
+    yield engine
+    engine.dispose()
+
+
+def test_replicas_read_only_and_round_robin(tmp_path, primary):
+    uri = f"sqlite:///{tmp_path / 'db.sqlite'}"
+    replicas = storage.read_replicas_from_config(section({"db_read_replicas": f"{uri}, {uri}"}))
+    try:
+        engines = []
+        for _ in range(4):
+            with replicas.session() as session:
+                engines.append(session.get_bind())
+                assert session.execute(select(users.c.username)).scalar_one() == "alice"
+        assert engines == replicas.engines * 2
+        with replicas.session() as session, pytest.raises(OperationalError, match="readonly|read-only|query_only"):
+            session.execute(insert(users).values(username="mallory"))
+    finally:
+        replicas.dispose()
+
+
+def test_replica_falls_back_to_primary(tmp_path, primary):
+    # A replica that has not caught up with the primary yet
+    lagging = engine_for(tmp_path / "replica.sqlite")
+    storage.ensure_schema(lagging, metadata, 1)
+    uri = f"sqlite:///{tmp_path / 'replica.sqlite'}"
+    replicas = storage.read_replicas_from_config(section({"db_read_replicas": uri}))
+    statement = select(users.c.username).where(users.c.username == "alice")
+    try:
+        with Session(primary) as session:
+            assert replicas.scalar_one(statement, session) == "alice"
+            with pytest.raises(NoResultFound):
+                replicas.scalar_one(select(users.c.username).where(users.c.username == "bob"), session)
+    finally:
+        replicas.dispose()
+        lagging.dispose()
+
+
+def test_no_replicas_uses_primary(primary):
+    replicas = storage.read_replicas_from_config(section({"db_read_replicas": " , "}))
+    assert not replicas
+    with Session(primary) as session:
+        assert replicas.scalar_one(select(users.c.username), session) == "alice"
@@ -0,0 +1,112 @@
+"""
+UsernameIndex syncs once for concurrent misses, grows its filter off the request thread and picks up ids
+committed out of order
+"""
+from __future__ import annotations, print_function
+
+import threading
+import time
+
+import user_index
+
+
+class Table:
+    """(id, username) rows served like usernames_after(), recording which thread read from which id"""
+
+    def __init__(self, count: int, delay: float = 0.0):
+        self.rows = [(i, f"user{i}") for i in range(1, count + 1)]
+        self.delay = delay
+        self.readers = []
+        self.lock = threading.Lock()
+
+    def register(self, count: int):
+        with self.lock:
+            start = len(self.rows) + 1
+            self.rows += [(i, f"user{i}") for i in range(start, start + count)]
+
+    def commit(self, user_id: int):
+        """Commit a single id, which need not be above the ids already committed"""
+        with self.lock:
+            self.rows = sorted(self.rows + [(user_id, f"user{user_id}")])
+
+    def __call__(self, after_id: int, limit: int) -> list:
+        self.readers.append((threading.current_thread().name, after_id))
+        time.sleep(self.delay)
+        with self.lock:
+            return [row for row in self.rows if row[0] > after_id][:limit]
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_concurrent_misses_sync_once():
+    table = Table(10, delay=0.05)
+    index = user_index.UsernameIndex(table, capacity=100, sync_interval=60)
+    index.rebuild()
+    syncs = index.counters["syncs"]
+    index._last_sync = 0.0
+    threads = [threading.Thread(target=index.might_exist, args=(f"nobody{i}",)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert index.counters["syncs"] == syncs + 1
+
+
+def test_growth_rebuild_runs_off_the_request_thread():
+    table = Table(50)
+    index = user_index.UsernameIndex(table, capacity=60, sync_interval=0, batch_size=1000)
+    index.rebuild()
+    table.register(30)
+    table.delay = 0.2
+    table.readers.clear()
+    start = time.monotonic()
+    # The sync adds the new users to the current filter, the full reload happens in the background
+    assert index.might_exist("user80")
+    assert not index.might_exist("nobody")
+    assert time.monotonic() - start < 1.0
+    request_thread = threading.current_thread().name
+    wait_for(lambda: index.stats()["capacity"] == 120)
+    assert index.stats()["usernames"] == 80
+    # Only the background thread read the whole table from the first id
+    assert ("duo-username-index-grow", 0) in table.readers
+    assert (request_thread, 0) not in table.readers
+
+
+def test_out_of_order_commit_found_by_periodic_rebuild():
+    table = Table(3)
+    index = user_index.UsernameIndex(table, capacity=100, sync_interval=0, rebuild_interval=0.2)
+    index.rebuild()
+    # Id 5 commits before id 4, the catch-up after id 5 never reads id 4
+    table.commit(5)
+    assert index.might_exist("user5")
+    table.commit(4)
+    assert index.stats()["usernames"] == 4
+    assert not index.might_exist("user4")
+    time.sleep(0.25)
+    index.might_exist("nobody")
+    wait_for(lambda: index.counters["rebuilds"] == 2)
+    assert index.might_exist("user4")
+    assert index.stats()["usernames"] == 5
+
+
+def test_counters_from_many_threads():
+    index = user_index.UsernameIndex(Table(10), capacity=100, sync_interval=60)
+    index.rebuild()
+    barrier = threading.Barrier(8)
+
+    def lookups():
+        barrier.wait()
+        for i in range(2000):
+            index.might_exist(f"user{i % 10 + 1}")
+
+    threads = [threading.Thread(target=lookups) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert index.counters["lookups"] == 16000
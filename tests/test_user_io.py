@@ -0,0 +1,82 @@
+"""
+import_users rejects records without a username or password, or whose password_hash is not a bcrypt hash, instead
+of storing them or stopping the import
+"""
+from __future__ import annotations, print_function
+
+import io
+import json
+import types
+
+import bcrypt
+import pytest
+import sqlalchemy as sa
+
+import password_hasher
+import user_io
+
+
+@pytest.fixture
+def database(tmp_path):
+    metadata = sa.MetaData()
+    table = sa.Table("users", metadata,
+                     sa.Column("id", sa.Integer, primary_key=True),
+                     sa.Column("username", sa.String(100), unique=True),
+                     sa.Column("password", sa.String(100)))
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'db.sqlite'}")
+    metadata.create_all(engine)
+    yield types.SimpleNamespace(engine=engine), table
+    engine.dispose()
+
+
+def test_invalid_hashes_rejected(database):
+    db, table = database
+    valid = bcrypt.hashpw(b"secret", bcrypt.gensalt(4)).decode()
+    lines = [
+            {"username": "alice", "password_hash": valid},
+            {"username": "bob", "password_hash": "5f4dcc3b5aa765d61d8327deb882cf99"},
+            {"username": "carol", "password_hash": valid[:-1]},
+            {"username": "dave", "password_hash": valid + "\n"},
+            {"username": "erin", "password_hash": valid.replace("$2b$", "$2x$")},
+            {"username": "frank", "password": 12345},
+            {"username": "grace", "password": "plain"},
+            {"username": "heidi", "password": "x" * 73},
+    ]
+    stream = io.StringIO("".join(json.dumps(line) + "\n" for line in lines))
+    hasher = password_hasher.PasswordHasher(4, max_workers=1)
+    try:
+        totals = user_io.import_users(db, table, user_io.read_users(stream, "jsonl"), hasher, batch_size=3)
+    finally:
+        hasher.shutdown()
+    assert (totals["read"], totals["inserted"], totals["rejected"]) == (8, 2, 6)
+    with db.engine.connect() as conn:
+        stored = dict(conn.execute(sa.select(table.c.username, table.c.password)).all())
+    assert stored.keys() == {"alice", "grace"}
+    assert stored["alice"] == valid and password_hasher.is_bcrypt_hash(stored["grace"])
+
+
+@pytest.mark.parametrize("fmt, text", [
+        ("jsonl", '{"username": "alice", "password": "one"}\n'
+                  '{"password": "no-username"}\n'
+                  '{"username": "bob"}\n'
+                  'not json\n'
+                  '["alice"]\n'
+                  '{"username": 7, "password": "number"}\n'
+                  '\n'
+                  '{"username": "  carol ", "password": "two"}\n'),
+        ("csv", "username,password,password_hash\n"
+                "alice,one,\n"
+                ",no-username,\n"
+                "bob,,\n"
+                "carol,two,\n"),
+], ids=["jsonl", "csv"])
+def test_incomplete_records_rejected_and_import_continues(database, fmt, text):
+    db, table = database
+    hasher = password_hasher.PasswordHasher(4, max_workers=1)
+    try:
+        totals = user_io.import_users(db, table, user_io.read_users(io.StringIO(text), fmt), hasher, batch_size=2)
+    finally:
+        hasher.shutdown()
+    assert totals["inserted"] == 2 and totals["rejected"] == totals["read"] - 2
+    with db.engine.connect() as conn:
+        assert set(conn.execute(sa.select(table.c.username)).scalars()) == {"alice", "carol"}
@@ -0,0 +1,219 @@
+"""
+In-memory index of registered usernames, so logins for unknown names skip the database
+"""
+from __future__ import annotations, print_function
+
+import hashlib
+import math
+import sys
+import threading
+import time
+from typing import Callable
+
+import duo_utils
+
+
+class BloomFilter:
+    """Bloom filter sized for ``capacity`` items at a false positive rate of ``error_rate``"""
+
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.001):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        # Double hashing, https://www.eecs.harvard.edu/~michaelm/postscripts/rsa2008.pdf
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str):
+        positions = self._positions(item)
+        with self._lock:
+            new = False
+            for position in positions:
+                mask = 1 << (position & 7)
+                if not self._bits[position >> 3] & mask:
+                    self._bits[position >> 3] |= mask
+                    new = True
+            # Adding an item that is (probably) already present does not count it twice
+            if new:
+                self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def memory_bytes(self) -> int:
+        return len(self._bits)
+
+    def estimated_false_positive_rate(self) -> float:
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class UsernameIndex:
+    """Bloom filter of all registered usernames plus a small LRU of names the database confirmed missing.
+
+    ``loader(after_id, limit)`` returns up to ``limit`` ``(id, username)`` rows with an id above
+    ``after_id`` in id order. The index loads the table in batches that way at start up and picks
+    up users registered by other processes later: before a name is ruled out the index catches
+    up with the database, at most once every ``sync_interval`` seconds. Until the first load has
+    finished every name is reported as possibly registered.
+
+    Catching up only reads ids above the highest one seen, which misses a row committed after a
+    row with a higher id. SQLite serializes writers so ids are committed in order; with other
+    databases set ``rebuild_interval`` and a sync also reloads the whole table in the background
+    when the last full load is older than that.
+    """
+
+    def __init__(self,
+                 loader: Callable[[int, int], list],
+                 /,
+                 *,
+                 capacity: int = 100000,
+                 error_rate: float = 0.001,
+                 negative_size: int = 10000,
+                 negative_ttl: float = 60.0,
+                 sync_interval: float = 1.0,
+                 batch_size: int = 5000,
+                 rebuild_interval: float = 0.0,
+                 logger=None):
+        self.loader = loader
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        self.batch_size = batch_size
+        self.rebuild_interval = rebuild_interval
+        self.logger = logger
+        self.ready = False
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._negative = duo_utils.TTLCache(negative_size, negative_ttl)
+        self._last_id = 0
+        self._last_sync = 0.0
+        self._last_rebuild = 0.0
+        self._sync_lock = threading.Lock()
+        self._rebuilding = False
+        self._counters_lock = threading.Lock()
+        self.counters = {"lookups": 0, "bloom_rejects": 0, "negative_hits": 0, "false_positives": 0, "syncs": 0,
+                         "rebuilds": 0}
+
+    def _count(self, counter: str):
+        with self._counters_lock:
+            self.counters[counter] += 1
+
+    def _load(self, bloom: BloomFilter, after_id: int) -> int:
+        while rows := self.loader(after_id, self.batch_size):
+            for user_id, username in rows:
+                bloom.add(username)
+                self._negative.invalidate(username)
+                after_id = user_id
+            if len(rows) < self.batch_size:
+                break
+        return after_id
+
+    def sync(self, max_age: float = 0.0) -> bool:
+        """Add the users registered since the last load, unless that happened less than ``max_age`` seconds ago"""
+        with self._sync_lock:
+            # Threads that waited for the lock find the sync they wanted already done
+            if max_age and time.monotonic() - self._last_sync < max_age:
+                return False
+            self._last_id = self._load(self._bloom, self._last_id)
+            self._last_sync = time.monotonic()
+            self._count("syncs")
+            grow = self._bloom.count > self._bloom.capacity
+            stale = self.rebuild_interval > 0 and self._last_sync - self._last_rebuild >= self.rebuild_interval
+            start = (grow or stale) and not self._rebuilding
+            self._rebuilding = self._rebuilding or start
+        if start:
+            # Reads the whole table, never on a login request. Lookups use the current filter meanwhile.
+            threading.Thread(target=self._rebuild_in_background, args=(self._bloom.capacity * 2 if grow else None,),
+                             name="duo-username-index-grow" if grow else "duo-username-index-rebuild",
+                             daemon=True).start()
+        return True
+
+    def _rebuild_in_background(self, capacity: int | None):
+        try:
+            self.rebuild(capacity)
+        finally:
+            self._rebuilding = False
+
+    def rebuild(self, capacity: int = None):
+        """Load every username into a new filter, e.g. a larger one once the table outgrew the current one.
+
+        The table is read without holding the sync lock, lookups and syncs keep using the current filter
+        until the new one has caught up and replaces it.
+        """
+        started = time.monotonic()
+        bloom = BloomFilter(capacity or self._bloom.capacity, self.error_rate)
+        last_id = self._load(bloom, 0)
+        with self._sync_lock:
+            # Users registered while the table was read
+            last_id = self._load(bloom, last_id)
+            self._bloom, self._last_id = bloom, last_id
+            # add() calls made since went to the old filter, the next miss catches up on them
+            self._last_sync = 0.0
+            self._last_rebuild = started
+            self.ready = True
+        self._count("rebuilds")
+        if self.logger is not None:
+            self.logger.info("Username index loaded %d users: %s", bloom.count, self.stats())
+
+    def start(self):
+        """Load the index in a background thread, logins query the database until it is ready"""
+        threading.Thread(target=self.rebuild, name="duo-username-index", daemon=True).start()
+
+    def add(self, username: str):
+        """Register a new username, call after the user was committed"""
+        self._bloom.add(username)
+        self._negative.invalidate(username)
+
+    def _ruled_out_by(self, username: str) -> str | None:
+        if username not in self._bloom:
+            return "bloom_rejects"
+        if self._negative.get(username) is not None:
+            return "negative_hits"
+        return None
+
+    def might_exist(self, username: str) -> bool:
+        """False only if the username is certainly not registered"""
+        if not self.ready:
+            return True
+        self._count("lookups")
+        reason = self._ruled_out_by(username)
+        if reason is not None and time.monotonic() - self._last_sync >= self.sync_interval:
+            # Another process may have registered it since the last sync
+            self.sync(self.sync_interval)
+            reason = self._ruled_out_by(username)
+        if reason is None:
+            return True
+        self._count(reason)
+        return False
+
+    def record_miss(self, username: str):
+        """The database has no user of that name although might_exist() said it could"""
+        if self.ready:
+            self._count("false_positives")
+            self._negative.put(username, True)
+
+    def stats(self) -> dict:
+        bloom = self._bloom
+        negatives = len(self._negative)
+        rejected = self.counters["bloom_rejects"]
+        false_positives = self.counters["false_positives"]
+        return {
+                "usernames":                     bloom.count,
+                "capacity":                      bloom.capacity,
+                "bloom_hashes":                  bloom.hashes,
+                # Bloom filter bits plus an estimate for the negative cache entries
+                "memory_bytes":                  bloom.memory_bytes + negatives * (sys.getsizeof("x" * 16) + 120),
+                "negative_entries":              negatives,
+                "estimated_false_positive_rate": bloom.estimated_false_positive_rate(),
+                "observed_false_positive_rate":  (false_positives / (false_positives + rejected)
+                                                  if false_positives + rejected else 0.0),
+                **self.counters,
+        }
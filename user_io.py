@@ -0,0 +1,168 @@
+"""
+Bulk user import and export in CSV or JSON Lines format
+"""
+from __future__ import annotations, print_function
+
+import csv
+import itertools
+import json
+import logging
+import sys
+import time
+from typing import IO, Iterable, Iterator
+
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql, sqlite
+
+import password_hasher
+
+CONFLICT_POLICIES = ("skip", "update", "fail")
+
+
+def detect_format(path: str, fmt: str = None) -> str:
+    if fmt:
+        return fmt
+    return "jsonl" if path.endswith((".jsonl", ".ndjson", ".json")) else "csv"
+
+
+def _json_rows(stream: IO[str]) -> Iterator[dict]:
+    for line in stream:
+        if line.strip():
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            # A line that is not a JSON object is a record without a username, rejected by import_users()
+            yield row if isinstance(row, dict) else {}
+
+
+def read_users(stream: IO[str], fmt: str) -> Iterator[dict]:
+    """Yield one record per user. Records need a username and either a password or a password_hash,
+    import_users() rejects the ones that do not have them."""
+    rows = csv.DictReader(stream) if fmt == "csv" else _json_rows(stream)
+    for record_no, row in enumerate(rows, start=1):
+        username = row.get("username")
+        yield {"record": record_no, "username": username.strip() if isinstance(username, str) else "",
+               "password": row.get("password"), "password_hash": row.get("password_hash")}
+
+
+def _rejection(record: dict) -> str | None:
+    """Why a record can not be imported, None if it can"""
+    if not record["username"]:
+        return "username is missing"
+    if not (record["password"] or record["password_hash"]):
+        return "password or password_hash is missing"
+    if record["password_hash"]:
+        if not password_hasher.is_bcrypt_hash(record["password_hash"]):
+            return "password_hash is not a bcrypt hash"
+    elif not isinstance(record["password"], str):
+        return "password is not a string"
+    elif len(record["password"].encode("utf-8")) > password_hasher.MAX_PASSWORD_BYTES:
+        return f"password is longer than {password_hasher.MAX_PASSWORD_BYTES} bytes"
+    return None
+
+
+def _insert_statement(table, dialect_name: str, on_conflict: str):
+    """INSERT for a batch of users with the requested handling of duplicate usernames"""
+    dialect_insert = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}.get(dialect_name)
+    if on_conflict == "fail" or dialect_insert is None:
+        return insert(table)
+    statement = dialect_insert(table)
+    if on_conflict == "skip":
+        return statement.on_conflict_do_nothing(index_elements=["username"])
+    return statement.on_conflict_do_update(index_elements=["username"],
+                                           set_={"password": statement.excluded.password})
+
+
+def import_users(db,
+                 table,
+                 records: Iterable[dict],
+                 hasher: password_hasher.PasswordHasher,
+                 /,
+                 *,
+                 batch_size: int = 1000,
+                 on_conflict: str = "skip",
+                 logger: logging.Logger = None) -> dict:
+    """Hash plain text passwords in the hasher's process pool and insert users in batched transactions.
+
+    Records without a username or password, or with a password_hash that is not a bcrypt hash, are
+    rejected and counted: those users could never log in.
+    """
+    logger = logger if logger is not None else logging.getLogger(__name__)
+    statement = _insert_statement(table, db.engine.dialect.name, on_conflict)
+    totals = {"read": 0, "inserted": 0, "skipped": 0, "rejected": 0}
+    start = time.perf_counter()
+    records = iter(records)
+    while batch := list(itertools.islice(records, batch_size)):
+        totals["read"] += len(batch)
+        valid = []
+        for record in batch:
+            reason = _rejection(record)
+            if reason is None:
+                valid.append(record)
+            else:
+                totals["rejected"] += 1
+                logger.warning("Rejected user %s: %s", record["username"] or f"in record {record.get('record')}",
+                               reason)
+        if valid:
+            plain = [record["password"] for record in valid if not record["password_hash"]]
+            hashes = iter(hasher.hash_many(plain))
+            rows = [{"username": record["username"], "password": record["password_hash"] or next(hashes)}
+                    for record in valid]
+            with db.engine.begin() as conn:
+                result = conn.execute(statement, rows)
+            # rowcount is the number of rows actually written, or -1 when the driver can not tell
+            written = result.rowcount if result.rowcount >= 0 else len(rows)
+            totals["inserted"] += written
+            totals["skipped"] += len(rows) - written
+        elapsed = time.perf_counter() - start
+        logger.info("Imported %d users (%d skipped, %d rejected), %.1f users/s", totals["read"], totals["skipped"],
+                    totals["rejected"], totals["read"] / elapsed if elapsed else 0.0)
+    totals["seconds"] = round(time.perf_counter() - start, 3)
+    return totals
+
+
+def export_users(db, table, stream: IO[str], fmt: str, /, *, batch_size: int = 1000) -> int:
+    """Stream all users with their password hashes, without loading the table into memory"""
+    writer = None
+    if fmt == "csv":
+        writer = csv.writer(stream)
+        writer.writerow(["username", "password_hash"])
+    count = 0
+    with db.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(
+                table.select().with_only_columns(table.c.username, table.c.password).order_by(table.c.id))
+        for username, pw_hash in result:
+            if writer is not None:
+                writer.writerow([username, pw_hash])
+            else:
+                stream.write(json.dumps({"username": username, "password_hash": pw_hash}) + "\n")
+            count += 1
+    return count
+
+
+def run(args, db, table, hasher: password_hasher.PasswordHasher, logger: logging.Logger = None) -> dict:
+    """Run the ``import`` or ``export`` command line subcommand. ``-`` reads stdin or writes stdout."""
+    logger = logger if logger is not None else logging.getLogger(__name__)
+    path = args.input if args.command == "import" else args.output
+    fmt = detect_format(path or "-", args.format)
+    if args.command == "import":
+        stream = sys.stdin if path in (None, "-") else open(path, newline="", encoding="utf-8")
+        try:
+            totals = import_users(db, table, read_users(stream, fmt), hasher,
+                                  batch_size=args.batch_size, on_conflict=args.on_conflict, logger=logger)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        logger.info("Import finished: %s", totals)
+        return totals
+    stream = sys.stdout if path in (None, "-") else open(path, "w", newline="", encoding="utf-8")
+    try:
+        start = time.perf_counter()
+        count = export_users(db, table, stream, fmt, batch_size=args.batch_size)
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+    totals = {"exported": count, "seconds": round(time.perf_counter() - start, 3)}
+    logger.info("Export finished: %s", totals)
+    return totals
@@ -0,0 +1,74 @@
+"""
+Production WSGI serving mode. Runs the Flask app with gunicorn pre-fork workers instead of the
+single process Werkzeug development server.
+"""
+from __future__ import annotations, print_function
+
+import logging
+import os
+from typing import Callable
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # gunicorn is not available on Windows
+    BaseApplication = None
+
+DEFAULT_WORKERS = 2
+DEFAULT_THREADS = 4
+
+
+def server_options(section, /, *, workers: int = None, threads: int = None) -> dict:
+    """Build gunicorn settings from a duo.conf section, command line values take precedence"""
+    return {
+            "bind":             f"{section.get('app_host', 'localhost')}:{section.get('app_port', '8008')}",
+            "workers":          workers or section.getint('server_workers', fallback=DEFAULT_WORKERS),
+            "threads":          threads or section.getint('server_threads', fallback=DEFAULT_THREADS),
+            "timeout":          section.getint('server_timeout', fallback=30),
+            "graceful_timeout": section.getint('server_graceful_timeout', fallback=30),
+            "keepalive":        section.getint('server_keepalive', fallback=5),
+            "max_requests":     section.getint('server_max_requests', fallback=0),
+            "max_requests_jitter": section.getint('server_max_requests_jitter', fallback=0),
+    }
+
+
+class WSGIServer(BaseApplication or object):
+    """Embedded gunicorn application. ``kill -HUP <master pid>`` gracefully restarts the workers."""
+
+    def __init__(self, app, options: dict, post_worker_init: Callable[[], None] = None):
+        self.application = app
+        self.options = options
+        self._post_worker_init = post_worker_init
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+        if self._post_worker_init is not None:
+            # Threads and pools can not be shared across fork(), start them in every worker
+            self.cfg.set("post_worker_init", lambda worker: self._post_worker_init())
+
+    def load(self):
+        return self.application
+
+
+def serve(app, section, /, *,
+          workers: int = None,
+          threads: int = None,
+          debug: bool = False,
+          post_worker_init: Callable[[], None] = None,
+          logger: logging.Logger = None):
+    """Serve the app with gunicorn, or with the Flask development server in debug mode"""
+    logger = logger if logger is not None else logging.getLogger(__name__)
+    if debug or BaseApplication is None:
+        if not debug:
+            logger.warning("gunicorn is not installed, falling back to the development server.")
+        if post_worker_init is not None and (not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true"):
+            # With the reloader only the child process serves requests
+            post_worker_init()
+        app.run(host=section['app_host'], port=int(section['app_port']), debug=debug, threaded=True)
+        return
+    options = server_options(section, workers=workers, threads=threads)
+    logger.info("Starting %d worker(s) with %d thread(s) each on %s",
+                options["workers"], options["threads"], options["bind"])
+    WSGIServer(app, options, post_worker_init).run()